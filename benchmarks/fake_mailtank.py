@@ -0,0 +1,181 @@
+# coding: utf-8
+"""Локальная замена Mailtank API для нагрузочных тестов.
+
+Поддерживает то, чем пользуется rsstank: постраничный список тегов
+(`GET /tags/`), создание рассылок (`POST /mailings/`), а также
+`GET /project` и `POST /layouts/` для админки. Ключ доступа передаётся
+в заголовке `X-Auth-Token`.
+"""
+import json
+import time
+import random
+import threading
+import collections
+import urlparse
+
+from . import RequestHandler, serve
+
+
+class FakeMailtank(object):
+    """Состояние и поведение поддельного Mailtank API.
+
+    Проекты заводятся :meth:`add_project`; на запросы с незнакомым
+    ключом API отвечает 401.
+
+    :param tags_per_page: число тегов на странице `GET /tags/`
+    :param latency: задержка (в секундах) перед каждым ответом
+    :param errors: словарь из статусов ответа (например, 429 или 503)
+                   в доли запросов, на которые API отвечает этим статусом
+    :param max_requests_per_key: сколько запросов с одним ключом API
+                                 обрабатывает одновременно; на остальные
+                                 отвечает 429. 0 -- без ограничения
+    """
+
+    def __init__(self, tags_per_page=100, latency=0, errors=None,
+                 max_requests_per_key=0, seed=0):
+        self.tags_per_page = tags_per_page
+        self.latency = latency
+        self.errors = sorted((errors or {}).items())
+        self.max_requests_per_key = max_requests_per_key
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # Ключ -> теги проекта
+        self._tags = {}
+        # Ключ -> статус, которым API отвечает на все запросы с ключом
+        self._statuses = {}
+        self._running_by_keys = collections.Counter()
+        self._mailings_n = 0
+        #: Число ответов по парам (метод API, статус)
+        self.responses = collections.Counter()
+        #: Созданные рассылки по ключам
+        self.mailings = collections.defaultdict(list)
+
+    def add_project(self, key, tags, status=None):
+        """Заводит проект с ключом доступа `key` и тегами `tags`.
+        Если задан `status` (например, 403), API отвечает им на все
+        запросы с этим ключом.
+        """
+        with self._lock:
+            self._tags[key] = list(tags)
+            if status is not None:
+                self._statuses[key] = status
+
+    def get_error_status(self):
+        """Возвращает статус случайной ошибки (см. `errors`) или None."""
+        with self._lock:
+            value = self._random.random()
+        for status, fraction in self.errors:
+            if value < fraction:
+                return status
+            value -= fraction
+        return None
+
+    def get_tags(self, key, query):
+        args = urlparse.parse_qs(query)
+        mask = args.get('mask', [''])[0].decode('utf-8')
+        page = int(args.get('page', ['1'])[0])
+        tags = [tag for tag in self._tags[key] if tag.startswith(mask)]
+        pages_total = max((len(tags) + self.tags_per_page - 1) // self.tags_per_page, 1)
+        if not 1 <= page <= pages_total:
+            return 404, {'detail': 'Page {0} does not exist'.format(page)}
+        start = (page - 1) * self.tags_per_page
+        return 200, {
+            'objects': [{'name': tag} for tag in tags[start:start + self.tags_per_page]],
+            'page': page,
+            'pages_total': pages_total,
+        }
+
+    def create_mailing(self, key, data):
+        for field in 'layout_id', 'context', 'target':
+            if field not in data:
+                return 400, {field: ['This field is required.']}
+        with self._lock:
+            self.mailings[key].append(data)
+            self._mailings_n += 1
+            mailing_id = self._mailings_n
+        return 200, {
+            'id': mailing_id,
+            'url': '/mailings/{0}'.format(mailing_id),
+            'status': 'ENQUEUED',
+            'eta': None,
+        }
+
+    def respond(self, method, url, key, body, is_limited=False):
+        """Возвращает название метода API, статус и тело (объект для JSON)
+        ответа на запрос `method` `url` с ключом `key` и телом `body`.
+        Если `is_limited`, запрос отклоняется с 429.
+        """
+        url = urlparse.urlsplit(url)
+        path = url.path.rstrip('/')
+        if method == 'GET' and path == '/tags':
+            name = 'get_tags'
+        elif method == 'POST' and path == '/mailings':
+            name = 'create_mailing'
+        elif method == 'GET' and path == '/project':
+            name = 'get_project'
+        elif method == 'POST' and path == '/layouts':
+            name = 'create_layout'
+        else:
+            return None, 404, {'detail': 'Not found'}
+
+        if key not in self._tags:
+            return name, 401, {'detail': 'Invalid token'}
+        if key in self._statuses:
+            return name, self._statuses[key], {'detail': 'Access denied'}
+        if is_limited:
+            return name, 429, {'detail': 'Too many requests'}
+        status = self.get_error_status()
+        if status is not None:
+            return name, status, {'detail': 'Simulated error'}
+
+        if name == 'get_tags':
+            return (name,) + self.get_tags(key, url.query)
+        try:
+            data = json.loads(body or '{}')
+        except ValueError:
+            return name, 400, {'detail': 'Malformed JSON'}
+        if name == 'create_mailing':
+            return (name,) + self.create_mailing(key, data)
+        if name == 'get_project':
+            return name, 200, {'name': 'Project {0}'.format(key),
+                               'from_email': 'no-reply@example.com'}
+        return name, 200, {'id': 'layout-{0}'.format(key)}
+
+    def get_handler_class(self):
+        """Возвращает класс обработчика запросов к API для :func:`serve`."""
+        mailtank = self
+
+        class FakeMailtankHandler(RequestHandler):
+            def handle_request(self):
+                key = self.headers.get('X-Auth-Token')
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else ''
+
+                with mailtank._lock:
+                    mailtank._running_by_keys[key] += 1
+                    is_limited = (mailtank.max_requests_per_key and
+                                  mailtank._running_by_keys[key] >
+                                  mailtank.max_requests_per_key)
+                try:
+                    if mailtank.latency:
+                        time.sleep(mailtank.latency)
+                    name, status, data = mailtank.respond(
+                        self.command, self.path, key, body, is_limited)
+                finally:
+                    with mailtank._lock:
+                        mailtank._running_by_keys[key] -= 1
+                with mailtank._lock:
+                    mailtank.responses[name, status] += 1
+
+                headers = [('Content-Type', 'application/json')]
+                if status == 429:
+                    headers.append(('Retry-After', '1'))
+                self.send(status, json.dumps(data), headers)
+
+            do_GET = do_POST = handle_request
+
+        return FakeMailtankHandler
+
+    def serve(self):
+        """Запускает API (см. :func:`benchmarks.serve`)."""
+        return serve(self.get_handler_class())
@@ -0,0 +1,236 @@
+# coding: utf-8
+"""Ферма синтетических RSS- и Atom-фидов для нагрузочных тестов.
+
+Фиды разбросаны по виртуальным хостам `hNNNN.farm.test`. Ферма работает
+как HTTP-прокси: направив на неё запросы через переменную окружения
+`http_proxy`, можно опрашивать тысячи хостов, не трогая DNS.
+"""
+import time
+import hashlib
+import calendar
+import datetime
+import threading
+import collections
+import urlparse
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+
+from . import RequestHandler, serve
+
+
+LOREM_IPSUM = u'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+
+RSS_TEMPLATE = u'''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel>
+<title>Feed {feed}</title>
+<link>http://{host}/</link>
+<description>Synthetic feed {feed}</description>
+<lastBuildDate>{{build_date}}</lastBuildDate>
+{items}
+</channel></rss>
+'''
+
+RSS_ITEM_TEMPLATE = u'''<item>
+<title>Item {item} of feed {feed}</title>
+<link>http://{host}/items/{feed}/{item}</link>
+<description>{description}</description>
+<guid isPermaLink="false">{feed}-{item}</guid>
+<pubDate>{pub_date}</pubDate>
+</item>'''
+
+ATOM_TEMPLATE = u'''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+<title>Feed {feed}</title>
+<link href="http://{host}/"/>
+<id>urn:farm:{feed}</id>
+<updated>{{build_date}}</updated>
+{items}
+</feed>
+'''
+
+ATOM_ENTRY_TEMPLATE = u'''<entry>
+<title>Item {item} of feed {feed}</title>
+<link href="http://{host}/items/{feed}/{item}"/>
+<id>urn:farm:{feed}:{item}</id>
+<published>{pub_date}</published>
+<updated>{pub_date}</updated>
+<summary>{description}</summary>
+</entry>'''
+
+
+class FeedFarm(object):
+    """Множество из `feeds` синтетических фидов, равномерно разбросанных
+    по `hosts` виртуальным хостам.
+
+    Поведение фидов задаётся долями от 0 до 1 и детерминировано
+    (см. :meth:`chance`), поэтому повторные запуски с одними и теми же
+    параметрами нагружают rsstank одинаково.
+
+    :param items: число элементов в каждом фиде
+    :param item_size: примерный размер описания элемента в байтах
+    :param latency: задержка (в секундах) перед каждым ответом
+    :param crawl_delay: Crawl-delay в robots.txt каждого хоста
+    :param validators: доля фидов, присылающих ETag и Last-Modified
+                       и отвечающих 304 на условный GET
+    :param atom: доля Atom-фидов (остальные -- RSS)
+    :param failures: доля запросов фидов, на которые ферма отвечает 500
+    :param updates: доля фидов, в которых за раунд (см. :meth:`next_round`)
+                    появляется новый элемент
+    """
+
+    def __init__(self, feeds=1000, hosts=100, items=20, item_size=500,
+                 latency=0, crawl_delay=0, validators=0.5, atom=0.3,
+                 failures=0.01, updates=0.1, seed=0):
+        self.feeds = feeds
+        self.hosts = hosts
+        self.items = items
+        self.item_size = item_size
+        self.latency = latency
+        self.crawl_delay = crawl_delay
+        self.validators = validators
+        self.atom = atom
+        self.failures = failures
+        self.updates = updates
+        self.seed = seed
+        #: Номер текущего раунда
+        self.round = 0
+        # Номер самого старого элемента каждого фида. Каждое
+        # обновление фида сдвигает окно его элементов на один
+        self._offsets = [0] * feeds
+        self._bodies = {}
+        # Элементы датируются от этой даты и до примерно часа назад
+        self._epoch = datetime.datetime.utcnow().replace(microsecond=0) - \
+            datetime.timedelta(hours=items + 1)
+        self._lock = threading.Lock()
+        #: Число ответов фермы по статусам
+        self.responses = collections.Counter()
+        #: Число отправленных байт тел ответов
+        self.bytes_sent = 0
+
+    def chance(self, *args):
+        """Возвращает псевдослучайное число от 0 до 1, однозначно
+        определяемое `args` и `seed` фермы.
+        """
+        digest = hashlib.md5(repr((self.seed,) + args)).hexdigest()
+        return int(digest[:8], 16) / float(0xffffffff)
+
+    def get_host(self, feed):
+        return 'h{0:04d}.farm.test'.format(feed % self.hosts)
+
+    def is_atom(self, feed):
+        return self.chance('atom', feed) < self.atom
+
+    def has_validators(self, feed):
+        return self.chance('validators', feed) < self.validators
+
+    def get_url(self, feed):
+        """Возвращает URL фида с номером `feed`."""
+        return 'http://{0}/feeds/{1}.{2}'.format(
+            self.get_host(feed), feed, 'atom' if self.is_atom(feed) else 'rss')
+
+    @property
+    def urls(self):
+        return [self.get_url(feed) for feed in range(self.feeds)]
+
+    def next_round(self):
+        """Начинает следующий раунд: в доле `updates` фидов появляется
+        новый элемент, а отказывают теперь другие фиды.
+        """
+        with self._lock:
+            self.round += 1
+            for feed in range(self.feeds):
+                if self.chance('update', feed, self.round) < self.updates:
+                    self._offsets[feed] += 1
+
+    def get_pub_date(self, item):
+        return self._epoch + datetime.timedelta(hours=item)
+
+    def render(self, feed, offset):
+        """Возвращает тело фида `feed` с элементами, начиная с `offset`,
+        в котором вместо даты сборки стоит `{build_date}`.
+        """
+        host = self.get_host(feed)
+        atom = self.is_atom(feed)
+        description = escape((LOREM_IPSUM * (self.item_size // len(LOREM_IPSUM) + 1))
+                             [:self.item_size])
+        # Элементы идут от новых к старым
+        items = []
+        for item in reversed(range(offset, offset + self.items)):
+            pub_date = self.get_pub_date(item)
+            items.append((ATOM_ENTRY_TEMPLATE if atom else RSS_ITEM_TEMPLATE).format(
+                feed=feed, item=item, host=host,
+                description=description,
+                pub_date=(pub_date.isoformat() + 'Z' if atom else
+                          formatdate(calendar.timegm(pub_date.timetuple()), usegmt=True))))
+        return (ATOM_TEMPLATE if atom else RSS_TEMPLATE).format(
+            feed=feed, host=host, items=u'\n'.join(items)).encode('utf-8')
+
+    def get_feed(self, feed):
+        """Возвращает тело (см. :meth:`render`) и ETag текущей версии
+        фида `feed`.
+        """
+        offset = self._offsets[feed]
+        key = feed, offset
+        body = self._bodies.get(key)
+        if body is None:
+            body = self._bodies[key] = self.render(feed, offset)
+            # Старые версии фида больше не понадобятся
+            self._bodies.pop((feed, offset - 1), None)
+        return body, '"{0}-{1}"'.format(feed, offset)
+
+    def respond(self, url, headers):
+        """Возвращает статус, тело и заголовки ответа на GET `url`
+        с заголовками запроса `headers`.
+        """
+        path = urlparse.urlsplit(url).path
+        if path == '/robots.txt':
+            robots_txt = 'User-agent: *\n'
+            if self.crawl_delay:
+                robots_txt += 'Crawl-delay: {0}\n'.format(self.crawl_delay)
+            return 200, robots_txt, [('Content-Type', 'text/plain')]
+
+        feed = path[len('/feeds/'):].split('.')[0]
+        if not path.startswith('/feeds/') or not feed.isdigit() or \
+                int(feed) >= self.feeds:
+            return 404, 'Not found', [('Content-Type', 'text/plain')]
+        feed = int(feed)
+
+        if self.chance('failure', feed, self.round) < self.failures:
+            return 500, 'Internal server error', [('Content-Type', 'text/plain')]
+
+        body, etag = self.get_feed(feed)
+        response_headers = [('Content-Type', 'application/atom+xml' if self.is_atom(feed)
+                             else 'application/rss+xml')]
+        if self.has_validators(feed):
+            last_modified = formatdate(calendar.timegm(self.get_pub_date(
+                self._offsets[feed] + self.items - 1).timetuple()), usegmt=True)
+            if headers.get('If-None-Match') == etag:
+                return 304, '', [('ETag', etag)]
+            response_headers += [('ETag', etag), ('Last-Modified', last_modified)]
+        build_date = (datetime.datetime.utcnow().isoformat() + 'Z' if self.is_atom(feed)
+                      else formatdate(usegmt=True))
+        return 200, body.replace('{build_date}', build_date), response_headers
+
+    def get_handler_class(self):
+        """Возвращает класс обработчика запросов к ферме для :func:`serve`."""
+        farm = self
+
+        class FeedFarmHandler(RequestHandler):
+            def do_GET(self):
+                if farm.latency:
+                    time.sleep(farm.latency)
+                url = self.path
+                if url.startswith('/'):
+                    # Запрос не через прокси
+                    url = 'http://{0}{1}'.format(self.headers.get('Host', ''), url)
+                status, body, headers = farm.respond(url, self.headers)
+                with farm._lock:
+                    farm.responses[status] += 1
+                    farm.bytes_sent += len(body)
+                self.send(status, body, headers)
+
+        return FeedFarmHandler
+
+    def serve(self):
+        """Запускает ферму (см. :func:`benchmarks.serve`)."""
+        return serve(self.get_handler_class())
@@ -0,0 +1,180 @@
+# coding: utf-8
+"""Бенчмарк `./manage.py poll_feeds`.
+
+Опрашивает синтетические фиды фермы (см. :mod:`benchmarks.feed_farm`)
+несколько раундов подряд и выводит по каждому раунду пропускную
+способность, задержки скачивания и время записи в БД. Первый раунд
+сохраняет все элементы фидов, следующие -- только новые, как это
+происходит в рабочем режиме.
+
+Пример::
+
+    python -m benchmarks.poll_feeds --feeds 5000 --hosts 500 --latency 0.05 \\
+        --engine async --database mysql://root@localhost/rsstank_benchmark
+"""
+from __future__ import print_function
+
+import os
+import time
+import datetime
+import argparse
+
+from . import (add_common_arguments, configure_logging, database,
+               format_table, get_server_url)
+from .feed_farm import FeedFarm
+from rsstank import app, metrics, poll_feeds
+from rsstank.models import db, AccessKey, Feed
+
+
+#: Колонки отчёта: заголовок и ключ словаря, возвращаемого :func:`run_round`
+COLUMNS = (
+    ('round', 'round'),
+    ('seconds', 'seconds'),
+    ('feeds/s', 'feeds_per_second'),
+    ('fetch p50', 'fetch_p50'),
+    ('fetch p99', 'fetch_p99'),
+    ('parse s', 'parse_seconds'),
+    ('db write s', 'db_write_seconds'),
+    ('items', 'items_inserted'),
+    ('unchanged', 'unchanged'),
+    ('errors', 'errors'),
+    ('MiB', 'downloaded_mib'),
+)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.poll_feeds',
+        description='Measures ./manage.py poll_feeds against a local farm '
+                    'of synthetic feeds.')
+    parser.add_argument('--engine', choices=sorted(poll_feeds.ENGINES),
+                        default='threads', help='polling engine (default: %(default)s)')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='number of polls of all feeds (default: %(default)s)')
+    parser.add_argument('--keys', type=int, default=10,
+                        help='number of access keys feeds are split between '
+                             '(default: %(default)s)')
+    parser.add_argument('--feeds', type=int, default=2000,
+                        help='number of feeds (default: %(default)s)')
+    parser.add_argument('--hosts', type=int, default=200,
+                        help='number of hosts feeds are spread across '
+                             '(default: %(default)s)')
+    parser.add_argument('--items', type=int, default=20,
+                        help='number of items in each feed (default: %(default)s)')
+    parser.add_argument('--item-size', type=int, default=500,
+                        help='size of item description in bytes (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='delay in seconds before each response of the farm '
+                             '(default: %(default)s)')
+    parser.add_argument('--crawl-delay', type=float, default=0.05,
+                        help='Crawl-delay in robots.txt of each host in seconds '
+                             '(default: %(default)s)')
+    parser.add_argument('--validators', type=float, default=0.5,
+                        help='fraction of feeds sending ETag and Last-Modified '
+                             '(default: %(default)s)')
+    parser.add_argument('--atom', type=float, default=0.3,
+                        help='fraction of Atom feeds (default: %(default)s)')
+    parser.add_argument('--failures', type=float, default=0.01,
+                        help='fraction of feed requests failing with 500 '
+                             '(default: %(default)s)')
+    parser.add_argument('--updates', type=float, default=0.1,
+                        help='fraction of feeds getting a new item between rounds '
+                             '(default: %(default)s)')
+    add_common_arguments(parser)
+    return parser.parse_args(args)
+
+
+def seed(farm, keys_n):
+    """Заводит `keys_n` включенных ключей и поровну распределяет
+    между ними фиды фермы `farm`.
+    """
+    enabled_at = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+    db.session.execute(AccessKey.__table__.insert(), [
+        {'content': 'benchmark-{0}'.format(i), 'namespace': 'benchmark',
+         'enabled_at': enabled_at}
+        for i in range(keys_n)])
+    key_ids = [key_id for key_id, in db.session.query(AccessKey.id).order_by(AccessKey.id)]
+    sending_interval = 60 * 60 * 24
+    db.session.execute(Feed.__table__.insert(), [
+        {'access_key_id': key_ids[i % keys_n], 'url': url,
+         'sending_interval': sending_interval,
+         'tag': 'rss:benchmark:{0}:{1}'.format(url, sending_interval)}
+        for i, url in enumerate(farm.urls)])
+    db.session.commit()
+
+
+def run_round(farm, engine):
+    """Опрашивает все фиды фермы `farm` способом `engine` и возвращает
+    словарь с результатами (см. :data:`COLUMNS`).
+    """
+    # Все фиды должны быть опрошены, когда бы их ни запланировали
+    db.session.execute(Feed.__table__.update().values(next_poll_at=None))
+    db.session.commit()
+    db.session.remove()
+
+    metrics.reset()
+    started_at = time.time()
+    poll_feeds.main(engine=engine)
+    seconds = time.time() - started_at
+    db.session.remove()
+
+    _, flush_seconds = metrics.get_histogram('rsstank_db_flush_seconds')
+    _, commit_seconds = metrics.get_histogram('rsstank_db_commit_seconds')
+    _, parse_seconds = metrics.get_histogram('rsstank_parse_seconds')
+    return {
+        'round': farm.round + 1,
+        'seconds': seconds,
+        'feeds_per_second': farm.feeds / seconds,
+        'fetch_p50': metrics.quantile('rsstank_fetch_seconds', 0.5),
+        'fetch_p99': metrics.quantile('rsstank_fetch_seconds', 0.99),
+        'parse_seconds': parse_seconds,
+        'db_write_seconds': flush_seconds + commit_seconds,
+        'items_inserted': metrics.get_total('rsstank_feed_items_inserted_total'),
+        # Ответы 304 и тела, хеш которых не изменился
+        'unchanged': (metrics.get_total('rsstank_fetch_responses_total', status=304) +
+                      metrics.get_total('rsstank_feeds_unchanged_total')),
+        'errors': (metrics.get_total('rsstank_fetch_responses_total', status=500) +
+                   metrics.get_total('rsstank_fetch_errors_total')),
+        'downloaded_mib': (metrics.get_total('rsstank_downloaded_bytes_total') /
+                           1024.0 / 1024),
+    }
+
+
+def main(args=None):
+    args = parse_args(args)
+    configure_logging(args.verbose)
+    farm = FeedFarm(
+        feeds=args.feeds, hosts=args.hosts, items=args.items,
+        item_size=args.item_size, latency=args.latency,
+        crawl_delay=args.crawl_delay, validators=args.validators, atom=args.atom,
+        failures=args.failures, updates=args.updates)
+    # Хосты без Crawl-delay опрашиваются с задержкой по умолчанию
+    app.config['RSSTANK_DEFAULT_CRAWL_DELAY'] = args.crawl_delay
+
+    with database(args.database) as uri, farm.serve() as server:
+        # Ферма -- прокси для всех хостов фидов
+        for name in 'http_proxy', 'HTTP_PROXY':
+            os.environ[name] = get_server_url(server)
+        for name in 'no_proxy', 'NO_PROXY':
+            os.environ.pop(name, None)
+        print('Polling {0} feeds on {1} hosts with {2} engine, database: {3}'.format(
+            args.feeds, args.hosts, args.engine, uri))
+        seed(farm, args.keys)
+
+        results = []
+        for i in range(args.rounds):
+            if i:
+                farm.next_round()
+            results.append(run_round(farm, args.engine))
+            print('Round {0} has taken {1:.1f}s.'.format(i + 1, results[-1]['seconds']))
+
+        print()
+        print(format_table(COLUMNS, results))
+        print('\nFarm responses: {0}; {1:.1f} MiB sent.'.format(
+            ', '.join('{0}: {1}'.format(status, n)
+                      for status, n in sorted(farm.responses.items())),
+            farm.bytes_sent / 1024.0 / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+# coding: utf-8
+"""Бенчмарк `./manage.py update_feeds` и `./manage.py send_feeds`.
+
+Заводит ключи доступа и проекты в поддельном Mailtank API (см.
+:mod:`benchmarks.fake_mailtank`) и по очереди замеряет:
+
+* синхронизацию фидов с тегами всех ключей (update_feeds), сначала
+  с пустой БД, затем -- с уже синхронизированной;
+* рассылку всех фидов в интервале первой рассылки, когда посылать
+  пора сразу всё (send_feeds), и повторный запуск, при котором
+  посылаются только фиды, не посланные из-за ошибок API.
+
+Пример::
+
+    python -m benchmarks.send_feeds --keys 200 --feeds 50 --items 20 \\
+        --latency 0.05 --send-workers 50
+"""
+from __future__ import print_function
+
+import os
+import time
+import datetime
+import argparse
+import collections
+
+from . import (add_common_arguments, configure_logging, database,
+               format_table, get_server_url)
+from .fake_mailtank import FakeMailtank
+from rsstank import app, metrics, send_feeds, update_feeds
+from rsstank.models import db, AccessKey, Feed, FeedItem
+
+
+#: Колонки отчёта: заголовок и ключ словаря, возвращаемого :func:`run_phase`
+COLUMNS = (
+    ('phase', 'phase'),
+    ('seconds', 'seconds'),
+    ('keys/s', 'keys_per_second'),
+    ('api calls', 'api_calls'),
+    ('api p50', 'api_p50'),
+    ('api p99', 'api_p99'),
+    ('api errors', 'api_errors'),
+    ('feeds added', 'feeds_added'),
+    ('mailings', 'mailings'),
+    ('mailings/s', 'mailings_per_second'),
+    ('items sent', 'items_sent'),
+)
+
+#: Сколько строк вставлять в БД одним запросом при заполнении
+CHUNK_SIZE = 1000
+
+
+def parse_errors(value):
+    """Разбирает аргумент `--errors` вида `429=0.01,503=0.02`."""
+    try:
+        return dict((int(status), float(fraction)) for status, fraction in
+                    (pair.split('=') for pair in value.split(',') if pair))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected STATUS=FRACTION pairs separated by commas')
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.send_feeds',
+        description='Measures ./manage.py update_feeds and ./manage.py send_feeds '
+                    'against a local fake of Mailtank API.')
+    parser.add_argument('--keys', type=int, default=50,
+                        help='number of access keys (default: %(default)s)')
+    parser.add_argument('--feeds', type=int, default=20,
+                        help='number of feeds per key (default: %(default)s)')
+    parser.add_argument('--items', type=int, default=10,
+                        help='number of unsent items per feed (default: %(default)s)')
+    parser.add_argument('--other-tags', type=int, default=20,
+                        help='number of non-feed tags per project (default: %(default)s)')
+    parser.add_argument('--tags-per-page', type=int, default=100,
+                        help='page size of tags listing (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='delay in seconds before each API response '
+                             '(default: %(default)s)')
+    parser.add_argument('--errors', type=parse_errors, default={429: 0.01, 500: 0.01},
+                        metavar='STATUS=FRACTION,...',
+                        help='fractions of API requests failing with given statuses '
+                             '(default: 429=0.01,500=0.01)')
+    parser.add_argument('--forbidden-keys', type=float, default=0.02,
+                        help='fraction of keys the API answers 403 to '
+                             '(default: %(default)s)')
+    parser.add_argument('--max-requests-per-key', type=int, default=0,
+                        help='concurrent requests per key the API serves before '
+                             'answering 429, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--update-workers', type=int,
+                        default=app.config['RSSTANK_UPDATE_WORKERS'],
+                        help='RSSTANK_UPDATE_WORKERS (default: %(default)s)')
+    parser.add_argument('--send-workers', type=int,
+                        default=app.config['RSSTANK_SEND_WORKERS'],
+                        help='RSSTANK_SEND_WORKERS (default: %(default)s)')
+    parser.add_argument('--send-workers-per-key', type=int,
+                        default=app.config['RSSTANK_SEND_WORKERS_PER_KEY'],
+                        help='RSSTANK_SEND_WORKERS_PER_KEY (default: %(default)s)')
+    add_common_arguments(parser)
+    return parser.parse_args(args)
+
+
+def get_feed_tag(key_n, feed_n, namespace):
+    url = 'http://h{0:04d}.feeds.test/{1}/{2}.rss'.format(feed_n, key_n, feed_n)
+    return 'rss:{0}:{1}:{2}'.format(namespace, url, 60 * 60 * 24)
+
+
+def seed_keys(mailtank, args):
+    """Заводит `args.keys` включенных ключей, которым можно впервые
+    посылать рассылки в любое время суток, и их проекты в `mailtank`.
+    """
+    forbidden_n = int(args.keys * args.forbidden_keys)
+    rows = []
+    for i in range(args.keys):
+        content = 'benchmark-key-{0}'.format(i)
+        namespace = 'ns{0}'.format(i)
+        tags = [get_feed_tag(i, j, namespace) for j in range(args.feeds)]
+        tags += ['other_tag_{0}'.format(j) for j in range(args.other_tags)]
+        mailtank.add_project(content, tags, status=403 if i < forbidden_n else None)
+        rows.append({
+            'content': content,
+            'namespace': namespace,
+            'layout_id': 'layout-{0}'.format(i),
+            'enabled_at': datetime.datetime.utcnow() - datetime.timedelta(days=30),
+            'first_send_interval_start': datetime.time(0, 0, 0),
+            'first_send_interval_end': datetime.time(23, 59, 59),
+        })
+    db.session.execute(AccessKey.__table__.insert(), rows)
+    db.session.commit()
+
+
+def seed_items(items_n):
+    """Добавляет в каждый фид `items_n` ещё не посланных элементов."""
+    created_at = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    feed_ids = [feed_id for feed_id, in db.session.query(Feed.id)]
+    rows = []
+    for feed_id in feed_ids:
+        for i in range(items_n):
+            guid = 'http://example.com/{0}/{1}'.format(feed_id, i)
+            rows.append({
+                'feed_id': feed_id,
+                'created_at': created_at,
+                'title': 'Item {0}'.format(i),
+                'link': guid,
+                'description': 'Description of item {0}'.format(i),
+                'guid': guid,
+                'guid_hash': FeedItem.hash_guid(guid),
+                'pub_date': created_at - datetime.timedelta(hours=i),
+            })
+            if len(rows) == CHUNK_SIZE:
+                db.session.execute(FeedItem.__table__.insert(), rows)
+                rows = []
+    if rows:
+        db.session.execute(FeedItem.__table__.insert(), rows)
+    db.session.commit()
+    return len(feed_ids) * items_n
+
+
+def run_phase(name, function, mailtank, method):
+    """Выполняет `function` и возвращает словарь с результатами (см.
+    :data:`COLUMNS`). `method` -- метод Mailtank API, которым пользуется
+    `function`.
+    """
+    keys_n = AccessKey.query.filter_by(is_enabled=True).count()
+    db.session.remove()
+    responses = collections.Counter(mailtank.responses)
+
+    metrics.reset()
+    started_at = time.time()
+    function()
+    seconds = time.time() - started_at
+    db.session.remove()
+
+    api_calls = sum(n for (api_method, _), n in
+                    (collections.Counter(mailtank.responses) - responses).iteritems()
+                    if api_method == method)
+    mailings_n = metrics.get_total('rsstank_mailings_created_total')
+    return {
+        'phase': name,
+        'seconds': seconds,
+        'keys_per_second': keys_n / seconds if method == 'get_tags' else None,
+        'api_calls': api_calls,
+        'api_p50': metrics.quantile('rsstank_mailtank_request_seconds', 0.5,
+                                    method=method),
+        'api_p99': metrics.quantile('rsstank_mailtank_request_seconds', 0.99,
+                                    method=method),
+        'api_errors': metrics.get_total('rsstank_mailtank_errors_total', method=method),
+        'feeds_added': metrics.get_total('rsstank_feeds_added_total'),
+        'mailings': mailings_n,
+        'mailings_per_second': mailings_n / seconds if method == 'create_mailing' else None,
+        'items_sent': metrics.get_total('rsstank_feed_items_sent_total'),
+    }
+
+
+def main(args=None):
+    args = parse_args(args)
+    configure_logging(args.verbose)
+    app.config.update(
+        RSSTANK_UPDATE_WORKERS=args.update_workers,
+        RSSTANK_SEND_WORKERS=args.send_workers,
+        RSSTANK_SEND_WORKERS_PER_KEY=args.send_workers_per_key)
+    mailtank = FakeMailtank(
+        tags_per_page=args.tags_per_page, latency=args.latency, errors=args.errors,
+        max_requests_per_key=args.max_requests_per_key)
+
+    with database(args.database) as uri, mailtank.serve() as server:
+        app.config['MAILTANK_API_URL'] = get_server_url(server)
+        # API доступен напрямую, даже если в окружении задан прокси
+        for name in 'no_proxy', 'NO_PROXY':
+            os.environ[name] = '127.0.0.1'
+        print('{0} keys x {1} feeds x {2} items, database: {3}'.format(
+            args.keys, args.feeds, args.items, uri))
+        seed_keys(mailtank, args)
+
+        results = [run_phase('update_feeds', update_feeds.main, mailtank, 'get_tags')]
+        results.append(run_phase('update_feeds (repeat)', update_feeds.main,
+                                 mailtank, 'get_tags'))
+        print('{0} feed items have been added.'.format(seed_items(args.items)))
+        results.append(run_phase('send_feeds', send_feeds.main, mailtank,
+                                 'create_mailing'))
+        results.append(run_phase('send_feeds (repeat)', send_feeds.main, mailtank,
+                                 'create_mailing'))
+
+        print()
+        print(format_table(COLUMNS, results))
+        print('\nAPI responses: {0}.'.format(', '.join(
+            '{0} {1}: {2}'.format(method, status, n)
+            for (method, status), n in sorted(mailtank.responses.items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,10 +6,12 @@ from flask.ext.script import Manager
 from flask.ext.migrate import Migrate, MigrateCommand
 
 import rsstank
-from rsstank.poll_feeds import main as poll_feeds
+from rsstank import metrics
+from rsstank.poll_feeds import main as poll_feeds, ENGINES
 from rsstank.send_feeds import main as send_feeds
 from rsstank.update_feeds import main as update_feeds
 from rsstank.cleanup import main as cleanup
+from rsstank.daemon import main as daemon
 
 
 def sentrify(f):
@@ -30,6 +32,22 @@ def sentrify(f):
     return decorated_function
 
 
+def summarize_metrics(f):
+    """Декоратор, выводящий в лог по завершении функции накопленные
+    за время её работы метрики (см. :mod:`rsstank.metrics`).
+    """
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        metrics.reset()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            rsstank.logger.info(u'Metrics of %s:\n%s', f.__name__,
+                                metrics.format_summary())
+
+    return decorated_function
+
+
 # Присваиваем функциям осмысленные имена (изначально они все
 # называются "main") для того, чтобы Flask-Script знал,
 # как называть команды ./manage.py
@@ -37,13 +55,21 @@ poll_feeds.__name__ = 'poll_feeds'
 send_feeds.__name__ = 'send_feeds'
 update_feeds.__name__ = 'update_feeds'
 cleanup.__name__ = 'cleanup'
+daemon.__name__ = 'daemon'
 
 
 manager = Manager(rsstank.app)
 manager.add_command('db', MigrateCommand)
 
-for command in (poll_feeds, send_feeds, update_feeds, cleanup):
-    manager.command(sentrify(command))
+for command in (send_feeds, update_feeds, cleanup, daemon):
+    manager.command(sentrify(summarize_metrics(command)))
+
+# Опции перечисляем явно: `sentrify` прячет сигнатуру функции,
+# по которой Flask-Script строит их автоматически
+manager.option('-e', '--engine', dest='engine', default='threads',
+               choices=sorted(ENGINES),
+               help='Polling engine (default: threads)')(
+                   sentrify(summarize_metrics(poll_feeds)))
 
 
 if __name__ == '__main__':
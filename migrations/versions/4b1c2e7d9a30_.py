@@ -0,0 +1,23 @@
+"""Add Feed.etag and Feed.last_modified
+
+Revision ID: 4b1c2e7d9a30
+Revises: 3608291e8184
+Create Date: 2026-10-18 10:12:41.204518
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b1c2e7d9a30'
+down_revision = '3608291e8184'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('feed', sa.Column('etag', sa.String(length=255), nullable=True))
+    op.add_column('feed', sa.Column('last_modified', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    op.drop_column('feed', 'last_modified')
+    op.drop_column('feed', 'etag')
@@ -0,0 +1,39 @@
+"""Add FeedItem.guid_hash with a unique index on (feed_id, guid_hash)
+
+Revision ID: 51f3a9c0d6e2
+Revises: 4b1c2e7d9a30
+Create Date: 2026-10-18 12:03:17.550231
+"""
+
+# revision identifiers, used by Alembic.
+revision = '51f3a9c0d6e2'
+down_revision = '4b1c2e7d9a30'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('feed_item', sa.Column('guid_hash', sa.String(length=40), nullable=True))
+    # SHA1() MySQL считает от utf-8 представления строки -- так же,
+    # как и FeedItem.hash_guid
+    op.execute('UPDATE feed_item SET guid_hash = SHA1(guid) WHERE guid IS NOT NULL')
+    # Перед созданием уникального индекса удаляем повторы, оставляя
+    # самый первый из сохранённых элементов. Без индекса по
+    # (feed_id, guid_hash) соединение таблицы с собой перебирало бы
+    # все пары элементов фида, поэтому сначала строим неуникальный
+    op.create_index('ix_feed_item_feed_id_guid_hash_tmp', 'feed_item',
+                    ['feed_id', 'guid_hash'])
+    op.execute('DELETE duplicate FROM feed_item AS duplicate '
+               'JOIN feed_item AS original '
+               'ON duplicate.feed_id = original.feed_id '
+               'AND duplicate.guid_hash = original.guid_hash '
+               'AND duplicate.id > original.id')
+    op.create_index('ix_feed_item_feed_id_guid_hash', 'feed_item',
+                    ['feed_id', 'guid_hash'], unique=True)
+    op.drop_index('ix_feed_item_feed_id_guid_hash_tmp', 'feed_item')
+
+
+def downgrade():
+    op.drop_index('ix_feed_item_feed_id_guid_hash', 'feed_item')
+    op.drop_column('feed_item', 'guid_hash')
@@ -0,0 +1,28 @@
+"""Add robots_txt table to cache robots.txt between poll_feeds runs
+
+Revision ID: 6d2f8e41b7c5
+Revises: 51f3a9c0d6e2
+Create Date: 2026-10-18 14:31:05.218470
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d2f8e41b7c5'
+down_revision = '51f3a9c0d6e2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('robots_txt',
+    sa.Column('host', sa.String(length=255), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=False),
+    sa.Column('content', sa.LargeBinary(), nullable=False),
+    sa.Column('fetched_at', sa.DateTime(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('host')
+    )
+
+
+def downgrade():
+    op.drop_table('robots_txt')
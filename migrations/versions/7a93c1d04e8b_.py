@@ -0,0 +1,23 @@
+"""Add Feed.next_poll_at
+
+Revision ID: 7a93c1d04e8b
+Revises: 6d2f8e41b7c5
+Create Date: 2026-10-18 15:02:44.871236
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a93c1d04e8b'
+down_revision = '6d2f8e41b7c5'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('feed', sa.Column('next_poll_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_feed_next_poll_at', 'feed', ['next_poll_at'])
+
+
+def downgrade():
+    op.drop_index('ix_feed_next_poll_at', 'feed')
+    op.drop_column('feed', 'next_poll_at')
@@ -0,0 +1,26 @@
+"""Add host_lease table to share polling between processes
+
+Revision ID: 8e0b5a27f3d1
+Revises: 7a93c1d04e8b
+Create Date: 2026-10-18 15:47:12.630958
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e0b5a27f3d1'
+down_revision = '7a93c1d04e8b'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('host_lease',
+    sa.Column('host', sa.String(length=255), nullable=False),
+    sa.Column('owner', sa.String(length=255), nullable=True),
+    sa.Column('expires_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('host')
+    )
+
+
+def downgrade():
+    op.drop_table('host_lease')
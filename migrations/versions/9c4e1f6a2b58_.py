@@ -0,0 +1,25 @@
+"""Add composite indexes on feed_item (feed_id, created_at) and (feed_id, pub_date)
+
+Revision ID: 9c4e1f6a2b58
+Revises: 8e0b5a27f3d1
+Create Date: 2026-10-18 16:20:37.104519
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9c4e1f6a2b58'
+down_revision = '8e0b5a27f3d1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_feed_item_feed_id_created_at', 'feed_item',
+                    ['feed_id', 'created_at'])
+    op.create_index('ix_feed_item_feed_id_pub_date', 'feed_item',
+                    ['feed_id', 'pub_date'])
+
+
+def downgrade():
+    op.drop_index('ix_feed_item_feed_id_pub_date', 'feed_item')
+    op.drop_index('ix_feed_item_feed_id_created_at', 'feed_item')
@@ -0,0 +1,23 @@
+"""Add AccessKey.tags_fingerprint and AccessKey.tags_synced_at
+
+Revision ID: a1d7c3e95f20
+Revises: 9c4e1f6a2b58
+Create Date: 2026-10-18 17:05:12.538804
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a1d7c3e95f20'
+down_revision = '9c4e1f6a2b58'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('access_key', sa.Column('tags_fingerprint', sa.String(length=40), nullable=True))
+    op.add_column('access_key', sa.Column('tags_synced_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('access_key', 'tags_synced_at')
+    op.drop_column('access_key', 'tags_fingerprint')
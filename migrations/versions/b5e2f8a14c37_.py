@@ -0,0 +1,21 @@
+"""Add Feed.content_digest
+
+Revision ID: b5e2f8a14c37
+Revises: a1d7c3e95f20
+Create Date: 2026-10-18 17:48:26.093417
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b5e2f8a14c37'
+down_revision = 'a1d7c3e95f20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('feed', sa.Column('content_digest', sa.String(length=40), nullable=True))
+
+
+def downgrade():
+    op.drop_column('feed', 'content_digest')
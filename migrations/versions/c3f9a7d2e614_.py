@@ -0,0 +1,22 @@
+"""Add Feed.poll_errors_n
+
+Revision ID: c3f9a7d2e614
+Revises: b5e2f8a14c37
+Create Date: 2026-10-18 21:14:52.306118
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3f9a7d2e614'
+down_revision = 'b5e2f8a14c37'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('feed', sa.Column('poll_errors_n', sa.Integer(), nullable=False,
+                                    server_default='0'))
+
+
+def downgrade():
+    op.drop_column('feed', 'poll_errors_n')
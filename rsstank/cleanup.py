@@ -1,6 +1,9 @@
 # coding: utf-8
+import time
 import logging
+import datetime as dt
 
+from . import app, metrics
 from .models import db, Feed, FeedItem
 
 
@@ -9,21 +12,219 @@ logger = logging.getLogger(__name__)
 
 def delete_sent_feed_items(feed):
     """Удаляет все элементы из фида `feed`, которые были созданы до даты
-    последнего отправления фида
+    последнего отправления фида. Возвращает число удалённых элементов.
+
+    Элементы удаляются пачками по `RSSTANK_CLEANUP_BATCH_SIZE` штук, каждая
+    в своей транзакции, с паузой в `RSSTANK_CLEANUP_SLEEP` секунд между
+    ними, чтобы не держать подолгу блокировки таблицы элементов.
     """
-    if feed.last_sent_at:
-        items_to_delete = feed.items.filter(
-            FeedItem.created_at < feed.last_sent_at).all()
-        logger.info('{0} outdated feed items found for feed #{1} with tag {2}'
-                    .format(len(items_to_delete), feed.id, feed.tag))
-        for item in items_to_delete:
-            db.session.delete(item)
+    if not feed.last_sent_at:
+        return 0
+    table = FeedItem.__table__
+    condition = db.and_(table.c.feed_id == feed.id,
+                        table.c.created_at < feed.last_sent_at)
+    if feed.last_pub_date:
+        # Элементы, опубликованные одновременно с последним элементом
+        # фида, оставляем: следующий опрос фида не отбросит их по дате
+        # публикации, и повторы среди них отсеет только уникальный индекс
+        condition = db.and_(condition, db.or_(
+            table.c.pub_date == None,
+            table.c.pub_date < feed.last_pub_date))
+    feed_repr = repr(feed)
+
+    batch_size = app.config['RSSTANK_CLEANUP_BATCH_SIZE']
+    deleted_n = 0
+    while True:
+        # MySQL не умеет LIMIT в подзапросе DELETE ... WHERE id IN (...),
+        # поэтому выбираем идентификаторы отдельным запросом
+        ids = [item_id for item_id, in db.session.execute(
+            db.select([table.c.id]).where(condition)
+            .order_by(table.c.id).limit(batch_size))]
+        if ids:
+            db.session.execute(table.delete().where(table.c.id.in_(ids)))
+            deleted_n += len(ids)
         db.session.commit()
+        if len(ids) < batch_size:
+            break
+        time.sleep(app.config['RSSTANK_CLEANUP_SLEEP'])
+
+    metrics.inc('rsstank_feed_items_deleted_total', deleted_n)
+    logger.info('%i outdated feed items have been deleted from %s.',
+                deleted_n, feed_repr)
+    return deleted_n
+
+
+# Секционирование feed_item
+# =========================
+# Если включен `RSSTANK_FEED_ITEM_PARTITIONING`, таблица feed_item разбита
+# на секции по дням `created_at` (только MySQL), и cleanup вместо удаления
+# элементов по одному удаляет секции целиком. Секция `pYYYYMMDD` содержит
+# элементы, созданные в этот день, секция `pmax` -- всё остальное.
+#
+# MySQL требует, чтобы все уникальные ключи секционированной таблицы
+# включали колонку секционирования, и не поддерживает для неё внешние
+# ключи. Поэтому ключ feed_id больше не проверяется, а уникальный индекс
+# (feed_id, guid_hash) дополняется created_at и отсеивает повторы только
+# в пределах одного опроса. Уже сохранённые элементы poll_feeds
+# отбрасывает сам, проверяя перед записью, нет ли их в БД (см.
+# :meth:`rsstank.poll_feeds.FeedItemWriter._drop_saved_rows`).
+#
+# Секция удаляется вместе с элементами, опубликованными одновременно
+# с последним элементом фида, которые :func:`delete_sent_feed_items`
+# оставляет. Поэтому при секционировании poll_feeds пропускает элементы,
+# опубликованные не позже `Feed.last_pub_date`, а не только раньше (см.
+# :func:`rsstank.poll_feeds.save_fetch_result`).
+
+def get_partition_name(day):
+    """Возвращает имя секции feed_item для элементов, созданных в день `day`."""
+    return day.strftime('p%Y%m%d')
+
+
+def get_feed_item_partitions():
+    """Возвращает список пар (имя секции, верхняя граница `created_at`
+    элементов в ней) таблицы feed_item, упорядоченный по границе. Для
+    `pmax` граница -- None. Если таблица не секционирована, список пуст.
+    """
+    rows = db.session.execute(
+        "SELECT partition_name, partition_description "
+        "FROM information_schema.partitions "
+        "WHERE table_schema = DATABASE() AND table_name = 'feed_item' "
+        "AND partition_name IS NOT NULL "
+        "ORDER BY partition_ordinal_position")
+    partitions = []
+    for name, description in rows:
+        upper_bound = None
+        if description != 'MAXVALUE':
+            upper_bound = dt.datetime.strptime(description.strip("'"),
+                                               '%Y-%m-%d %H:%M:%S')
+        partitions.append((name, upper_bound))
+    return partitions
+
+
+def get_partition_definition(day):
+    """Возвращает определение секции feed_item для дня `day`."""
+    upper_bound = dt.datetime.combine(day + dt.timedelta(days=1), dt.time())
+    return "PARTITION {0} VALUES LESS THAN ('{1:%Y-%m-%d %H:%M:%S}')".format(
+        get_partition_name(day), upper_bound)
+
+
+def partition_feed_item(utc_now=None):
+    """Разбивает таблицу feed_item на дневные секции, начиная со дня
+    создания самого старого элемента и заканчивая
+    `RSSTANK_FEED_ITEM_PARTITIONS_AHEAD` днями после сегодняшнего.
+    Перестраивает таблицу целиком, так что на большой таблице это долго.
+    """
+    if not utc_now:
+        utc_now = dt.datetime.utcnow()
+    oldest_created_at = db.session.query(db.func.min(FeedItem.created_at)).scalar()
+    first_day = (oldest_created_at or utc_now).date()
+    last_day = utc_now.date() + dt.timedelta(
+        days=app.config['RSSTANK_FEED_ITEM_PARTITIONS_AHEAD'])
+    days = [first_day + dt.timedelta(days=i)
+            for i in range((last_day - first_day).days + 1)]
+
+    foreign_keys = db.session.execute(
+        "SELECT constraint_name FROM information_schema.table_constraints "
+        "WHERE table_schema = DATABASE() AND table_name = 'feed_item' "
+        "AND constraint_type = 'FOREIGN KEY'")
+    for name, in foreign_keys:
+        db.session.execute('ALTER TABLE feed_item DROP FOREIGN KEY {0}'.format(name))
+    db.session.execute(
+        'ALTER TABLE feed_item DROP PRIMARY KEY, ADD PRIMARY KEY (id, created_at), '
+        'DROP INDEX ix_feed_item_feed_id_guid_hash, '
+        'ADD UNIQUE INDEX ix_feed_item_feed_id_guid_hash (feed_id, guid_hash, created_at)')
+    definitions = [get_partition_definition(day) for day in days]
+    definitions.append('PARTITION pmax VALUES LESS THAN (MAXVALUE)')
+    db.session.execute(
+        'ALTER TABLE feed_item PARTITION BY RANGE COLUMNS(created_at) ({0})'
+        .format(', '.join(definitions)))
+    db.session.commit()
+    logger.info('feed_item has been partitioned into %i partitions.', len(days) + 1)
+
+
+def add_feed_item_partitions(partitions, utc_now=None):
+    """Заводит секции feed_item на `RSSTANK_FEED_ITEM_PARTITIONS_AHEAD`
+    дней вперёд, отщепляя их от пустой `pmax`.
+
+    :param partitions: см. :func:`get_feed_item_partitions`
+    """
+    if not utc_now:
+        utc_now = dt.datetime.utcnow()
+    existing_names = set(name for name, _ in partitions)
+    last_upper_bound = max(upper_bound for _, upper_bound in partitions
+                           if upper_bound is not None)
+    ahead = app.config['RSSTANK_FEED_ITEM_PARTITIONS_AHEAD']
+    days = [utc_now.date() + dt.timedelta(days=i) for i in range(ahead + 1)]
+    days = [day for day in days if get_partition_name(day) not in existing_names and
+            dt.datetime.combine(day, dt.time()) >= last_upper_bound]
+    if not days:
+        return
+    definitions = [get_partition_definition(day) for day in days]
+    definitions.append('PARTITION pmax VALUES LESS THAN (MAXVALUE)')
+    db.session.execute(
+        'ALTER TABLE feed_item REORGANIZE PARTITION pmax INTO ({0})'
+        .format(', '.join(definitions)))
+    db.session.commit()
+    logger.info('%i feed_item partitions have been added.', len(days))
+
+
+def has_unsent_feed_items(lower_bound, upper_bound):
+    """Возвращает True, если среди элементов, созданных в промежутке
+    [`lower_bound`, `upper_bound`), есть ещё не разосланные.
+    """
+    query = db.session.query(FeedItem.id).join(Feed) \
+        .filter(FeedItem.created_at < upper_bound) \
+        .filter(db.or_(Feed.last_sent_at == None,
+                       FeedItem.created_at >= Feed.last_sent_at))
+    if lower_bound is not None:
+        query = query.filter(FeedItem.created_at >= lower_bound)
+    return query.first() is not None
+
+
+def drop_sent_feed_item_partitions(partitions, utc_now=None):
+    """Удаляет прошедшие секции feed_item, все элементы которых разосланы
+    или которые старше `RSSTANK_FEED_ITEM_MAX_AGE` дней. Возвращает число
+    удалённых секций.
+
+    :param partitions: см. :func:`get_feed_item_partitions`
+    """
+    if not utc_now:
+        utc_now = dt.datetime.utcnow()
+    max_age_bound = utc_now - dt.timedelta(days=app.config['RSSTANK_FEED_ITEM_MAX_AGE'])
+    dropped_n = 0
+    lower_bound = None
+    for name, upper_bound in partitions:
+        if upper_bound is None or upper_bound > utc_now:
+            break
+        if upper_bound <= max_age_bound or \
+                not has_unsent_feed_items(lower_bound, upper_bound):
+            db.session.execute('ALTER TABLE feed_item DROP PARTITION {0}'.format(name))
+            db.session.commit()
+            dropped_n += 1
+            metrics.inc('rsstank_feed_item_partitions_dropped_total')
+            logger.info('Partition %s of feed_item has been dropped.', name)
+        lower_bound = upper_bound
+    return dropped_n
+
+
+def rotate_feed_item_partitions(utc_now=None):
+    """Секционирует feed_item, если она ещё не секционирована, заводит
+    секции на ближайшие дни и удаляет разосланные.
+    """
+    partitions = get_feed_item_partitions()
+    if not partitions:
+        partition_feed_item(utc_now=utc_now)
+        partitions = get_feed_item_partitions()
+    add_feed_item_partitions(partitions, utc_now=utc_now)
+    drop_sent_feed_item_partitions(get_feed_item_partitions(), utc_now=utc_now)
 
 
 def main():
     """Удаляет отправленные элементы всех фидов"""
     logger.info('cleanup has started.')
-    for feed in Feed.query.all():
-        delete_sent_feed_items(feed)
+    if app.config['RSSTANK_FEED_ITEM_PARTITIONING']:
+        rotate_feed_item_partitions()
+    else:
+        for feed in Feed.query.all():
+            delete_sent_feed_items(feed)
     logger.info('cleanup has finished.')
@@ -9,15 +9,121 @@ class DefaultConfig(object):
     SENTRY_DSN = None
     SQLALCHEMY_DATABASE_URI = None
     MAILTANK_API_URL = 'http://api.mailtank.ru'
+    #: Сколько раз повторять идемпотентные запросы к Mailtank API
+    #: при ошибке сети или ответе 5xx и пауза (в секундах) перед первым
+    #: повтором. Каждая следующая пауза вдвое длиннее предыдущей
+    MAILTANK_RETRIES = 2
+    MAILTANK_RETRY_BACKOFF = 1
+    #: Таймауты (в секундах) на установку соединения с Mailtank API
+    #: и на чтение его ответа
+    MAILTANK_CONNECT_TIMEOUT = 10
+    MAILTANK_READ_TIMEOUT = 60
+    #: Сколько keep-alive соединений с Mailtank API держит процесс.
+    #: Должно быть не меньше числа потоков, обращающихся к API
+    #: (`RSSTANK_SEND_WORKERS`, `RSSTANK_UPDATE_WORKERS`)
+    MAILTANK_POOL_MAXSIZE = 10
+    #: Сколько клиентов Mailtank API (по одному на ключ) процесс держит
+    #: в кеше. Дольше всех не использовавшиеся клиенты вытесняются
+    MAILTANK_CLIENTS_CACHE_SIZE = 1000
     RSSTANK_LOGLEVEL = 'INFO'
     RSSTANK_AGENT = 'rsstank/0.1'
     #: Crawl-delay, который будет использоваться в случае, если
     #: хост не задал свои правила в robots.txt
     RSSTANK_DEFAULT_CRAWL_DELAY = 1
+    #: Время (в секундах), в течение которого закешированный robots.txt
+    #: считается актуальным, если хост не указал его в Cache-Control или
+    #: Expires, и минимальное такое время
+    RSSTANK_ROBOTS_TXT_TTL = 60 * 60 * 24
+    RSSTANK_ROBOTS_TXT_MIN_TTL = 60 * 60
+    #: Число потоков, скачивающих устаревшие robots.txt
+    #: (./manage.py poll_feeds --engine=threads)
+    RSSTANK_ROBOTS_TXT_WORKERS = 20
+    #: Таймауты (в секундах) на установку соединения и на чтение ответа
+    #: при запросах к хостам фидов
+    RSSTANK_CONNECT_TIMEOUT = 10
+    RSSTANK_READ_TIMEOUT = 30
+    #: Сколько keep-alive соединений держит HTTP-сессия одного хоста.
+    #: Фиды хоста опрашиваются последовательно, так что одного достаточно
+    RSSTANK_HTTP_POOL_MAXSIZE = 1
+    #: Интервал (в секундах) между опросами фида, пока частота его
+    #: обновлений неизвестна, и пределы, в которых этот интервал
+    #: подстраивается под неё. Интервал также не превышает интервала
+    #: рассылки фида
+    RSSTANK_DEFAULT_POLL_INTERVAL = 60 * 60 * 3
+    RSSTANK_MIN_POLL_INTERVAL = 60 * 15
+    RSSTANK_MAX_POLL_INTERVAL = 60 * 60 * 24
+    #: На сколько секунд процесс poll_feeds арендует хосты, фиды которых
+    #: он опрашивает. Пока хосты опрашиваются, аренда продлевается
+    #: каждую треть этого времени, так что истекает она, только если
+    #: процесс завис или умер
+    RSSTANK_HOST_LEASE_TIME = 60 * 10
+    #: Сколько хостов процесс poll_feeds арендует и опрашивает за раз.
+    #: Остальные хосты тем временем достаются другим процессам
+    RSSTANK_HOST_LEASE_BATCH_SIZE = 500
+    #: Число потоков, между которыми делятся хосты при опросе фидов
+    #: (./manage.py poll_feeds --engine=threads)
+    RSSTANK_POLL_WORKERS = 20
+    #: Максимальное число одновременных запросов к хостам и число
+    #: одновременно опрашиваемых хостов при ./manage.py poll_feeds --engine=async
+    RSSTANK_ASYNC_POLL_WORKERS = 100
+    RSSTANK_ASYNC_POLL_MAX_ACTIVE_HOSTS = 500
+    #: Максимальный размер фида в байтах. Фиды больше не опрашиваются
+    RSSTANK_MAX_FEED_SIZE = 10 * 1024 * 1024
+    #: Фиды не больше скольких байт, сервер которых не присылает ни ETag,
+    #: ни Last-Modified, скачиваются целиком, чтобы по хешу тела узнать,
+    #: изменились ли они. Фиды больше разбираются потоково
+    RSSTANK_CONTENT_DIGEST_MAX_SIZE = 1024 * 1024
+    #: Сколько уже сохранённых элементов должно встретиться в фиде подряд,
+    #: чтобы дальше его не скачивать и не разбирать
+    RSSTANK_OLD_ITEMS_TO_STOP_PARSING = 5
+    #: Сколько новых элементов фидов (или обновлений самих фидов)
+    #: накапливать перед записью в БД. Это же число строк в одном INSERT-е
+    RSSTANK_INSERT_CHUNK_SIZE = 100
+    #: Интервалы (в секундах) между запусками задач ./manage.py daemon.
+    #: Задачи, которых здесь нет, демон не запускает
+    RSSTANK_DAEMON_INTERVALS = {
+        'poll_feeds': 60 * 15,
+        'send_feeds': 60 * 60,
+        'update_feeds': 60 * 60,
+        'cleanup': 60 * 60 * 24,
+    }
+    #: Способ опроса фидов в ./manage.py daemon (см. poll_feeds --engine)
+    RSSTANK_DAEMON_POLL_ENGINE = 'threads'
+    #: Адрес и порт, на которых ./manage.py daemon отдаёт метрики по
+    #: /metrics. Если порт не задан, метрики демона не отдаются. Метрики
+    #: отдаются без авторизации, поэтому по умолчанию -- только локально
+    RSSTANK_DAEMON_METRICS_HOST = '127.0.0.1'
+    RSSTANK_DAEMON_METRICS_PORT = None
+    #: Сколько элементов фида удалять одним запросом при чистке
+    #: и пауза (в секундах) между такими запросами
+    RSSTANK_CLEANUP_BATCH_SIZE = 1000
+    RSSTANK_CLEANUP_SLEEP = 0.1
+    #: Хранить ли элементы фидов в секционированной по дням таблице
+    #: (только MySQL). Тогда cleanup удаляет секции, все элементы
+    #: которых разосланы или которые старше RSSTANK_FEED_ITEM_MAX_AGE
+    #: дней, и заводит секции на RSSTANK_FEED_ITEM_PARTITIONS_AHEAD дней
+    #: вперёд. Первый запуск cleanup после включения перестраивает таблицу
+    RSSTANK_FEED_ITEM_PARTITIONING = False
+    RSSTANK_FEED_ITEM_PARTITIONS_AHEAD = 3
+    RSSTANK_FEED_ITEM_MAX_AGE = 30
     #: UTC-время суток, в которое стоит осуществлять рассылку
     #: свежедобавленных фидов (дефолтное значение это 02:00-04:00,
     #: то есть от 8 до 10 утра по Екатеринбургу).
     RSSTANK_DEFAULT_FIRST_SEND_INTERVAL = (dt.time(hour=2), dt.time(hour=4))
+    #: Максимальное число элементов фида в одной рассылке. Если новых
+    #: элементов больше, в рассылку попадут самые свежие
+    RSSTANK_MAX_ITEMS_PER_MAILING = 100
+    #: Сколько рассылок создавать одновременно, всего и по одному ключу
+    RSSTANK_SEND_WORKERS = 10
+    RSSTANK_SEND_WORKERS_PER_KEY = 2
+    #: Сколько ключей опрашивать одновременно при обновлении фидов,
+    #: сколько секунд ждать тегов одного ключа и тегов всех ключей
+    RSSTANK_UPDATE_WORKERS = 10
+    RSSTANK_UPDATE_KEY_TIMEOUT = 300
+    RSSTANK_UPDATE_TIMEOUT = 60 * 30
+    #: Не чаще чем раз в сколько секунд синхронизировать фиды ключа,
+    #: теги которого не менялись с прошлой синхронизации
+    RSSTANK_FULL_SYNC_INTERVAL = 24 * 60 * 60
 
 
 class DevelopmentConfig(DefaultConfig):
@@ -30,4 +136,5 @@ class TestingConfig(DefaultConfig):
     SECRET_KEY = 'testing'
     SERVER_NAME = 'rsstank.local'
     MAILTANK_API_URL = 'http://api.mailtank.local'
+    MAILTANK_RETRY_BACKOFF = 0
     RSSTANK_LOGLEVEL = 'WARNING'
@@ -0,0 +1,132 @@
+# coding: utf-8
+import time
+import heapq
+import signal
+import logging
+import threading
+import functools
+import concurrent.futures
+
+from werkzeug.serving import make_server
+
+from . import app, metrics, poll_feeds, send_feeds, update_feeds, cleanup
+from .models import db
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_jobs():
+    """Возвращает словарь из названий задач в пары (функция, интервал
+    между запусками в секундах). Интервалы задаются `RSSTANK_DAEMON_INTERVALS`.
+
+    :raises: ValueError, если `RSSTANK_DAEMON_INTERVALS` не задаёт ни одной
+             задачи, называет неизвестную задачу или интервал не положителен
+    """
+    functions = {
+        'poll_feeds': functools.partial(
+            poll_feeds.main, engine=app.config['RSSTANK_DAEMON_POLL_ENGINE']),
+        'send_feeds': send_feeds.main,
+        'update_feeds': update_feeds.main,
+        'cleanup': cleanup.main,
+    }
+    intervals = app.config['RSSTANK_DAEMON_INTERVALS'] or {}
+    if not intervals:
+        raise ValueError('RSSTANK_DAEMON_INTERVALS is empty, daemon has no jobs '
+                         'to run. Available jobs: {0}.'.format(', '.join(sorted(functions))))
+    for name, interval in intervals.iteritems():
+        if name not in functions:
+            raise ValueError('Unknown job in RSSTANK_DAEMON_INTERVALS: {0!r}. '
+                             'Available jobs: {1}.'.format(name, ', '.join(sorted(functions))))
+        if not interval > 0:
+            raise ValueError('Interval of job {0} in RSSTANK_DAEMON_INTERVALS must be '
+                             'positive, got {1!r}.'.format(name, interval))
+    return dict((name, (functions[name], interval))
+                for name, interval in intervals.iteritems())
+
+
+def run_job(name, function):
+    """Выполняет задачу `name` и возвращает соединение потока с БД в пул."""
+    try:
+        with metrics.timer('rsstank_job_seconds', job=name):
+            function()
+    except:
+        metrics.inc('rsstank_job_errors_total', job=name)
+        logger.error('Job %s has failed.', name, exc_info=True)
+    else:
+        metrics.set_gauge('rsstank_job_last_success_timestamp', time.time(), job=name)
+    finally:
+        db.session.remove()
+
+
+def run(jobs, stop):
+    """Запускает задачи `jobs` (см. :func:`get_jobs`) по расписанию,
+    пока не будет установлено событие `stop`, и дожидается завершения
+    выполняющихся.
+
+    Каждая задача выполняется в своём потоке. Если к очередному сроку
+    предыдущий запуск задачи ещё не закончился, срок пропускается:
+    одна и та же задача никогда не выполняется дважды одновременно.
+
+    :type stop: :class:`threading.Event`
+    """
+    # Очередь таймеров: пары (время очередного запуска, название задачи)
+    timers = [(time.time(), name) for name in sorted(jobs)]
+    heapq.heapify(timers)
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        while not stop.is_set():
+            now = time.time()
+            while timers[0][0] <= now:
+                due_at, name = heapq.heappop(timers)
+                function, interval = jobs[name]
+                if name in running and not running[name].done():
+                    logger.warn('Job %s is still running, skipping its run.', name)
+                else:
+                    logger.info('Starting job %s.', name)
+                    running[name] = executor.submit(run_job, name, function)
+                # Следующий запуск -- через `interval` после запланированного,
+                # а пропущенные сроки не наверстываем
+                next_at = due_at + interval
+                while next_at <= now:
+                    next_at += interval
+                heapq.heappush(timers, (next_at, name))
+            stop.wait(timers[0][0] - time.time())
+
+        logger.info('Waiting for running jobs to finish.')
+
+
+def main():
+    """Запускает poll_feeds, send_feeds, update_feeds и cleanup по
+    расписанию в одном процессе, пока тот не получит SIGTERM или SIGINT.
+    """
+    # Ошибки в настройках должны остановить демон до того, как он запустится
+    jobs = get_jobs()
+    logger.info('daemon has started.')
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        logger.info('Got signal %i, stopping.', signum)
+        stop.set()
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    # Задачи выполняются в этом процессе, поэтому и их метрики можно
+    # получить только у него. Отдаются только метрики, не админка
+    metrics_server = None
+    if app.config['RSSTANK_DAEMON_METRICS_PORT']:
+        metrics_server = make_server(app.config['RSSTANK_DAEMON_METRICS_HOST'],
+                                     app.config['RSSTANK_DAEMON_METRICS_PORT'],
+                                     metrics.wsgi_app)
+        metrics_thread = threading.Thread(target=metrics_server.serve_forever)
+        metrics_thread.daemon = True
+        metrics_thread.start()
+        logger.info('Serving metrics on %s:%i.', *metrics_server.server_address)
+
+    try:
+        run(jobs, stop)
+    finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
+    logger.info('daemon has finished.')
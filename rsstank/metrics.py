@@ -0,0 +1,222 @@
+# coding: utf-8
+"""Метрики процесса: счётчики, значения и гистограммы длительностей.
+
+Метрики копятся в памяти процесса и отдаются в текстовом формате
+Prometheus (:func:`render_prometheus`, WSGI-приложение :func:`wsgi_app`,
+которое запускает ./manage.py daemon) и кратким отчётом в конце каждой
+команды ./manage.py (:func:`format_summary`).
+
+Метрика задаётся именем и метками (именованными аргументами функций);
+каждое сочетание значений меток -- отдельный ряд. Все функции
+потокобезопасны.
+"""
+import time
+import bisect
+import threading
+import contextlib
+
+
+#: Верхние границы корзин гистограмм длительностей в секундах
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+# {(имя, ((метка, значение), ...)): значение}
+_counters = {}
+_gauges = {}
+# {(имя, ((метка, значение), ...)): [число наблюдений в каждой корзине
+#                                     и сверх последней, сумма]}
+_histograms = {}
+
+
+def _get_key(name, labels):
+    return name, tuple(sorted(labels.iteritems()))
+
+
+def inc(name, value=1, **labels):
+    """Увеличивает счётчик `name` на `value`."""
+    key = _get_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Устанавливает значение `name` равным `value`."""
+    key = _get_key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def observe(name, seconds, **labels):
+    """Добавляет в гистограмму `name` наблюдение длительностью `seconds`."""
+    key = _get_key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(BUCKETS) + 1), 0]
+        histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    """Контекстный менеджер, добавляющий длительность своего блока
+    в гистограмму `name` (в том числе, если блок бросил исключение).
+    """
+    started_at = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - started_at, **labels)
+
+
+def get_total(name, **labels):
+    """Возвращает сумму счётчика `name` по всем значениям меток,
+    кроме заданных в `labels`.
+    """
+    labels = set(labels.iteritems())
+    with _lock:
+        return sum(value for (metric_name, series_labels), value in _counters.iteritems()
+                   if metric_name == name and labels.issubset(series_labels))
+
+
+def _get_buckets(name, labels):
+    labels = set(labels.iteritems())
+    buckets = [0] * (len(BUCKETS) + 1)
+    total = 0
+    for (metric_name, series_labels), (counts, seconds) in _histograms.iteritems():
+        if metric_name == name and labels.issubset(series_labels):
+            buckets = [a + b for a, b in zip(buckets, counts)]
+            total += seconds
+    return buckets, total
+
+
+def get_histogram(name, **labels):
+    """Возвращает число наблюдений и их сумму в гистограмме `name` по всем
+    значениям меток, кроме заданных в `labels`.
+    """
+    with _lock:
+        buckets, total = _get_buckets(name, labels)
+    return sum(buckets), total
+
+
+def quantile(name, q, **labels):
+    """Оценивает `q`-квантиль (0 < `q` < 1) гистограммы `name` по всем
+    значениям меток, кроме заданных в `labels`, интерполируя внутри
+    корзины, как histogram_quantile в Prometheus. Наблюдения больше
+    последней границы корзин считаются равными ей. Возвращает None,
+    если наблюдений нет.
+    """
+    with _lock:
+        buckets, _ = _get_buckets(name, labels)
+    rank = q * sum(buckets)
+    cumulative = 0
+    for i, count in enumerate(buckets):
+        if count and cumulative + count >= rank:
+            if i == len(BUCKETS):
+                return BUCKETS[-1]
+            lower_bound = BUCKETS[i - 1] if i else 0
+            return lower_bound + (BUCKETS[i] - lower_bound) * (rank - cumulative) / count
+        cumulative += count
+    return None
+
+
+def reset():
+    """Забывает все накопленные метрики."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        u'{0}="{1}"'.format(
+            label, unicode(value).replace('\\', r'\\').replace('"', r'\"')
+                                 .replace('\n', r'\n'))
+        for label, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _group_by_names(series):
+    rv = {}
+    for (name, labels), value in series.iteritems():
+        rv.setdefault(name, []).append((labels, value))
+    return sorted((name, sorted(values)) for name, values in rv.iteritems())
+
+
+def render_prometheus():
+    """Возвращает все метрики в текстовом формате Prometheus 0.0.4."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = dict((key, (list(buckets), total))
+                          for key, (buckets, total) in _histograms.iteritems())
+
+    lines = []
+    for metrics, metric_type in ((counters, 'counter'), (gauges, 'gauge')):
+        for name, values in _group_by_names(metrics):
+            lines.append(u'# TYPE {0} {1}'.format(name, metric_type))
+            for labels, value in values:
+                lines.append(u'{0}{1} {2}'.format(
+                    name, _format_labels(labels), _format_value(value)))
+
+    for name, values in _group_by_names(histograms):
+        lines.append(u'# TYPE {0} histogram'.format(name))
+        for labels, (buckets, total) in values:
+            count = 0
+            for upper_bound, bucket_count in zip(BUCKETS + ('+Inf',), buckets):
+                count += bucket_count
+                lines.append(u'{0}_bucket{1} {2}'.format(
+                    name, _format_labels(labels, [('le', upper_bound)]), count))
+            lines.append(u'{0}_sum{1} {2!r}'.format(
+                name, _format_labels(labels), float(total)))
+            lines.append(u'{0}_count{1} {2}'.format(
+                name, _format_labels(labels), count))
+    return u'\n'.join(lines) + u'\n'
+
+
+def wsgi_app(environ, start_response):
+    """WSGI-приложение, отдающее по `GET /metrics` все метрики в текстовом
+    формате Prometheus (см. :func:`render_prometheus`) и 404 по любому
+    другому адресу.
+    """
+    if environ.get('PATH_INFO') != '/metrics' or \
+            environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not found']
+    body = render_prometheus().encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def format_summary():
+    """Возвращает краткий отчёт о накопленных метриках: итоги счётчиков
+    и гистограмм по всем значениям меток, по строке на метрику.
+    """
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = dict((key, (sum(buckets), total))
+                          for key, (buckets, total) in _histograms.iteritems())
+
+    lines = []
+    for name, values in _group_by_names(counters):
+        lines.append(u'{0}: {1}'.format(
+            name, _format_value(sum(value for _, value in values))))
+    for name, values in _group_by_names(gauges):
+        for labels, value in values:
+            lines.append(u'{0}{1}: {2}'.format(
+                name, _format_labels(labels), _format_value(value)))
+    for name, values in _group_by_names(histograms):
+        count = sum(count for _, (count, _) in values)
+        total = sum(total for _, (_, total) in values)
+        lines.append(u'{0}: {1} in {2:.3f}s (avg {3:.3f}s)'.format(
+            name, count, total, total / count if count else 0))
+    return u'\n'.join(lines)
@@ -1,18 +1,211 @@
 # coding: utf-8
+import json
+import time
+import hashlib
+import threading
+import collections
 import datetime as dt
 
 import pytz
 import dateutil
+import requests
+import requests.adapters
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 
-from mailtank import Mailtank
-from . import db, app
+from mailtank import Mailtank, MailtankError
+from . import db, app, metrics
 
 
 default_interval_start, default_interval_stop = \
     app.config['RSSTANK_DEFAULT_FIRST_SEND_INTERVAL']
 
 
+class seconds_between(FunctionElement):
+    """SQL-выражение, равное числу целых секунд между датами `start`
+    и `end` (аргументы конструктора).
+    """
+    type = db.Integer()
+    name = 'seconds_between'
+
+
+@compiles(seconds_between)
+def compile_seconds_between(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return 'TIMESTAMPDIFF(SECOND, {0}, {1})'.format(
+        compiler.process(start), compiler.process(end))
+
+
+@compiles(seconds_between, 'sqlite')
+def compile_seconds_between_sqlite(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return "(strftime('%s', {1}) - strftime('%s', {0}))".format(
+        compiler.process(start), compiler.process(end))
+
+
+class MailtankAPIError(MailtankError):
+    """Ошибка, которой Mailtank API ответил на запрос :class:`MailtankClient`.
+
+    :param code: статус ответа
+    :param message: тело ответа
+    """
+
+    def __init__(self, code, message):
+        Exception.__init__(self, code, message)
+        self.code = code
+        self.message = message
+
+
+class MailtankResource(object):
+    """Объект Mailtank API, поля которого доступны как атрибуты."""
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+    def __repr__(self):
+        return '<MailtankResource {0!r}>'.format(self.__dict__)
+
+
+class MailtankClient(Mailtank):
+    """Клиент Mailtank API, выполняющий все запросы через сессию `session`
+    (:class:`requests.Session`) с таймаутами `MAILTANK_CONNECT_TIMEOUT`
+    и `MAILTANK_READ_TIMEOUT`.
+
+    Реализует только те методы :class:`mailtank.Mailtank`, которыми
+    пользуется rsstank.
+    """
+
+    def __init__(self, api_url, api_key, session):
+        Mailtank.__init__(self, api_url, api_key)
+        self.api_url = api_url.rstrip('/')
+        self.api_key = api_key
+        self.session = session
+
+    def request(self, method, path, **kwargs):
+        """Выполняет запрос к API и возвращает разобранный JSON ответа.
+
+        :raises: :class:`MailtankAPIError`, если API ответил ошибкой
+        """
+        headers = {'X-Auth-Token': self.api_key}
+        if 'data' in kwargs:
+            headers['Content-Type'] = 'application/json'
+        response = self.session.request(
+            method, self.api_url + path, headers=headers,
+            timeout=(app.config['MAILTANK_CONNECT_TIMEOUT'],
+                     app.config['MAILTANK_READ_TIMEOUT']),
+            **kwargs)
+        if not 200 <= response.status_code < 300:
+            raise MailtankAPIError(response.status_code, response.text)
+        return response.json() if response.content else None
+
+    def get_tags(self, mask=None):
+        """Возвращает список всех тегов проекта, начинающихся с `mask`."""
+        tags = []
+        page = 1
+        while True:
+            params = {'page': page}
+            if mask is not None:
+                params['mask'] = mask
+            data = self.request('GET', '/tags/', params=params)
+            tags.extend(MailtankResource(tag) for tag in data['objects'])
+            if data['page'] >= data['pages_total']:
+                return tags
+            page += 1
+
+    def get_project(self):
+        return MailtankResource(self.request('GET', '/project'))
+
+    def create_layout(self, **fields):
+        return MailtankResource(self.request('POST', '/layouts/', data=json.dumps(fields)))
+
+    def create_mailing(self, layout_id, context, target, attachments=None):
+        mailing = {'layout_id': layout_id, 'context': context, 'target': target}
+        if attachments is not None:
+            mailing['attachments'] = attachments
+        return MailtankResource(self.request('POST', '/mailings/', data=json.dumps(mailing)))
+
+
+def create_mailtank_session():
+    """Возвращает :class:`requests.Session` для запросов к Mailtank API.
+
+    Сессия держит до `MAILTANK_POOL_MAXSIZE` keep-alive соединений
+    с API и повторяет до `MAILTANK_RETRIES` раз запросы, которым
+    не удалось установить соединение (такие повторы безопасны и для
+    неидемпотентных запросов: до API они не дошли).
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=app.config['MAILTANK_POOL_MAXSIZE'],
+        max_retries=app.config['MAILTANK_RETRIES'])
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_mailtank_sessions = {}
+# Клиенты в порядке от дольше всех не использовавшегося к последнему
+_mailtank_clients = collections.OrderedDict()
+_mailtank_clients_lock = threading.Lock()
+
+
+def get_mailtank(key_content):
+    """Возвращает клиент Mailtank API для ключа `key_content`.
+
+    Клиент создаётся однажды на процесс и переиспользуется всеми потоками.
+    Клиенты всех ключей делят одну сессию (см. :func:`create_mailtank_session`),
+    чтобы не терять установленные соединения с API. В кеше остаются только
+    `MAILTANK_CLIENTS_CACHE_SIZE` клиентов, использовавшихся последними:
+    ключом может оказаться любая строка, введённая в форму входа.
+
+    :rtype: :class:`MailtankClient`
+    """
+    api_url = app.config['MAILTANK_API_URL']
+    cache_key = (api_url, key_content)
+    with _mailtank_clients_lock:
+        client = _mailtank_clients.pop(cache_key, None)
+        if client is None:
+            session = _mailtank_sessions.get(api_url)
+            if session is None:
+                session = _mailtank_sessions[api_url] = create_mailtank_session()
+            client = MailtankClient(api_url, key_content, session)
+        _mailtank_clients[cache_key] = client
+        while len(_mailtank_clients) > app.config['MAILTANK_CLIENTS_CACHE_SIZE']:
+            _mailtank_clients.popitem(last=False)
+        return client
+
+
+def forget_mailtank(key_content):
+    """Выбрасывает из кеша клиент Mailtank API для ключа `key_content`."""
+    with _mailtank_clients_lock:
+        for cache_key in list(_mailtank_clients):
+            if cache_key[1] == key_content:
+                del _mailtank_clients[cache_key]
+
+
+def get_tags(key_content, **kwargs):
+    """Возвращает теги проекта с ключом `key_content` (см.
+    :meth:`MailtankClient.get_tags`).
+
+    Запрос идемпотентен, поэтому при ошибке сети или ответе 5xx он
+    повторяется до `MAILTANK_RETRIES` раз с экспоненциально растущей
+    паузой, начиная с `MAILTANK_RETRY_BACKOFF` секунд.
+    """
+    retries = app.config['MAILTANK_RETRIES']
+    backoff = app.config['MAILTANK_RETRY_BACKOFF']
+    for attempt in range(retries + 1):
+        try:
+            with metrics.timer('rsstank_mailtank_request_seconds', method='get_tags'):
+                return list(get_mailtank(key_content).get_tags(**kwargs))
+        except (MailtankError, requests.RequestException) as e:
+            is_server_error = not isinstance(e, MailtankError) or \
+                (getattr(e, 'code', None) or 0) >= 500
+            if not is_server_error or attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
 class AccessKey(db.Model):
     """Ключ доступа к API Mailtank."""
 
@@ -35,6 +228,11 @@ class AccessKey(db.Model):
         db.Time(), default=default_interval_stop)
     #: Идентификатор шаблона в Mailtank
     layout_id = db.Column(db.String(255))
+    #: SHA-1 от тегов, по которым последний раз синхронизировались фиды
+    #: ключа (см. :func:`rsstank.update_feeds.get_tags_fingerprint`)
+    tags_fingerprint = db.Column(db.String(40))
+    #: Дата и время последней синхронизации фидов ключа с тегами
+    tags_synced_at = db.Column(db.DateTime)
 
     @hybrid_property
     def is_enabled(self):
@@ -43,14 +241,20 @@ class AccessKey(db.Model):
     @is_enabled.setter
     def setter(self, is_enabled):
         self.enabled_at = dt.datetime.utcnow() if is_enabled else None
+        if not is_enabled:
+            forget_mailtank(self.content)
 
     @is_enabled.expression
     def is_enabled(cls):
-        return ~db.func.isnull(cls.enabled_at)
+        return (cls.enabled_at != None).self_group()
 
     @property
     def mailtank(self):
-        return Mailtank(app.config['MAILTANK_API_URL'], self.content)
+        return get_mailtank(self.content)
+
+    def get_tags(self, **kwargs):
+        """Возвращает теги проекта (см. :func:`get_tags`)."""
+        return get_tags(self.content, **kwargs)
 
     @property
     def project(self):
@@ -77,6 +281,21 @@ class Feed(db.Model):
     last_sent_at = db.Column(db.DateTime)
     #: Дата и время последней публикации элемента фида
     last_pub_date = db.Column(db.DateTime)
+    #: Значение заголовка ETag из последнего ответа сервера фида
+    etag = db.Column(db.String(255))
+    #: Значение заголовка Last-Modified из последнего ответа сервера фида
+    last_modified = db.Column(db.String(255))
+    #: SHA-1 от тела последнего ответа сервера фида без меняющихся при
+    #: каждом запросе дат канала (см. :func:`rsstank.poll_feeds.get_content_digest`).
+    #: Запоминается, только если сервер не прислал ни ETag, ни Last-Modified
+    content_digest = db.Column(db.String(40))
+    #: Дата и время, не раньше которых фид нужно опросить снова. Если
+    #: не задано, фид будет опрошен при ближайшем запуске poll_feeds
+    next_poll_at = db.Column(db.DateTime, index=True)
+    #: Сколько опросов фида подряд закончились ошибкой (соединения,
+    #: таймаутом, слишком большим телом и т.п.)
+    poll_errors_n = db.Column(db.Integer, nullable=False, default=0,
+                              server_default='0')
     #: Ключ доступа к Mailtank API, к которому привязан фид
     access_key = db.relationship(
         'AccessKey',
@@ -127,6 +346,17 @@ class Feed(db.Model):
 
 class FeedItem(db.Model):
     """Элемент фида."""
+    __table_args__ = (
+        # Не даёт сохранить элемент фида дважды (см. `guid_hash`)
+        db.Index('ix_feed_item_feed_id_guid_hash', 'feed_id', 'guid_hash',
+                 unique=True),
+        # Элементы почти всегда выбираются по фиду: последний созданный
+        # (send_feeds), созданные после рассылки (send_feeds), созданные
+        # до неё (cleanup), упорядоченные по дате публикации (send_feeds)
+        db.Index('ix_feed_item_feed_id_created_at', 'feed_id', 'created_at'),
+        db.Index('ix_feed_item_feed_id_pub_date', 'feed_id', 'pub_date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     feed_id = db.Column(db.Integer, db.ForeignKey('feed.id'), nullable=False)
     created_at = db.Column(db.DateTime, nullable=False, index=True,
@@ -154,6 +384,10 @@ class FeedItem(db.Model):
 
     # Optional. Defines a unique identifier for the item
     guid = db.Column(db.String(2000))
+    #: SHA-1 от `guid` (см. :meth:`hash_guid`). Заполняется при опросе фида.
+    #: `guid` слишком длинный для уникального индекса, поэтому
+    #: уникальность элементов внутри фида проверяется по этой колонке
+    guid_hash = db.Column(db.String(40))
     # Optional. Defines the last-publication date for the item
     pub_date = db.Column(db.DateTime)
 
@@ -166,14 +400,29 @@ class FeedItem(db.Model):
     source_url = db.Column(db.String(2000))
     source_content = db.Column(db.String(2000))
 
+    @staticmethod
+    def hash_guid(guid):
+        """Возвращает SHA-1 от `guid` в виде hex-строки."""
+        if isinstance(guid, unicode):
+            guid = guid.encode('utf-8')
+        return hashlib.sha1(guid).hexdigest()
+
+    @staticmethod
+    def parse_pub_date(pub_date):
+        """Разбирает дату публикации элемента фида и возвращает её
+        в виде :class:`datetime.datetime` в UTC без часового пояса.
+        """
+        pub_date = dateutil.parser.parse(pub_date)
+        if pub_date.tzinfo is not None:
+            pub_date = pub_date.astimezone(pytz.utc).replace(tzinfo=None)
+        return pub_date
+
     @staticmethod
     def from_feedparser_entry(entry):
         """Конструирует :class:`FeedItem` из :class:`feedparser.FeedParserDict`."""
         pub_date = entry.get('published')
         if pub_date:
-            pub_date = dateutil.parser.parse(pub_date)
-            if pub_date.tzinfo is not None:
-                pub_date = pub_date.astimezone(pytz.utc).replace(tzinfo=None)
+            pub_date = FeedItem.parse_pub_date(pub_date)
 
         feed_item = FeedItem(
             title=entry['title'],
@@ -223,3 +472,42 @@ class FeedItem(db.Model):
         }
 
         return entry
+
+
+class RobotsTxt(db.Model):
+    """Закешированный robots.txt хоста."""
+
+    #: Максимальный размер сохраняемого robots.txt в байтах (вместимость BLOB)
+    MAX_CONTENT_SIZE = 65535
+
+    #: Хост
+    host = db.Column(db.String(255), primary_key=True)
+    #: HTTP-статус ответа на запрос robots.txt
+    status_code = db.Column(db.Integer, nullable=False)
+    #: Содержимое robots.txt
+    content = db.Column(db.LargeBinary, nullable=False)
+    #: Дата и время скачивания robots.txt
+    fetched_at = db.Column(db.DateTime, nullable=False)
+    #: Дата и время, после которых robots.txt нужно скачать заново
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<RobotsTxt {0} ({1})>'.format(self.host, self.status_code)
+
+
+class HostLease(db.Model):
+    """Аренда хоста процессом poll_feeds. Пока аренда не истекла, фиды
+    хоста опрашивает только её владелец: так несколько процессов
+    (в том числе на разных машинах) не опрашивают фиды дважды и не
+    нарушают Crawl-delay хоста.
+    """
+
+    #: Хост
+    host = db.Column(db.String(255), primary_key=True)
+    #: Идентификатор процесса, арендовавшего хост, или None
+    owner = db.Column(db.String(255))
+    #: Дата и время, после которых аренда считается истёкшей
+    expires_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<HostLease {0} ({1})>'.format(self.host, self.owner)
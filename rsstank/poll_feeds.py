@@ -1,22 +1,58 @@
 # coding: utf-8
+import os
+import re
 import time
+import hashlib
+import uuid
+import socket
+import heapq
+import threading
+import contextlib
+import calendar
 import datetime
 import collections
 import concurrent.futures
 import logging
+from xml.etree import cElementTree as ElementTree
 
 import requests
 import feedparser
+import reppy
 import reppy.parser
+import reppy.exceptions
 from furl import furl
+from sqlalchemy.orm.attributes import set_committed_value
 
-from . import app
-from .models import db, AccessKey, Feed, FeedItem
+from . import app, metrics
+from .models import db, AccessKey, Feed, FeedItem, RobotsTxt, HostLease
 
 
 logger = logging.getLogger(__name__)
 
 
+def create_session():
+    """Возвращает :class:`requests.Session`, который держит keep-alive
+    соединения с хостом. Предполагается, что одна сессия используется
+    для запросов к одному хосту из одного потока.
+    """
+    session = requests.Session()
+    # Несколько пулов -- на случай редиректов на другую схему или хост
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=app.config['RSSTANK_HTTP_POOL_MAXSIZE'])
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_timeout():
+    """Возвращает пару из таймаутов на соединение и на чтение для
+    аргумента `timeout` функций :mod:`requests`.
+    """
+    return (app.config['RSSTANK_CONNECT_TIMEOUT'],
+            app.config['RSSTANK_READ_TIMEOUT'])
+
+
 def get_robots_txt_url(host, scheme='http'):
     """Возвращает URL robots.txt для хоста `host`. Схема URL будет
     соответствовать аргументу `scheme`.
@@ -28,45 +64,654 @@ def get_robots_txt_url(host, scheme='http'):
     return str(f)
 
 
-def get_robots_rules(host, agent):
-    """Возвращает объект :class:`reppy.parser.Agent`, содержащий
-    правила, заданные в robots.txt хоста `host` для юзер-агента `agent`.
+def fetch_robots_txt(host, session=None):
+    """Скачивает robots.txt хоста `host`. Возвращает несохранённый
+    :class:`rsstank.models.RobotsTxt`, срок годности которого определяется
+    заголовками Cache-Control и Expires ответа, или None, если robots.txt
+    не удалось скачать.
+
+    :type session: :class:`requests.Session`
     """
     robots_txt_url = get_robots_txt_url(host)
     try:
-        response = requests.get(robots_txt_url)
+        response = (session or requests).get(robots_txt_url, timeout=get_timeout())
     except requests.exceptions.RequestException:
         return None
-    else:
+    ttl = reppy.Utility.get_ttl(response.headers, app.config['RSSTANK_ROBOTS_TXT_TTL'])
+    # Не перезапрашиваем robots.txt чаще, чем раз в RSSTANK_ROBOTS_TXT_MIN_TTL,
+    # даже если хост просит его не кешировать
+    ttl = max(ttl, app.config['RSSTANK_ROBOTS_TXT_MIN_TTL'])
+    fetched_at = datetime.datetime.utcnow()
+    return RobotsTxt(
+        host=host,
+        status_code=response.status_code,
+        content=response.content[:RobotsTxt.MAX_CONTENT_SIZE],
+        fetched_at=fetched_at,
+        expires_at=fetched_at + datetime.timedelta(seconds=ttl))
+
+
+def parse_robots_rules(robots_txt, agent):
+    """Возвращает объект :class:`reppy.parser.Agent`, содержащий
+    правила, заданные в `robots_txt` для юзер-агента `agent`, или None,
+    если правила неизвестны (robots.txt не удалось скачать или хост
+    ответил ошибкой 5xx).
+
+    :type robots_txt: :class:`rsstank.models.RobotsTxt` или None
+    """
+    if robots_txt is None:
+        return None
+    try:
         rules = reppy.parser.Rules(
-            robots_txt_url, response.status_code, response.content,
-            time.time() + 3600)  # Последний параметр -- это TLL, в течение которого
-                                 # будет валиден robots.txt. Нас функционал
-                                 # перезапрашивания robots.txt не волнует, поэтому
-                                 # передаём туда первое попавшееся валидное значение.
-        return rules[agent]
+            get_robots_txt_url(robots_txt.host), robots_txt.status_code,
+            robots_txt.content,
+            calendar.timegm(robots_txt.expires_at.utctimetuple()))
+    except reppy.exceptions.ReppyException:
+        return None
+    return rules[agent]
+
+
+def get_robots_rules(host, agent, session=None):
+    """Возвращает объект :class:`reppy.parser.Agent`, содержащий
+    правила, заданные в robots.txt хоста `host` для юзер-агента `agent`.
+    robots.txt скачивается заново, кеш в БД не используется.
+
+    :type session: :class:`requests.Session`
+    """
+    return parse_robots_rules(fetch_robots_txt(host, session=session), agent)
+
+
+def get_cached_robots_txts(hosts):
+    """Возвращает словарь из хостов `hosts` в их закешированные
+    и ещё не устаревшие :class:`rsstank.models.RobotsTxt`.
+    """
+    hosts = set(hosts)
+    robots_txts = {}
+    for robots_txt in RobotsTxt.query.filter(
+            RobotsTxt.expires_at > datetime.datetime.utcnow()):
+        if robots_txt.host in hosts:
+            # Отсоединяем от сессии, чтобы коммиты, сделанные за время
+            # опроса, не заставляли загружать их из БД заново
+            db.session.expunge(robots_txt)
+            robots_txts[robots_txt.host] = robots_txt
+    return robots_txts
+
+
+def save_robots_txt(robots_txt):
+    """Сохраняет (или обновляет) `robots_txt` в БД."""
+    try:
+        db.session.merge(robots_txt)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        logger.warn('Could not save %r.', robots_txt, exc_info=True)
+
+
+def load_robots_rules(hosts, agent):
+    """Возвращает словарь из хостов `hosts` в правила их robots.txt для
+    юзер-агента `agent` (см. :func:`parse_robots_rules`).
+
+    Берёт robots.txt из кеша в БД, а устаревшие и отсутствующие в нём
+    скачивает параллельно в `RSSTANK_ROBOTS_TXT_WORKERS` потоков
+    и сохраняет.
+    """
+    robots_txts = get_cached_robots_txts(hosts)
+    hosts_to_fetch = [host for host in hosts if host not in robots_txts]
+    if hosts_to_fetch:
+        logger.info('Fetching robots.txt of %i hosts.', len(hosts_to_fetch))
+        max_workers = app.config['RSSTANK_ROBOTS_TXT_WORKERS']
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetched = executor.map(fetch_robots_txt, hosts_to_fetch)
+            for host, robots_txt in zip(hosts_to_fetch, fetched):
+                robots_txts[host] = robots_txt
+
+    # Разбираем до сохранения: коммит сделает объекты устаревшими
+    rules = dict((host, parse_robots_rules(robots_txts.get(host), agent))
+                 for host in hosts)
+    for host in hosts_to_fetch:
+        if robots_txts[host] is not None:
+            save_robots_txt(robots_txts[host])
+    return rules
+
+
+#: Результат скачивания фида (см. :func:`fetch_feed`).
+#: `feed_data` -- :class:`feedparser.FeedParserDict` или None, если
+#: сервер не вернул содержимое фида или оно не изменилось. `ttl` --
+#: сколько секунд ответ остаётся свежим согласно заголовкам Cache-Control
+#: и Expires, или None. `content_digest` -- см. :func:`get_content_digest`
+#: (None, если сервер прислал ETag или Last-Modified)
+FetchResult = collections.namedtuple(
+    'FetchResult',
+    ['status_code', 'etag', 'last_modified', 'feed_data', 'ttl', 'content_digest'])
+
+
+class FeedTooLargeError(Exception):
+    """Фид больше `RSSTANK_MAX_FEED_SIZE` байт."""
+
+
+class ResponseStream(object):
+    """Файлоподобный объект, читающий тело ответа `response` по мере
+    надобности и запоминающий прочитанное. Если тело ответа окажется
+    больше `max_size` байт, чтение бросит :class:`FeedTooLargeError`.
+
+    :type response: :class:`requests.Response`, полученный с `stream=True`
+    """
+
+    chunk_size = 16 * 1024
+
+    def __init__(self, response, max_size):
+        self.chunks = []
+        self.size = 0
+        self._max_size = max_size
+        self._iter_content = response.iter_content(chunk_size=self.chunk_size)
+        # Индекс куска, который вернёт следующий вызов `read`
+        self._next_chunk = 0
+        #: Сколько секунд заняло скачивание прочитанного
+        self.read_seconds = 0
+
+    def read(self, size=-1):
+        """Возвращает очередной кусок тела ответа (независимо от `size`)
+        или пустую строку, если тело прочитано до конца.
+        """
+        if self._next_chunk < len(self.chunks):
+            chunk = self.chunks[self._next_chunk]
+        else:
+            started_at = time.time()
+            chunk = next(self._iter_content, b'')
+            self.read_seconds += time.time() - started_at
+            if not chunk:
+                return chunk
+            self.size += len(chunk)
+            if self.size > self._max_size:
+                raise FeedTooLargeError(
+                    'Feed is larger than {0} bytes.'.format(self._max_size))
+            self.chunks.append(chunk)
+        self._next_chunk += 1
+        return chunk
+
+    def prefetch(self, max_size):
+        """Читает тело ответа, если оно не больше `max_size` байт, и
+        возвращает его целиком; иначе возвращает None, прочитав чуть
+        больше `max_size` байт. В обоих случаях последующие вызовы
+        `read` начнут отдавать тело с начала.
+        """
+        body = None
+        while self.size <= max_size:
+            if not self.read():
+                body = b''.join(self.chunks)
+                break
+        self._next_chunk = 0
+        return body
+
+    def read_all(self):
+        """Дочитывает тело ответа и возвращает его целиком."""
+        while self.read():
+            pass
+        return b''.join(self.chunks)
+
+
+#: Локальные имена тегов, содержащих элементы фидов RSS и Atom
+ENTRY_TAGS = frozenset(['item', 'entry'])
+#: Локальные имена (в нижнем регистре) тегов, из которых feedparser берёт
+#: дату публикации элемента фида
+PUB_DATE_TAGS = frozenset(['pubdate', 'published', 'issued'])
+
+
+def get_local_name(tag):
+    """Возвращает имя тега `tag` без пространства имён."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def get_entry_pub_date(element):
+    """Возвращает дату публикации (см. :meth:`FeedItem.parse_pub_date`)
+    элемента фида, заданного XML-элементом `element`, или None, если
+    её нет или её не удаётся разобрать.
+    """
+    for child in element:
+        if get_local_name(child.tag).lower() in PUB_DATE_TAGS and child.text:
+            try:
+                return FeedItem.parse_pub_date(child.text.strip())
+            except (ValueError, OverflowError, TypeError, AttributeError):
+                return None
+    return None
+
+
+def parse_new_entries(stream, watermark):
+    """Потоково разбирает фид из `stream` и возвращает
+    :class:`feedparser.FeedParserDict`, в котором нет элементов,
+    опубликованных раньше `watermark` (их бы всё равно пропустил
+    :func:`save_fetch_result`).
+
+    Фиды обычно упорядочены от новых элементов к старым, поэтому разбор
+    прекращается, как только подряд встретятся
+    `RSSTANK_OLD_ITEMS_TO_STOP_PARSING` старых элементов, -- оставшаяся
+    часть документа даже не скачивается. Метаданные канала идут в фидах
+    до элементов, так что они не теряются. Если же даты публикации
+    разобранных элементов хоть раз возросли, новые элементы могут найтись
+    и в конце фида, и он разбирается целиком.
+
+    Бросает :class:`xml.etree.cElementTree.ParseError`, если фид не
+    является корректным XML.
+
+    :type stream: :class:`ResponseStream`
+    :type watermark: :class:`datetime.datetime`
+    """
+    stop_after = app.config['RSSTANK_OLD_ITEMS_TO_STOP_PARSING']
+    root = None
+    # Открытые на данный момент элементы, от корня вглубь документа
+    parents = []
+    old_entries_in_a_row = 0
+    # Не возрастают ли даты публикации разобранных элементов
+    is_newest_first = True
+    prev_pub_date = None
+    for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            parents.append(element)
+            continue
+
+        parents.pop()
+        if get_local_name(element.tag) not in ENTRY_TAGS or not parents:
+            continue
+        pub_date = get_entry_pub_date(element)
+        if pub_date is None:
+            continue
+        if prev_pub_date is not None and pub_date > prev_pub_date:
+            is_newest_first = False
+        prev_pub_date = pub_date
+        if pub_date >= watermark:
+            old_entries_in_a_row = 0
+            continue
+        old_entries_in_a_row += 1
+        if is_newest_first and old_entries_in_a_row >= stop_after:
+            # Парсер разбирает документ кусками, поэтому в дереве уже
+            # могут быть элементы, следующие за текущим, -- отрезаем их
+            # вместе с ним
+            parent = parents[-1]
+            del parent[list(parent).index(element):]
+            for ancestor, child in zip(parents, parents[1:]):
+                del ancestor[list(ancestor).index(child) + 1:]
+            break
+        parents[-1].remove(element)
+
+    # Оборванные на середине элементы (например, канал) сериализуются
+    # с тем, что уже успело в них попасть
+    return feedparser.parse(ElementTree.tostring(root, encoding='utf-8'))
+
+
+#: Начало первого элемента фида RSS или Atom
+FIRST_ENTRY_RE = re.compile(br'<(?:\w+:)?(?:item|entry)[\s>]')
+#: Даты канала, которые многие серверы обновляют при каждом запросе
+VOLATILE_CHANNEL_TAGS_RE = re.compile(
+    br'<((?:\w+:)?(?:lastBuildDate|pubDate|updated|date))[\s>].*?</\1\s*>', re.S)
+
+
+def get_content_digest(body):
+    """Возвращает SHA-1 от тела фида `body` в виде hex-строки. Даты
+    самого канала (например, lastBuildDate), идущие до первого элемента,
+    не учитываются, чтобы неизменившийся фид давал тот же хеш.
+    """
+    match = FIRST_ENTRY_RE.search(body)
+    head_end = match.start() if match else len(body)
+    head = VOLATILE_CHANNEL_TAGS_RE.sub(b'', body[:head_end])
+    digest = hashlib.sha1(head)
+    digest.update(body[head_end:])
+    return digest.hexdigest()
+
+
+def fetch_feed(url, etag=None, last_modified=None, session=None, watermark=None,
+               content_digest=None):
+    """Скачивает и разбирает фид с адресом `url`. Не обращается к БД,
+    поэтому может выполняться в любом потоке.
+
+    Если задан `watermark`, элементы, опубликованные раньше него,
+    в результат не попадают, а фид скачивается и разбирается только
+    до тех пор, пока в нём идут новые элементы (см.
+    :func:`parse_new_entries`). Некорректный XML разбирается целиком
+    средствами feedparser.
+
+    :param etag: значение ETag из предыдущего ответа сервера
+    :param last_modified: значение Last-Modified из предыдущего ответа сервера
+    :type session: :class:`requests.Session`
+    :param watermark: дата публикации, элементы раньше которой не нужны
+    :type watermark: :class:`datetime.datetime`
+    :param content_digest: хеш тела фида из предыдущего ответа сервера.
+                           Если сервер не прислал валидаторов, а хеш тела
+                           совпал, фид не разбирается
+    :rtype: :class:`FetchResult`
+    """
+    # Делаем условный GET: если фид не изменился с прошлого опроса,
+    # сервер ответит 304 без тела
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    host = furl(url).host
+    started_at = time.time()
+    try:
+        response = (session or requests).get(  # requests следует редиректам
+            url, headers=headers, timeout=get_timeout(), stream=True)
+    except:
+        metrics.inc('rsstank_fetch_errors_total', host=host)
+        raise
+    metrics.inc('rsstank_fetch_responses_total', status=response.status_code)
+    try:
+        feed_data = None
+        new_content_digest = None
+        parse_seconds = 0
+        if 200 <= response.status_code < 300:
+            stream = ResponseStream(response, app.config['RSSTANK_MAX_FEED_SIZE'])
+            try:
+                if not response.headers.get('ETag') and \
+                        not response.headers.get('Last-Modified'):
+                    # Без валидаторов о том, что фид не изменился, можно узнать,
+                    # только скачав его целиком. Большие фиды всё же разбираем
+                    # потоково, не дожидаясь конца
+                    body = stream.prefetch(app.config['RSSTANK_CONTENT_DIGEST_MAX_SIZE'])
+                    if body is not None:
+                        new_content_digest = get_content_digest(body)
+                if new_content_digest is not None and \
+                        new_content_digest == content_digest:
+                    metrics.inc('rsstank_feeds_unchanged_total')
+                    logger.info('%s has not changed since the last poll.', url)
+                else:
+                    # Потоковый разбор перемежается со скачиванием, поэтому
+                    # время скачивания из времени разбора вычитаем
+                    parse_started_at = time.time()
+                    read_seconds = stream.read_seconds
+                    feed_data = parse_feed(url, stream, watermark)
+                    parse_seconds = (time.time() - parse_started_at -
+                                     (stream.read_seconds - read_seconds))
+                    metrics.observe('rsstank_parse_seconds', parse_seconds)
+            except:
+                metrics.inc('rsstank_fetch_errors_total', host=host)
+                raise
+            finally:
+                metrics.inc('rsstank_downloaded_bytes_total', stream.size, host=host)
+            logger.debug('%i bytes of %s have been read.', stream.size, url)
+    finally:
+        # Недочитанный ответ закрывает соединение, а не возвращает его в пул
+        response.close()
+    metrics.observe('rsstank_fetch_seconds', time.time() - started_at - parse_seconds)
+    return FetchResult(
+        status_code=response.status_code,
+        etag=response.headers.get('ETag'),
+        last_modified=response.headers.get('Last-Modified'),
+        feed_data=feed_data,
+        ttl=reppy.Utility.get_ttl(response.headers, None),
+        content_digest=new_content_digest)
 
 
-def poll_feed(feed):
-    """Сохраняет элементы фида в БД.
+def parse_feed(url, stream, watermark=None):
+    """Разбирает фид с адресом `url` из `stream` (см. :func:`fetch_feed`).
+
+    :type stream: :class:`ResponseStream`
+    :rtype: :class:`feedparser.FeedParserDict`
+    """
+    if watermark is not None:
+        try:
+            return parse_new_entries(stream, watermark)
+        except ElementTree.ParseError:
+            logger.info('%s is not a well-formed XML, parsing it '
+                        'with feedparser.', url)
+    return feedparser.parse(stream.read_all())
+
+
+def get_watermark(feed):
+    """Возвращает дату публикации, элементы фида `feed` раньше которой
+    не будут сохранены (см. :func:`save_fetch_result`), или None.
 
     :type feed: :class:`rsstank.models.Feed`
     """
-    logger.info('Polling %r.', feed)
+    dates = [date for date in (feed.last_pub_date, feed.access_key.enabled_at)
+             if date is not None]
+    return max(dates) if dates else None
+
+
+def insert_ignore(table):
+    """Возвращает INSERT в таблицу `table`, который молча пропускает
+    строки, нарушающие уникальные индексы.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    return table.insert().prefix_with('IGNORE')
+
+
+class FeedItemWriter(object):
+    """Копит результаты опроса фидов и записывает их в БД пачками:
+    новые элементы фидов -- многострочными INSERT-ами, изменения
+    самих фидов -- одним UPDATE на пачку.
+
+    Элементы, уже сохранённые в фиде (с тем же `guid`), пропускаются
+    уникальным индексом `(feed_id, guid_hash)`.
+
+    Записанное не фиксируется: после :meth:`flush` нужно сделать
+    `db.session.commit()` (см. :func:`commit_writer`). Не потокобезопасен --
+    каждому потоку нужен свой экземпляр.
+
+    :param chunk_size: число строк в одном INSERT-е; по умолчанию
+                       `RSSTANK_INSERT_CHUNK_SIZE`
+    """
+
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size or app.config['RSSTANK_INSERT_CHUNK_SIZE']
+        self._item_rows = []
+        # {id фида: (фид, {имя колонки: новое значение})}
+        self._feed_updates = {}
+
+    def add(self, feed, items=(), **values):
+        """Ставит в очередь на запись элементы `items` фида `feed` и новые
+        значения `values` колонок фида.
+
+        :type feed: :class:`rsstank.models.Feed`
+        :type items: список :class:`rsstank.models.FeedItem`
+        """
+        created_at = datetime.datetime.utcnow()
+        for item in items:
+            row = {column.key: getattr(item, column.key)
+                   for column in FeedItem.__table__.columns
+                   if not column.primary_key}
+            row['feed_id'] = feed.id
+            row['created_at'] = created_at
+            row['guid_hash'] = item.guid and FeedItem.hash_guid(item.guid)
+            self._item_rows.append(row)
+        _, feed_values = self._feed_updates.setdefault(feed.id, (feed, {}))
+        feed_values.update(values)
+
+    @property
+    def is_full(self):
+        """True, если накоплено не меньше пачки элементов или фидов."""
+        return (len(self._item_rows) >= self.chunk_size or
+                len(self._feed_updates) >= self.chunk_size)
+
+    def split(self):
+        """Возвращает список пар из идентификатора фида и writer-а,
+        которому передано накопленное для этого фида.
+        """
+        writers = collections.OrderedDict()
+        for feed_id, (feed, feed_values) in self._feed_updates.iteritems():
+            writer = writers[feed_id] = FeedItemWriter(self.chunk_size)
+            writer._feed_updates[feed_id] = (feed, dict(feed_values))
+        for row in self._item_rows:
+            writers[row['feed_id']]._item_rows.append(row)
+        return writers.items()
+
+    def _drop_saved_rows(self, item_rows):
+        """Возвращает строки `item_rows`, кроме элементов, уже сохранённых
+        в БД (с теми же фидом и `guid_hash`).
+
+        Нужно, когда feed_item секционирована (см. :mod:`rsstank.cleanup`):
+        тогда уникальный индекс включает created_at и отсеивает повторы
+        только в пределах одной записи.
+        """
+        chunk_size = self.chunk_size
+        rows_to_check = [row for row in item_rows if row['guid_hash'] is not None]
+        saved_keys = set()
+        for i in range(0, len(rows_to_check), chunk_size):
+            hashes_by_feed_ids = collections.defaultdict(set)
+            for row in rows_to_check[i:i + chunk_size]:
+                hashes_by_feed_ids[row['feed_id']].add(row['guid_hash'])
+            saved_keys.update(db.session.query(FeedItem.feed_id, FeedItem.guid_hash)
+                              .filter(db.or_(*[
+                                  db.and_(FeedItem.feed_id == feed_id,
+                                          FeedItem.guid_hash.in_(hashes))
+                                  for feed_id, hashes in hashes_by_feed_ids.iteritems()])))
+        return [row for row in item_rows
+                if (row['feed_id'], row['guid_hash']) not in saved_keys]
+
+    def flush(self):
+        """Записывает накопленное в БД. Накопленное забывается, даже если
+        записать его не удалось.
+        """
+        item_rows, feed_updates = self._item_rows, self._feed_updates
+        self._item_rows = []
+        self._feed_updates = {}
+        with metrics.timer('rsstank_db_flush_seconds'):
+            self._flush(item_rows, feed_updates)
+
+    def _flush(self, item_rows, feed_updates):
+        item_table = FeedItem.__table__
+        rows_n = len(item_rows)
+        if app.config['RSSTANK_FEED_ITEM_PARTITIONING']:
+            item_rows = self._drop_saved_rows(item_rows)
+        inserted_n = 0
+        for i in range(0, len(item_rows), self.chunk_size):
+            chunk = item_rows[i:i + self.chunk_size]
+            result = db.session.execute(insert_ignore(item_table).values(chunk))
+            inserted_n += result.rowcount
+        metrics.inc('rsstank_feed_items_inserted_total', inserted_n)
+        metrics.inc('rsstank_feed_items_skipped_total', rows_n - inserted_n)
+        if inserted_n < rows_n:
+            logger.info('%i already saved feed items have been skipped.',
+                        rows_n - inserted_n)
+
+        if feed_updates:
+            # UPDATE feed SET <колонка> = CASE id WHEN <id> THEN <значение> ...
+            #                             ELSE <колонка> END, ... WHERE id IN (...)
+            feed_table = Feed.__table__
+            column_names = set()
+            for _, feed_values in feed_updates.itervalues():
+                column_names.update(feed_values)
+            case_values = {}
+            for name in column_names:
+                column = feed_table.c[name]
+                whens = {
+                    feed_id: db.literal(feed_values[name], type_=column.type)
+                    for feed_id, (_, feed_values) in feed_updates.iteritems()
+                    if name in feed_values
+                }
+                case_values[name] = db.case(whens, value=feed_table.c.id, else_=column)
+            db.session.execute(
+                feed_table.update()
+                .where(feed_table.c.id.in_(feed_updates.keys()))
+                .values(**case_values))
+
+            # Приводим загруженные в сессию объекты в соответствие с БД,
+            # не помечая их изменёнными
+            for feed, feed_values in feed_updates.itervalues():
+                for name, value in feed_values.iteritems():
+                    set_committed_value(feed, name, value)
+
+
+def get_poll_interval(feed, pub_dates=(), ttl=None):
+    """Возвращает интервал в секундах до следующего опроса фида `feed`.
+
+    Интервал подстраивается под частоту публикаций в фиде. Если при опросе
+    нашлись новые элементы, опубликованные в моменты `pub_dates`, это
+    средний промежуток между ними и предыдущей публикацией; если нет --
+    предыдущий интервал, увеличенный вдвое. Интервал не опускается ниже
+    времени свежести ответа `ttl` и `RSSTANK_MIN_POLL_INTERVAL`
+    и не превышает `RSSTANK_MAX_POLL_INTERVAL` и интервала рассылки фида.
+
+    :type feed: :class:`rsstank.models.Feed` до записи результатов опроса
+    :param pub_dates: даты публикации новых элементов фида
+    """
+    interval = app.config['RSSTANK_DEFAULT_POLL_INTERVAL']
+    if pub_dates:
+        pub_dates = sorted(pub_dates)
+        if feed.last_pub_date and feed.last_pub_date < pub_dates[0]:
+            pub_dates.insert(0, feed.last_pub_date)
+        if len(pub_dates) > 1:
+            span = pub_dates[-1] - pub_dates[0]
+            interval = total_seconds(span) / (len(pub_dates) - 1)
+    elif feed.last_polled_at and feed.next_poll_at:
+        interval = 2 * total_seconds(feed.next_poll_at - feed.last_polled_at)
+
+    if ttl:
+        interval = max(interval, ttl)
+    interval = min(interval, app.config['RSSTANK_MAX_POLL_INTERVAL'],
+                   feed.sending_interval)
+    return max(interval, app.config['RSSTANK_MIN_POLL_INTERVAL'])
+
+
+def get_retry_interval(feed):
+    """Возвращает интервал в секундах до следующей попытки опросить фид
+    `feed`, опрос которого только что закончился ошибкой: начиная
+    с `RSSTANK_MIN_POLL_INTERVAL`, интервал удваивается с каждой ошибкой
+    подряд и не превышает `RSSTANK_MAX_POLL_INTERVAL`.
+
+    :type feed: :class:`rsstank.models.Feed` до записи результатов опроса
+    """
+    max_interval = app.config['RSSTANK_MAX_POLL_INTERVAL']
+    # Степень ограничена, чтобы не считать огромных чисел
+    interval = app.config['RSSTANK_MIN_POLL_INTERVAL'] * 2 ** min(feed.poll_errors_n, 32)
+    return min(interval, max_interval)
+
+
+def total_seconds(timedelta):
+    """Возвращает длительность `timedelta` в секундах."""
+    return timedelta.days * 24 * 60 * 60 + timedelta.seconds
+
+
+def save_fetch_error(feed, writer):
+    """Передаёт `writer`-у время следующего опроса фида `feed`, скачать
+    или разобрать который не удалось (см. :func:`get_retry_interval`).
+
+    :type feed: :class:`rsstank.models.Feed`
+    :type writer: :class:`FeedItemWriter`
+    """
+    utc_now = datetime.datetime.utcnow()
+    writer.add(feed, poll_errors_n=feed.poll_errors_n + 1,
+               next_poll_at=utc_now + datetime.timedelta(
+                   seconds=get_retry_interval(feed)))
 
-    response = requests.get(feed.url)  # requests.get следует редиректам
-    if not 200 <= response.status_code < 300:
-        logger.warn('%r returned non-20* status: %i', feed, response.status_code)
-        return
-    feed_data = feedparser.parse(response.content)
 
-    feed.channel_link = feed_data.feed.link
-    feed.channel_title = feed_data.feed.title
-    feed.channel_description = feed_data.feed.subtitle
-    feed.channel_image_url = feed_data.feed.get('image', {}).get('href')
+def save_fetch_result(feed, result, writer):
+    """Передаёт `writer`-у элементы фида `feed`, полученные :func:`fetch_feed`.
 
-    items_saved_n = 0
+    :type feed: :class:`rsstank.models.Feed`
+    :type result: :class:`FetchResult`
+    :type writer: :class:`FeedItemWriter`
+    """
+    utc_now = datetime.datetime.utcnow()
+    if feed.poll_errors_n:
+        # Сервер снова отвечает
+        writer.add(feed, poll_errors_n=0)
+    is_body_unchanged = (result.content_digest is not None and
+                         result.content_digest == feed.content_digest)
+    if result.status_code == 304 or \
+            (200 <= result.status_code < 300 and is_body_unchanged):
+        writer.add(feed, last_polled_at=utc_now, next_poll_at=utc_now + datetime.timedelta(
+            seconds=get_poll_interval(feed, ttl=result.ttl)))
+        logger.info('%r has not been modified since the last poll.', feed)
+        return
+    if not 200 <= result.status_code < 300:
+        # Откладываем следующий опрос так же, как для неизменившегося фида
+        writer.add(feed, next_poll_at=utc_now + datetime.timedelta(
+            seconds=get_poll_interval(feed, ttl=result.ttl)))
+        logger.warn('%r returned non-20* status: %i', feed, result.status_code)
+        return
+    feed_data = result.feed_data
+
+    feed_items = []
+    has_items_from_future = False
+    next_future_pub_date = None
     last_pub_date = feed.last_pub_date
+    # cleanup удаляет секции feed_item целиком, вместе с элементами,
+    # опубликованными одновременно с последним (см. rsstank.cleanup)
+    is_partitioned = app.config['RSSTANK_FEED_ITEM_PARTITIONING']
     for entry in feed_data.entries:
         feed_item = FeedItem.from_feedparser_entry(entry)
         # Проверяем дату публикации элемента фида. Если элемент фида опубликован
@@ -82,92 +727,531 @@ def poll_feed(feed):
 
         if feed_item.pub_date < datetime.datetime.utcnow():
             # Публикация элемента фида совершена в прошлом
-            if feed.last_pub_date and feed_item.pub_date <= feed.last_pub_date:
-                # Элемент опубликован раньше, чем последний элемент фида, или в
-                # то же время, значит мы его уже загружали
+            if feed.last_pub_date and feed_item.pub_date < feed.last_pub_date:
+                # Элемент опубликован раньше, чем последний элемент фида,
+                # значит мы его уже загружали. Элементы, опубликованные
+                # в то же время, могут быть и новыми -- повторы среди них
+                # отсеет уникальный индекс при записи
+                continue
+            if is_partitioned and feed_item.pub_date == feed.last_pub_date:
+                # ...если только их не удалили вместе с секцией: тогда
+                # повтор уже не отсеять, и элемент разослали бы снова
                 continue
             if feed_item.pub_date < feed.access_key.enabled_at:
                 # Если элемент был опубликован раньше времени активации ключа
                 continue
 
-            feed.items.append(feed_item)
-            items_saved_n += 1
+            feed_items.append(feed_item)
             if not last_pub_date or last_pub_date < feed_item.pub_date:
                 # Запоминаем дату публикации фида, опубликованного позже
                 # предыдущих
                 last_pub_date = feed_item.pub_date
+        else:
+            has_items_from_future = True
+            if not next_future_pub_date or feed_item.pub_date < next_future_pub_date:
+                next_future_pub_date = feed_item.pub_date
+
+    # Частоту публикаций оцениваем только по действительно новым элементам:
+    # опубликованные одновременно с последним сохранённым могут оказаться
+    # повторами
+    new_pub_dates = [feed_item.pub_date for feed_item in feed_items
+                     if not feed.last_pub_date or
+                     feed_item.pub_date > feed.last_pub_date]
+    poll_interval = get_poll_interval(feed, new_pub_dates, ttl=result.ttl)
+    next_poll_at = utc_now + datetime.timedelta(seconds=poll_interval)
+    if next_future_pub_date and next_future_pub_date < next_poll_at:
+        # Опрашиваем фид вскоре после публикации элемента из будущего
+        next_poll_at = max(next_future_pub_date, utc_now + datetime.timedelta(
+            seconds=app.config['RSSTANK_MIN_POLL_INTERVAL']))
+
+    # В фиде есть элементы, опубликованные в будущем. Их нужно будет
+    # подобрать при одном из следующих опросов, даже если сам документ
+    # к тому времени не изменится -- поэтому не запоминаем валидаторы
+    writer.add(
+        feed, feed_items,
+        # Ничто из этого не обязательно, например, в Atom-фидах
+        channel_link=feed_data.feed.get('link'),
+        channel_title=feed_data.feed.get('title'),
+        channel_description=feed_data.feed.get('subtitle'),
+        channel_image_url=feed_data.feed.get('image', {}).get('href'),
+        etag=None if has_items_from_future else result.etag,
+        last_modified=None if has_items_from_future else result.last_modified,
+        content_digest=None if has_items_from_future else result.content_digest,
+        last_polled_at=utc_now,
+        next_poll_at=next_poll_at,
+        # Сохраняем дату публикации последнего фида
+        last_pub_date=last_pub_date)
+    logger.info('%i items have been saved from %r.', len(feed_items), feed)
+
+
+def normalize_url(url):
+    """Приводит адрес фида `url` к виду, одинаковому для адресов одного
+    и того же документа: схема и хост в нижнем регистре, без порта по
+    умолчанию и без фрагмента.
+    """
+    try:
+        normalized_url = furl(url)
+    except ValueError:
+        return url
+    normalized_url.fragment = ''
+    return normalized_url.url
+
+
+def group_feed_ids_by_url(feed_ids):
+    """Группирует идентификаторы фидов `feed_ids` по адресам фидов (см.
+    :func:`normalize_url`). Возвращает список групп -- списков
+    идентификаторов -- в порядке первого появления адреса в `feed_ids`.
+    """
+    urls_by_ids = {}
+    chunk_size = app.config['RSSTANK_INSERT_CHUNK_SIZE']
+    for i in range(0, len(feed_ids), chunk_size):
+        chunk = feed_ids[i:i + chunk_size]
+        urls_by_ids.update(
+            db.session.query(Feed.id, Feed.url).filter(Feed.id.in_(chunk)))
+    groups = collections.OrderedDict()
+    for feed_id in feed_ids:
+        if feed_id in urls_by_ids:
+            url = normalize_url(urls_by_ids[feed_id])
+            groups.setdefault(url, []).append(feed_id)
+    return groups.values()
+
+
+def get_feeds(feed_ids):
+    """Возвращает список фидов с идентификаторами `feed_ids`, кроме уже
+    удалённых (например, одновременно запущенным update_feeds).
+    """
+    feeds = [Feed.query.get(feed_id) for feed_id in feed_ids]
+    return [feed for feed in feeds if feed is not None]
+
+
+def get_fetch_kwargs(feeds):
+    """Возвращает аргументы :func:`fetch_feed` для однократного скачивания
+    фида, на который подписаны фиды `feeds` (с одинаковым адресом).
+
+    Условный GET делается, только если валидаторы всех фидов совпадают:
+    ответ 304 должен быть верен для каждого из них (то же -- для хеша
+    тела). Элементы отбрасываются по самой ранней из дат, до которых они
+    не нужны фидам.
+
+    :type feeds: список :class:`rsstank.models.Feed`
+    """
+    validators = set((feed.etag, feed.last_modified, feed.content_digest)
+                     for feed in feeds)
+    etag, last_modified, content_digest = \
+        validators.pop() if len(validators) == 1 else (None, None, None)
+    watermarks = [get_watermark(feed) for feed in feeds]
+    watermark = None if None in watermarks else min(watermarks)
+    return dict(url=feeds[0].url, etag=etag, last_modified=last_modified,
+                watermark=watermark, content_digest=content_digest)
+
+
+def poll_same_feeds(feeds, session=None, writer=None):
+    """Скачивает и разбирает однажды фид, на который подписаны фиды
+    `feeds` (с одинаковым адресом), и сохраняет его элементы в БД для
+    каждого из них. Какие элементы новые, решается для каждого фида
+    отдельно (см. :func:`save_fetch_result`).
+
+    :type feeds: список :class:`rsstank.models.Feed`
+    :param session: сессия, через которую будет скачан фид
+    :type session: :class:`requests.Session`
+    :param writer: объект, копящий записи в БД. Если не задан, элементы
+                   фидов будут записаны сразу (но не зафиксированы)
+    :type writer: :class:`FeedItemWriter`
+    """
+    if writer is None:
+        writer = FeedItemWriter()
+        try:
+            poll_same_feeds(feeds, session=session, writer=writer)
+        finally:
+            writer.flush()
+        return
+
+    logger.info('Polling %r.', feeds[0] if len(feeds) == 1 else feeds)
+    try:
+        result = fetch_feed(session=session, **get_fetch_kwargs(feeds))
+    except:
+        # Откладываем следующую попытку, чтобы не опрашивать недоступный
+        # фид при каждом запуске
+        for feed in feeds:
+            save_fetch_error(feed, writer)
+        raise
+    for feed in feeds:
+        save_fetch_result(feed, result, writer)
+
+
+def poll_feed(feed, session=None, writer=None):
+    """Сохраняет элементы фида в БД (см. :func:`poll_same_feeds`).
+
+    :type feed: :class:`rsstank.models.Feed`
+    """
+    poll_same_feeds([feed], session=session, writer=writer)
+
+
+def commit_writer(writer):
+    """Записывает накопленное `writer`-ом в БД и фиксирует транзакцию.
+
+    Если пачку записать не удалось, она записывается заново по фидам,
+    и отбрасываются результаты опроса только тех фидов, запись которых
+    не удалась и в одиночку. Такие фиды будут опрошены при следующем
+    запуске. В любом случае `writer` после вызова пуст.
+
+    :type writer: :class:`FeedItemWriter`
+    """
+    feed_writers = writer.split()
+    try:
+        writer.flush()
+        with metrics.timer('rsstank_db_commit_seconds'):
+            db.session.commit()
+    except:
+        db.session.rollback()
+        if len(feed_writers) < 2:
+            logger.warn('There was an error during saving polled feeds', exc_info=True)
+            return
+        logger.warn('There was an error during saving polled feeds, saving them '
+                    'one by one', exc_info=True)
+    else:
+        return
 
-    feed.last_polled_at = datetime.datetime.utcnow()
-    # Сохраняем дату публикации последнего фида
-    feed.last_pub_date = last_pub_date
-    logger.info('%i items have been saved from %r.', items_saved_n, feed)
+    for feed_id, feed_writer in feed_writers:
+        try:
+            feed_writer.flush()
+            with metrics.timer('rsstank_db_commit_seconds'):
+                db.session.commit()
+        except:
+            db.session.rollback()
+            logger.warn('Polling results of feed #%i have been dropped',
+                        feed_id, exc_info=True)
 
 
-def poll_feeds(feed_ids, rules=None):
+def poll_feeds(feed_ids, rules=None, session=None):
     """Сохраняет элементы фидов с идентификаторами `feed_ids` в БД.
 
     :param feed_ids: список идентификаторов фидов. URL-ы этих фидов должны
                      указывать на один и тот же хост, правила доступа к
-                     которому задаются аргументом `rules`
+                     которому задаются аргументом `rules`. Фиды с одинаковым
+                     адресом скачиваются однажды
     :type rules: :class:`reppy.parser.Agent`
+    :param session: сессия, через которую будут скачаны фиды. Если не
+                    задана, будет создана (и закрыта по окончании) новая
+    :type session: :class:`requests.Session`
     """
-    def _process(feed_id):
-        feed = Feed.query.get(feed_id)
-        if not rules or rules.allowed(feed.url):
+    if session is None:
+        session = create_session()
+        try:
+            return poll_feeds(feed_ids, rules=rules, session=session)
+        finally:
+            session.close()
+
+    writer = FeedItemWriter()
+
+    def _process(group):
+        feeds = get_feeds(group)
+        if not feeds:
+            return
+        if not rules or rules.allowed(feeds[0].url):
             try:
-                poll_feed(feed)
+                poll_same_feeds(feeds, session=session, writer=writer)
             except:
                 db.session.rollback()
-                logger.warn('There was an error during polling %r', feed, exc_info=True)
-            else:
-                db.session.commit()
+                logger.warn('There was an error during polling %r', feeds, exc_info=True)
+            if writer.is_full:
+                commit_writer(writer)
         else:
-            logger.warn('Accessing %r is forbidden by host\'s robots.txt.', feed)
+            logger.warn('Accessing %r is forbidden by host\'s robots.txt.', feeds)
 
-    # Хотим спать _только между_ вызовами `poll_feed` (т.е., не хотим спать
-    # после последнего вызова) -- отсюда такая схема с откусыванием головы.
-    feed_ids = iter(feed_ids)
-    feed_id = feed_ids.next()
-    _process(feed_id)
-    for feed_id in feed_ids:
+    # Хотим спать _только между_ вызовами `poll_same_feeds` (т.е., не хотим
+    # спать после последнего вызова) -- отсюда такая схема с откусыванием головы.
+    groups = iter(group_feed_ids_by_url(feed_ids))
+    group = groups.next()
+    _process(group)
+    for group in groups:
         # Уважаем Crawl-delay и спим, дабы соблюсти задержку.
         # Note: `rules.delay` может быть None, если в robots.txt не была
         # указана задержка
         time.sleep((rules and rules.delay) or
                    app.config['RSSTANK_DEFAULT_CRAWL_DELAY'])
-        _process(feed_id)
+        _process(group)
+    commit_writer(writer)
 
 
-def get_feed_ids_by_hosts():
+def get_feed_ids_by_hosts(utc_now=None, feed_ids=None):
     """Возвращает словарь, ключами которого являются имена хостов,
     а значениями -- списки идентификаторов фидов, чьи URL указызывают
     на этот хост.
 
-    Перечисляются только фиды, относящиеся ко включенным ключам (`is_enabled`).
+    Перечисляются только фиды, относящиеся ко включенным ключам (`is_enabled`),
+    которые пора опросить (`next_poll_at` не задан или наступил).
 
+    :param feed_ids: если задан, перечисляются только фиды из этого списка
     :rtype: {str: [int]}
     """
+    if not utc_now:
+        utc_now = datetime.datetime.utcnow()
+    feeds = db.session.query(Feed.id, Feed.url) \
+        .filter(db.or_(Feed.next_poll_at == None, Feed.next_poll_at <= utc_now)) \
+        .join(AccessKey).filter_by(is_enabled=True)
+    if feed_ids is None:
+        chunks = [feeds]
+    else:
+        chunk_size = app.config['RSSTANK_INSERT_CHUNK_SIZE']
+        chunks = [feeds.filter(Feed.id.in_(feed_ids[i:i + chunk_size]))
+                  for i in range(0, len(feed_ids), chunk_size)]
     rv = collections.defaultdict(list)
-    for feed in Feed.query.join(AccessKey).filter_by(is_enabled=True):
-        host = furl(feed.url).host
-        rv[host].append(feed.id)
+    for chunk in chunks:
+        for feed_id, url in chunk:
+            host = furl(url).host
+            rv[host].append(feed_id)
     return rv
 
 
-def main():
-    """Обновляет содержимое всех фидов, относящихся ко включенным ключам."""
-    logger.info('poll_feeds has started.')
+def get_lease_owner():
+    """Возвращает уникальный идентификатор текущего запуска poll_feeds
+    для аренды хостов (см. :class:`rsstank.models.HostLease`).
+    """
+    return '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(),
+                                uuid.uuid4().hex[:8])
 
-    # Группируем идентификаторы фидов по хостам
-    feed_ids_by_hosts = get_feed_ids_by_hosts()
 
-    # Опрашиваем robots.txt всех хостов
-    host_rules = {}
-    for host in feed_ids_by_hosts.keys():
-        host_rules[host] = get_robots_rules(host, app.config['RSSTANK_AGENT'])
+def lease_hosts(hosts, owner, utc_now=None):
+    """Арендует для `owner` те из хостов `hosts`, которые не арендованы
+    другими или чья аренда истекла, на `RSSTANK_HOST_LEASE_TIME` секунд.
+    Возвращает множество арендованных хостов.
+
+    Захват хоста -- атомарный UPDATE, проверяющий, что аренда свободна,
+    так что каждый хост достаётся ровно одному из одновременно
+    запущенных процессов.
+    """
+    if not utc_now:
+        utc_now = datetime.datetime.utcnow()
+    expires_at = utc_now + datetime.timedelta(
+        seconds=app.config['RSSTANK_HOST_LEASE_TIME'])
+    table = HostLease.__table__
+    # URL без хоста (furl вернёт None) арендуются под пустым именем
+    hosts_by_names = dict((host or '', host) for host in hosts)
+    names = list(hosts_by_names)
+    leased_hosts = set()
+    chunk_size = app.config['RSSTANK_INSERT_CHUNK_SIZE']
+    for i in range(0, len(names), chunk_size):
+        chunk = names[i:i + chunk_size]
+        db.session.execute(insert_ignore(table).values(
+            [{'host': host, 'owner': None, 'expires_at': None} for host in chunk]))
+        db.session.execute(
+            table.update()
+            .where(table.c.host.in_(chunk))
+            .where(db.or_(table.c.owner == None, table.c.expires_at < utc_now))
+            .values(owner=owner, expires_at=expires_at))
+        leased_hosts.update(hosts_by_names[name] for name, in db.session.execute(
+            db.select([table.c.host])
+            .where(table.c.host.in_(chunk))
+            .where(table.c.owner == owner)))
+        db.session.commit()
+    return leased_hosts
+
+
+def renew_hosts(owner, utc_now=None):
+    """Продлевает на `RSSTANK_HOST_LEASE_TIME` секунд аренду хостов,
+    арендованных `owner`.
+    """
+    if not utc_now:
+        utc_now = datetime.datetime.utcnow()
+    table = HostLease.__table__
+    db.session.execute(
+        table.update().where(table.c.owner == owner)
+        .values(expires_at=utc_now + datetime.timedelta(
+            seconds=app.config['RSSTANK_HOST_LEASE_TIME'])))
+    db.session.commit()
+
+
+@contextlib.contextmanager
+def renewing_hosts(owner):
+    """Контекстный менеджер, который в отдельном потоке продлевает аренду
+    хостов `owner` (см. :func:`renew_hosts`) каждую треть
+    `RSSTANK_HOST_LEASE_TIME`, пока выполняется его тело.
+    """
+    stop = threading.Event()
+    interval = app.config['RSSTANK_HOST_LEASE_TIME'] / 3.0
+
+    def renew():
+        try:
+            while not stop.wait(interval):
+                try:
+                    renew_hosts(owner)
+                except:
+                    db.session.rollback()
+                    logger.warn('Could not renew leases of %s.', owner, exc_info=True)
+        finally:
+            db.session.remove()
+
+    thread = threading.Thread(target=renew)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def release_hosts(owner):
+    """Освобождает хосты, арендованные `owner`."""
+    table = HostLease.__table__
+    db.session.execute(
+        table.update().where(table.c.owner == owner)
+        .values(owner=None, expires_at=None))
+    db.session.commit()
+
+
+def poll_hosts_async(feed_ids_by_hosts):
+    """Сохраняет элементы фидов `feed_ids_by_hosts` в БД, не занимая
+    потоки ожиданием Crawl-delay.
+
+    В пул потоков отдаются только сетевые запросы (robots.txt и
+    :func:`fetch_feed`). Расписание запросов к хостам ведётся в вызывающем
+    потоке очередью таймеров, и он же, единственный, пишет результаты в БД.
+    Поэтому одновременно могут опрашиваться тысячи хостов, а поток
+    из пула занят ровно столько, сколько длится запрос.
 
-    # Заводим пул из 20 потоков
-    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+    :param feed_ids_by_hosts: см. :func:`get_feed_ids_by_hosts`
+    """
+    agent = app.config['RSSTANK_AGENT']
+    default_delay = app.config['RSSTANK_DEFAULT_CRAWL_DELAY']
+    max_workers = app.config['RSSTANK_ASYNC_POLL_WORKERS']
+    max_active_hosts = app.config['RSSTANK_ASYNC_POLL_MAX_ACTIVE_HOSTS']
+
+    # Хосты, опрос которых ещё не начался. Число одновременно опрашиваемых
+    # хостов ограничено, поскольку каждый держит keep-alive соединение
+    waiting_hosts = collections.deque(feed_ids_by_hosts)
+    feed_ids_queues = {}
+    sessions = {}
+    rules = {}
+    # Не устаревшие robots.txt из кеша в БД; остальные скачиваются
+    # при начале опроса хоста
+    robots_txts = get_cached_robots_txts(feed_ids_by_hosts)
+    # Очередь таймеров: пары (время, не раньше которого можно
+    # обращаться к хосту; хост)
+    timers = []
+    # Выполняющиеся запросы: future -> (хост, идентификаторы фидов
+    # с одним адресом или None для robots.txt)
+    pending = {}
+
+    def start_hosts():
+        while waiting_hosts and len(sessions) < max_active_hosts:
+            host = waiting_hosts.popleft()
+            # Фиды с одинаковым адресом скачиваются однажды
+            feed_ids_queues[host] = collections.deque(
+                group_feed_ids_by_url(feed_ids_by_hosts[host]))
+            sessions[host] = create_session()
+            heapq.heappush(timers, (time.time(), host))
+
+    def finish_host(host):
+        sessions.pop(host).close()
+        del feed_ids_queues[host]
+        rules.pop(host, None)
+        logger.info('All feeds from %s have been polled.', host)
+
+    def next_allowed_feeds(host):
+        groups = feed_ids_queues[host]
+        while groups:
+            feeds = get_feeds(groups.popleft())
+            if not feeds:
+                continue
+            if not rules[host] or rules[host].allowed(feeds[0].url):
+                return feeds
+            logger.warn('Accessing %r is forbidden by host\'s robots.txt.', feeds)
+
+    def submit(executor, host):
+        session = sessions[host]
+        if host not in rules and host in robots_txts:
+            rules[host] = parse_robots_rules(robots_txts.pop(host), agent)
+        if host not in rules:
+            future = executor.submit(fetch_robots_txt, host, session=session)
+            pending[future] = (host, None)
+            return
+        feeds = next_allowed_feeds(host)
+        if feeds is None:
+            finish_host(host)
+            return
+        logger.info('Polling %r.', feeds[0] if len(feeds) == 1 else feeds)
+        future = executor.submit(fetch_feed, session=session, **get_fetch_kwargs(feeds))
+        pending[future] = (host, [feed.id for feed in feeds])
+
+    writer = FeedItemWriter()
+
+    def save(feed_ids, future):
+        feeds = get_feeds(feed_ids)
+        try:
+            if future.exception() is not None:
+                for feed in feeds:
+                    save_fetch_error(feed, writer)
+            result = future.result()
+            for feed in feeds:
+                save_fetch_result(feed, result, writer)
+        except:
+            db.session.rollback()
+            logger.warn('There was an error during polling %r', feeds, exc_info=True)
+        if writer.is_full:
+            commit_writer(writer)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting_hosts or timers or pending:
+            start_hosts()
+            while (timers and timers[0][0] <= time.time() and
+                   len(pending) < max_workers):
+                _, host = heapq.heappop(timers)
+                submit(executor, host)
+
+            # Ждём завершения какого-нибудь запроса, но не дольше, чем
+            # до срабатывания ближайшего таймера
+            timeout = None
+            if timers and len(pending) < max_workers:
+                timeout = max(timers[0][0] - time.time(), 0)
+            if not pending:
+                if timeout:
+                    time.sleep(timeout)
+                continue
+            done, _ = concurrent.futures.wait(
+                pending, timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                host, feed_ids = pending.pop(future)
+                if feed_ids is None:
+                    robots_txt = None
+                    if future.exception() is not None:
+                        logger.warn('Could not get robots.txt of %s: "%s".',
+                                    host, future.exception())
+                    else:
+                        robots_txt = future.result()
+                    rules[host] = parse_robots_rules(robots_txt, agent)
+                    if robots_txt is not None:
+                        save_robots_txt(robots_txt)
+                    heapq.heappush(timers, (time.time(), host))
+                    continue
+
+                save(feed_ids, future)
+                if feed_ids_queues[host]:
+                    # Уважаем Crawl-delay: следующий фид хоста будет
+                    # запрошен не раньше, чем истечёт задержка
+                    delay = (rules[host] and rules[host].delay) or default_delay
+                    heapq.heappush(timers, (time.time() + delay, host))
+                else:
+                    finish_host(host)
+    commit_writer(writer)
+
+
+def poll_hosts_threaded(feed_ids_by_hosts):
+    """Сохраняет элементы фидов `feed_ids_by_hosts` в БД, отдавая
+    каждый хост целиком одному потоку из пула (см. :func:`poll_feeds`).
+
+    :param feed_ids_by_hosts: см. :func:`get_feed_ids_by_hosts`
+    """
+    # Получаем правила robots.txt всех хостов
+    host_rules = load_robots_rules(
+        list(feed_ids_by_hosts), app.config['RSSTANK_AGENT'])
+
+    # Заводим пул потоков
+    max_workers = app.config['RSSTANK_POLL_WORKERS']
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_to_host = {}
         for host, feed_ids in feed_ids_by_hosts.iteritems():
             # Делегируем таск "обнови все фиды хоста" пулу потоков.
@@ -176,7 +1260,7 @@ def main():
             future = executor.submit(poll_feeds, feed_ids, rules=host_rules[host])
             future_to_host[future] = host
             logger.info('%i feeds for host %s has been enqueued for polling.',
-                        len(host_rules), host)
+                        len(feed_ids), host)
 
         for future in concurrent.futures.as_completed(future_to_host):
             host = future_to_host[future]
@@ -186,4 +1270,49 @@ def main():
             else:
                 logger.info('All feeds from %s have been successfully polled.', host)
 
+
+#: Способы опроса фидов, из которых можно выбрать при запуске
+#: ./manage.py poll_feeds --engine=<способ>
+ENGINES = {
+    'threads': poll_hosts_threaded,
+    'async': poll_hosts_async,
+}
+
+
+def main(engine='threads'):
+    """Обновляет содержимое всех фидов, относящихся ко включенным ключам.
+
+    :param engine: способ опроса фидов, один из ключей :data:`ENGINES`
+    """
+    if engine not in ENGINES:
+        raise ValueError('Unknown polling engine: {0!r}. Available engines: {1}.'
+                         .format(engine, ', '.join(sorted(ENGINES))))
+    logger.info('poll_feeds has started (engine: %s).', engine)
+
+    # Группируем идентификаторы фидов по хостам и опрашиваем хосты
+    # пачками: пачку хостов, которые не опрашиваются сейчас другими
+    # процессами, арендуем, опрашиваем и освобождаем
+    feed_ids_by_hosts = get_feed_ids_by_hosts()
+    hosts = list(feed_ids_by_hosts)
+    owner = get_lease_owner()
+    batch_size = app.config['RSSTANK_HOST_LEASE_BATCH_SIZE']
+    skipped_hosts_n = 0
+    for i in range(0, len(hosts), batch_size):
+        batch = hosts[i:i + batch_size]
+        leased_hosts = lease_hosts(batch, owner)
+        skipped_hosts_n += len(batch) - len(leased_hosts)
+        try:
+            # Пока хосты не были арендованы, их фиды мог опросить другой
+            # процесс, поэтому выбираем фиды, которые пора опросить, заново
+            leased_feed_ids_by_hosts = get_feed_ids_by_hosts(feed_ids=[
+                feed_id for host in leased_hosts for feed_id in feed_ids_by_hosts[host]])
+            if leased_feed_ids_by_hosts:
+                with renewing_hosts(owner):
+                    ENGINES[engine](leased_feed_ids_by_hosts)
+        finally:
+            release_hosts(owner)
+    if skipped_hosts_n:
+        logger.info('%i hosts are being polled by other processes, they have '
+                    'been skipped.', skipped_hosts_n)
+
     logger.info('poll_feeds has finished.')
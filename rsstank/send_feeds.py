@@ -1,62 +1,192 @@
 # coding: utf-8
+import collections
+import concurrent.futures
 import datetime as dt
 import logging
 
 import mailtank
-from .models import db, AccessKey, Feed, FeedItem
+from . import app, metrics
+from .models import db, seconds_between, AccessKey, Feed, FeedItem
 
 
 logger = logging.getLogger(__name__)
 
 
-def send_feed(feed):
-    """Создаёт рассылку, содержащую новые элементы из фида `feed`."""
+def build_mailing(feed):
+    """Возвращает аргументы :meth:`rsstank.models.MailtankClient.create_mailing`
+    для рассылки, содержащей новые элементы из фида `feed`, и число этих
+    элементов.
+
+    :rtype: ({str: object}, int)
+    """
     items_to_send = feed.items.order_by(FeedItem.pub_date.desc())
 
     if feed.last_sent_at:
         items_to_send = items_to_send.filter(
             FeedItem.created_at >= feed.last_sent_at)
 
+    # Элементы идут от новых к старым, так что из повторов остаётся
+    # самый свежий, а при превышении лимита отбрасываются самые старые
+    max_items = app.config['RSSTANK_MAX_ITEMS_PER_MAILING']
     unique_items = []
+    seen_guids = set()
     for item in items_to_send:
-        if not item.guid in [item_u.guid for item_u in unique_items]:
-            unique_items.append(item)
+        if item.guid in seen_guids:
+            continue
+        if len(unique_items) == max_items:
+            logger.warn('%r has more than %i items to send, the older ones '
+                        'are skipped.', feed, max_items)
+            break
+        seen_guids.add(item.guid)
+        unique_items.append(item)
 
     context_items = [item.to_context_entry() for item in reversed(unique_items)]
     assert context_items  # Потому что никто (никто!) не смеет посылать
                           # пустую рассылку
-    try:
-        feed.access_key.mailtank.create_mailing(
-            layout_id=feed.access_key.layout_id,
-            target={
-                'tags': [feed.tag],
-                'unsubscribe_tags': [feed.tag],
+    mailing = {
+        'layout_id': feed.access_key.layout_id,
+        'target': {
+            'tags': [feed.tag],
+            'unsubscribe_tags': [feed.tag],
+        },
+        'context': {
+            'channel': {
+                'link': feed.channel_link,
+                'description': feed.channel_description,
+                'title': feed.channel_title,
+                'image_url': feed.channel_image_url,
             },
-            context={
-                'channel': {
-                    'link': feed.channel_link,
-                    'description': feed.channel_description,
-                    'title': feed.channel_title,
-                    'image_url': feed.channel_image_url,
-                },
-                'items': context_items,
-            })
+            'items': context_items,
+        },
+    }
+    return mailing, len(unique_items)
+
+
+def send_feed(feed):
+    """Создаёт рассылку, содержащую новые элементы из фида `feed`."""
+    built_at = dt.datetime.utcnow()
+    mailing, items_n = build_mailing(feed)
+    try:
+        feed.access_key.mailtank.create_mailing(**mailing)
     except mailtank.MailtankError as e:
         logger.warn('Could not create mailing for %r. Mailtank API has '
                     'returned an error: %r.', feed, e)
     else:
-        feed.last_sent_at = dt.datetime.utcnow()
-        logger.info('%i items have been sent from %r.', len(unique_items), feed)
+        feed.last_sent_at = built_at
+        logger.info('%i items have been sent from %r.', items_n, feed)
+
+
+def get_feeds_to_send(utc_now=None):
+    """Возвращает запрос, выбирающий фиды включенных ключей, которые
+    пора посылать и в которых появились новые элементы -- то же, что
+    :meth:`Feed.is_it_time_to_send` и :meth:`Feed.are_there_items_to_send`,
+    но одним SQL-запросом для всех фидов.
+
+    :param utc_now: текущее время; по умолчанию `datetime.utcnow()`
+    """
+    if utc_now is None:
+        utc_now = dt.datetime.utcnow()
+
+    latest_items = db.session.query(
+        FeedItem.feed_id.label('feed_id'),
+        db.func.max(FeedItem.created_at).label('created_at'),
+    ).group_by(FeedItem.feed_id).subquery()
+
+    return Feed.query.join(AccessKey).filter_by(is_enabled=True) \
+        .join(latest_items, latest_items.c.feed_id == Feed.id) \
+        .filter(db.or_(
+            # Рассылка ни разу не посылалась, и текущее время попадает
+            # в интервал, когда допустимо впервые посылать фид
+            db.and_(
+                Feed.last_sent_at == None,
+                AccessKey.first_send_interval_start <= utc_now.time(),
+                AccessKey.first_send_interval_end >= utc_now.time()),
+            # С последней посылки прошло не меньше `sending_interval`
+            # и с тех пор появились новые элементы
+            db.and_(
+                latest_items.c.created_at > Feed.last_sent_at,
+                seconds_between(Feed.last_sent_at, utc_now) >= Feed.sending_interval),
+        )) \
+        .options(db.contains_eager(Feed.access_key))
+
+
+def create_mailing(client, **mailing):
+    """Создаёт рассылку через клиент Mailtank API `client`, замеряя время
+    запроса.
+    """
+    with metrics.timer('rsstank_mailtank_request_seconds', method='create_mailing'):
+        return client.create_mailing(**mailing)
+
+
+def send_feeds(feeds):
+    """Создаёт рассылки по фидам `feeds`, вызывая Mailtank API параллельно.
+
+    Запросы к API выполняются пулом из `RSSTANK_SEND_WORKERS` потоков,
+    причём по одному ключу выполняется не больше
+    `RSSTANK_SEND_WORKERS_PER_KEY` запросов одновременно. Рассылки
+    собираются и `last_sent_at` фидов записываются в вызывающем потоке.
+
+    :type feeds: список :class:`rsstank.models.Feed`
+    """
+    max_workers = app.config['RSSTANK_SEND_WORKERS']
+    max_workers_per_key = app.config['RSSTANK_SEND_WORKERS_PER_KEY']
+
+    feeds_by_keys = collections.defaultdict(collections.deque)
+    for feed in feeds:
+        feeds_by_keys[feed.access_key_id].append(feed)
+    running_by_keys = collections.Counter()
+    # future -> (фид, время сборки рассылки, число элементов в рассылке)
+    pending = {}
+
+    def submit_next(executor, key_id):
+        key_feeds = feeds_by_keys[key_id]
+        while key_feeds and running_by_keys[key_id] < max_workers_per_key:
+            feed = key_feeds.popleft()
+            built_at = dt.datetime.utcnow()
+            try:
+                mailing, items_n = build_mailing(feed)
+            except:
+                logger.warn('Could not build mailing for %r.', feed, exc_info=True)
+                continue
+            future = executor.submit(create_mailing, feed.access_key.mailtank, **mailing)
+            pending[future] = (feed, built_at, items_n)
+            running_by_keys[key_id] += 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for key_id in feeds_by_keys.keys():
+            submit_next(executor, key_id)
+
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                feed, built_at, items_n = pending.pop(future)
+                e = future.exception()
+                if e is not None:
+                    metrics.inc('rsstank_mailtank_errors_total',
+                                method='create_mailing', key=feed.access_key_id)
+                if isinstance(e, mailtank.MailtankError):
+                    logger.warn('Could not create mailing for %r. Mailtank API has '
+                                'returned an error: %r.', feed, e)
+                elif e is not None:
+                    logger.warn('Could not create mailing for %r: %r.', feed, e)
+                else:
+                    # Элементы, появившиеся после сборки рассылки, уйдут
+                    # в следующую
+                    feed.last_sent_at = built_at
+                    db.session.add(feed)
+                    db.session.commit()
+                    metrics.inc('rsstank_mailings_created_total')
+                    metrics.inc('rsstank_feed_items_sent_total', items_n)
+                    logger.info('%i items have been sent from %r.', items_n, feed)
+                running_by_keys[feed.access_key_id] -= 1
+                submit_next(executor, feed.access_key_id)
 
 
 def main():
     """Создаёт рассылки по всем фидам, относящимся ко включенным ключам."""
     logger.info('send_feeds has started.')
 
-    for feed in Feed.query.join(AccessKey).filter_by(is_enabled=True):
-        if feed.is_it_time_to_send() and feed.are_there_items_to_send():
-            send_feed(feed)
-            db.session.add(feed)
-            db.session.commit()
+    send_feeds(get_feeds_to_send().all())
 
     logger.info('send_feeds has finished.')
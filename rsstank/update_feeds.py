@@ -1,82 +1,227 @@
 # coding: utf-8
+import time
+import hashlib
 import logging
+import datetime as dt
+import concurrent.futures
 
-from .models import db, AccessKey, Feed
+from . import app, metrics
+from .models import db, AccessKey, Feed, FeedItem, get_tags
 from mailtank import MailtankError
 
 
 logger = logging.getLogger(__name__)
 
 
+def parse_tag(tag):
+    """Возвращает пару (интервал рассылки, адрес фида), заданную тегом
+    `tag` вида `rss:<пространство имён>:<адрес>:<интервал>`, или None,
+    если тег не описывает фид.
+    """
+    if ':' not in tag:
+        return None
+    head, rest = tag.split(':', 1)
+    if head != 'rss':
+        return None
+
+    try:
+        namespace, url_and_interval = rest.split(':', 1)
+        url, interval = url_and_interval.rsplit(':', 1)
+        try:
+            url = url.encode('ascii')
+        except UnicodeEncodeError as e:
+            logger.warn(u'Error during parsing tag: {0}. '
+                        u'URL is not ASCII.'.format(tag))
+            return None
+        interval = int(interval)
+    except ValueError as e:
+        # Плохой тег
+        logger.warn(u'Error "{0}" during parsing tag: {1}'.format(e, tag))
+        return None
+    return interval, url
+
+
+def get_tags_fingerprint(tags):
+    """Возвращает SHA-1 от множества тегов `tags` в виде hex-строки."""
+    fingerprint = hashlib.sha1()
+    for tag in sorted(set(tags)):
+        if isinstance(tag, unicode):
+            tag = tag.encode('utf-8')
+        fingerprint.update(tag)
+        fingerprint.update(b'\n')
+    return fingerprint.hexdigest()
+
+
+def is_sync_needed(tags, key, utc_now=None):
+    """Возвращает True, если теги `tags` ключа `key` изменились с прошлой
+    синхронизации или та была больше `RSSTANK_FULL_SYNC_INTERVAL` секунд
+    назад. Периодическая полная синхронизация исправляет фиды, изменённые
+    в обход update_feeds.
+    """
+    if not utc_now:
+        utc_now = dt.datetime.utcnow()
+    full_sync_interval = dt.timedelta(seconds=app.config['RSSTANK_FULL_SYNC_INTERVAL'])
+    return (key.tags_fingerprint != get_tags_fingerprint(tags) or
+            not key.tags_synced_at or
+            key.tags_synced_at + full_sync_interval <= utc_now)
+
+
 def sync(tags, key):
     """Синхронизирует фиды ключа `key` rsstank в соответствии с
     тегами `tags` Mailtank.
 
+    Фиды сопоставляются тегам по паре (интервал, адрес); недостающие
+    фиды добавляются, а лишние удаляются вместе с элементами, каждое --
+    одним запросом.
+
     :type tags: список строк
     """
-    feeds = key.feeds.all()
-    # Строим словарь из фидов с ключом 'интервал:адрес'
-    feeds_by_url = \
-        {u'{0}:{1}'.format(feed.sending_interval, feed.url): feed for feed in feeds}
+    # Ключ мог быть ещё не сохранён
+    db.session.add(key)
+    db.session.flush()
 
+    # (интервал, адрес) -> тег
+    tags_by_urls = {}
     for tag in tags:
-        if ':' not in tag:
-            continue
-        head, rest = tag.split(':', 1)
-        if head != 'rss':
-            continue
+        interval_and_url = parse_tag(tag)
+        if interval_and_url:
+            tags_by_urls.setdefault(interval_and_url, tag)
 
-        try:
-            # Парсим тег
-            namespace, url_and_interval = rest.split(':', 1)
-            url, interval = url_and_interval.rsplit(':', 1)
-            try:
-                url = url.encode('ascii')
-            except UnicodeEncodeError as e:
-                logger.warn(u'Error during parsing tag: {0}. '
-                            u'URL is not ASCII.'.format(tag))
-                continue
-            interval = int(interval)
-        except ValueError as e:
-            # Плохой тег
-            logger.warn(u'Error "{0}" during parsing tag: {1}'.format(e, tag))
-        else:
-            # Ищем, есть ли фид для этого тега, если нет то создаем
-            feed = feeds_by_url.get(u'{0}:{1}'.format(interval, url))
-            if feed:
-                feeds.remove(feed)
-            else:
-                db.session.add(
-                    Feed(access_key=key, sending_interval=interval, url=url, tag=tag))
-            logger.info(u'Tag {} synced'.format(tag))
+    # (интервал, адрес) -> идентификатор фида
+    feed_ids_by_urls = dict(
+        ((interval, url), feed_id) for feed_id, interval, url in
+        db.session.query(Feed.id, Feed.sending_interval, Feed.url)
+                  .filter(Feed.access_key_id == key.id))
+
+    new_urls = set(tags_by_urls) - set(feed_ids_by_urls)
+    if new_urls:
+        db.session.execute(Feed.__table__.insert(), [
+            {'access_key_id': key.id, 'sending_interval': interval,
+             'url': url, 'tag': tags_by_urls[interval, url]}
+            for interval, url in new_urls])
 
-    for feed in feeds:
-        # Удаляем фиды, для которых не было тега
-        db.session.delete(feed)
+    # Удаляем фиды, для которых не было тега
+    stale_feed_ids = [feed_id for interval_and_url, feed_id
+                      in feed_ids_by_urls.iteritems()
+                      if interval_and_url not in tags_by_urls]
+    if stale_feed_ids:
+        db.session.execute(FeedItem.__table__.delete().where(
+            FeedItem.__table__.c.feed_id.in_(stale_feed_ids)))
+        db.session.execute(Feed.__table__.delete().where(
+            Feed.__table__.c.id.in_(stale_feed_ids)))
 
+    metrics.inc('rsstank_feeds_added_total', len(new_urls))
+    metrics.inc('rsstank_feeds_deleted_total', len(stale_feed_ids))
+    key.tags_fingerprint = get_tags_fingerprint(tags)
+    key.tags_synced_at = dt.datetime.utcnow()
     db.session.commit()
+    logger.info(u'Tags of key {0} synced: {1} feeds added, {2} deleted'
+                .format(key.content, len(new_urls), len(stale_feed_ids)))
+
+
+def fetch_tags(keys):
+    """Запрашивает теги пространств имён ключей `keys` параллельно.
+
+    Запросы выполняются пулом из `RSSTANK_UPDATE_WORKERS` потоков. Если
+    запрос тегов ключа выполняется дольше `RSSTANK_UPDATE_KEY_TIMEOUT`
+    секунд, его результат больше не ждут: для ключа возвращается
+    :class:`concurrent.futures.TimeoutError`. То же возвращается для всех
+    ключей, тегов которых не дождались за `RSSTANK_UPDATE_TIMEOUT` секунд,
+    -- например, потому что все потоки заняты зависшими запросами.
+
+    Прервать поток нельзя, а при выходе из процесса потоки пула
+    дожидаются, поэтому сами запросы ограничены таймаутами сокета (см.
+    `MAILTANK_CONNECT_TIMEOUT` и `MAILTANK_READ_TIMEOUT`).
+
+    Возвращает генератор троек (ключ, список тегов, исключение) в порядке
+    получения ответов; из тегов и исключения задано что-то одно.
+
+    :type keys: список :class:`rsstank.models.AccessKey`
+    """
+    timeout = app.config['RSSTANK_UPDATE_KEY_TIMEOUT']
+    deadline = time.time() + app.config['RSSTANK_UPDATE_TIMEOUT']
+    # Ключ -> время начала запроса его тегов (не постановки в очередь)
+    started_at = {}
+
+    def fetch(key, key_content, mask):
+        # Сами ключи в потоках не трогаем: они привязаны к сессии
+        # вызывающего потока
+        started_at[key] = time.time()
+        return [tag.name for tag in get_tags(key_content, mask=mask)]
+
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=app.config['RSSTANK_UPDATE_WORKERS'])
+    pending = {}
+    for key in keys:
+        mask = u'rss:{}:'.format(key.namespace)
+        pending[executor.submit(fetch, key, key.content, mask)] = key
+
+    try:
+        while pending:
+            now = time.time()
+            # Ключи, запрос которых ещё не начался, не истекут раньше, чем
+            # через `timeout`
+            deadlines = [started_at[key] + timeout if key in started_at else now + timeout
+                         for key in pending.values()]
+            deadlines.append(deadline)
+            done, _ = concurrent.futures.wait(
+                pending, timeout=max(min(deadlines) - now, 0),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                e = future.exception()
+                yield key, None if e else future.result(), e
+
+            now = time.time()
+            for future, key in list(pending.items()):
+                if future.done():
+                    continue
+                if now >= deadline:
+                    # Запросы, до которых очередь так и не дошла, отменяем
+                    future.cancel()
+                    del pending[future]
+                    yield key, None, concurrent.futures.TimeoutError(
+                        'no response in {0} seconds since update has started'
+                        .format(app.config['RSSTANK_UPDATE_TIMEOUT']))
+                elif key in started_at and started_at[key] + timeout <= now:
+                    # Прервать поток нельзя, поэтому просто бросаем запрос
+                    del pending[future]
+                    yield key, None, concurrent.futures.TimeoutError(
+                        'no response in {0} seconds'.format(timeout))
+    finally:
+        # Не ждём зависших запросов и не начинаем тех, что в очереди
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
 
 
 def main():
     """Обновляет фиды в соответствии с тегами проекта в Mailtank."""
     logger.info('update_feeds has started.')
 
-    keys = AccessKey.query.filter_by(is_enabled=True)
+    keys = AccessKey.query.filter_by(is_enabled=True).all()
 
-    for key in keys:
-        mask = u'rss:{}:'.format(key.namespace)
-        try:
-            tags = [tag.name for tag in key.mailtank.get_tags(mask=mask)]
-        except MailtankError as e:
+    for key, tags, e in fetch_tags(keys):
+        if e is not None:
+            metrics.inc('rsstank_mailtank_errors_total', method='get_tags', key=key.id)
+        if isinstance(e, MailtankError):
             logger.warn(u'Error during connecting with key {0}: "{1}"'
                         .format(key.content, e))
             if e.code in (401, 403):
                 key.is_enabled = False
                 db.session.add(key)
                 db.session.commit()
+        elif e is not None:
+            logger.warn(u'Could not fetch tags for key {0}: {1!r}'
+                        .format(key.content, e))
         else:
             logger.info(u'Tags for key {} have been successfully fetched'
                         .format(key.content))
-            sync(tags, key)
+            if is_sync_needed(tags, key):
+                with metrics.timer('rsstank_sync_seconds'):
+                    sync(tags, key)
+            else:
+                metrics.inc('rsstank_syncs_skipped_total')
+                logger.info(u'Tags for key {} have not changed'.format(key.content))
 
     logger.info('update_feeds has finished.')
@@ -2,6 +2,7 @@
 import datetime as dt
 
 import mock
+import pytest
 
 from . import TestCase, fixtures
 from rsstank import cleanup, db
@@ -48,6 +49,35 @@ class TestCleanup(TestCase):
         cleanup.delete_sent_feed_items(feed)
         assert FeedItem.query.count() == 1
 
+    def test_delete_sent_feed_items_keeps_last_published(self):
+        feed = fixtures.create_feed('http://feed.url', self.access_key)
+        items = [fixtures.create_feed_item(i) for i in range(3)]
+        feed.items.extend(items)
+        feed.last_pub_date = items[0].pub_date
+        feed.last_sent_at = dt.datetime.utcnow() + dt.timedelta(hours=1)
+        db.session.add(feed)
+        db.session.commit()
+
+        # Элемент, опубликованный последним, нужен для отсеивания повторов
+        # при следующем опросе фида
+        cleanup.delete_sent_feed_items(feed)
+        assert [item.guid for item in FeedItem.query] == [items[0].guid]
+
+    def test_delete_sent_feed_items_in_batches(self):
+        feed = fixtures.create_feed('http://feed.url', self.access_key)
+        feed.items.extend([fixtures.create_feed_item(i) for i in range(5)])
+        feed.last_sent_at = dt.datetime.utcnow() + dt.timedelta(hours=1)
+        db.session.add(feed)
+        db.session.commit()
+
+        with mock.patch.dict(self.app.config, {'RSSTANK_CLEANUP_BATCH_SIZE': 2}):
+            with mock.patch('time.sleep') as sleep_mock:
+                assert cleanup.delete_sent_feed_items(feed) == 5
+
+        # Три пачки (2 + 2 + 1) и паузы между ними
+        assert sleep_mock.call_count == 2
+        assert FeedItem.query.count() == 0
+
     def test_main(self):
         db.session.add(fixtures.create_feed('asdfasd', self.access_key))
         db.session.add(fixtures.create_feed('wert', self.access_key))
@@ -58,3 +88,73 @@ class TestCleanup(TestCase):
                         autospec=True) as delete_mock:
             cleanup.main()
             assert delete_mock.call_count == 2
+
+    def test_has_unsent_feed_items(self):
+        sent_at = dt.datetime(2013, 11, 21, 12, 0, 0)
+        feed = fixtures.create_feed('http://feed.url', self.access_key)
+        feed.last_sent_at = sent_at
+        item = fixtures.create_feed_item(1)
+        item.created_at = sent_at + dt.timedelta(hours=1)
+        feed.items.append(item)
+        db.session.add(feed)
+        db.session.commit()
+
+        day = dt.timedelta(days=1)
+        assert not cleanup.has_unsent_feed_items(sent_at - day, sent_at)
+        assert not cleanup.has_unsent_feed_items(None, sent_at)
+        assert cleanup.has_unsent_feed_items(sent_at, sent_at + day)
+
+    def test_drop_sent_feed_item_partitions(self):
+        utc_now = dt.datetime(2013, 11, 21, 12, 0, 0)
+        partitions = [
+            ('p20131019', dt.datetime(2013, 10, 20)),
+            ('p20131119', dt.datetime(2013, 11, 20)),
+            ('p20131120', dt.datetime(2013, 11, 21)),
+            ('p20131121', dt.datetime(2013, 11, 22)),
+            ('pmax', None),
+        ]
+        unsent_bounds = set([dt.datetime(2013, 10, 20), dt.datetime(2013, 11, 21)])
+
+        def has_unsent_feed_items(lower_bound, upper_bound):
+            return upper_bound in unsent_bounds
+
+        with mock.patch('rsstank.cleanup.has_unsent_feed_items',
+                        side_effect=has_unsent_feed_items):
+            with mock.patch.object(db.session, 'execute') as execute_mock:
+                assert cleanup.drop_sent_feed_item_partitions(
+                    partitions, utc_now=utc_now) == 2
+
+        # Удаляются разосланные и слишком старые секции, но не текущая
+        statements = [args[0] for args, kwargs in execute_mock.call_args_list]
+        assert statements == [
+            'ALTER TABLE feed_item DROP PARTITION p20131019',
+            'ALTER TABLE feed_item DROP PARTITION p20131119',
+        ]
+
+    def test_rotate_feed_item_partitions(self):
+        if db.engine.dialect.name != 'mysql':
+            pytest.skip('feed_item is partitioned only on MySQL')
+        utc_now = dt.datetime(2013, 11, 21, 12, 0, 0)
+        feed = fixtures.create_feed('http://feed.url', self.access_key)
+        feed.last_sent_at = utc_now - dt.timedelta(days=1)
+        for i, days in enumerate([3, 2, 0]):
+            item = fixtures.create_feed_item(i)
+            item.created_at = utc_now - dt.timedelta(days=days)
+            feed.items.append(item)
+        db.session.add(feed)
+        db.session.commit()
+
+        with mock.patch.dict(self.app.config,
+                             {'RSSTANK_FEED_ITEM_PARTITIONS_AHEAD': 2}):
+            cleanup.rotate_feed_item_partitions(utc_now=utc_now)
+            # Повторный запуск ничего не меняет
+            cleanup.rotate_feed_item_partitions(utc_now=utc_now)
+            names = [name for name, _ in cleanup.get_feed_item_partitions()]
+            assert names == ['p20131121', 'p20131122', 'p20131123', 'pmax']
+            assert FeedItem.query.count() == 1
+
+            cleanup.rotate_feed_item_partitions(
+                utc_now=utc_now + dt.timedelta(days=1))
+            names = [name for name, _ in cleanup.get_feed_item_partitions()]
+            assert names == ['p20131121', 'p20131122', 'p20131123',
+                             'p20131124', 'pmax']
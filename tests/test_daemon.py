@@ -0,0 +1,75 @@
+# coding: utf-8
+import time
+import threading
+import collections
+
+import mock
+import pytest
+
+from . import TestCase
+from rsstank import daemon
+
+
+class TestDaemon(TestCase):
+    """Тесты внутренностей ./manage.py daemon"""
+
+    def test_get_jobs(self):
+        intervals = {'poll_feeds': 60, 'cleanup': 3600}
+        with mock.patch.dict(self.app.config, {'RSSTANK_DAEMON_INTERVALS': intervals}):
+            jobs = daemon.get_jobs()
+        assert set(jobs) == {'poll_feeds', 'cleanup'}
+        assert jobs['cleanup'] == (daemon.cleanup.main, 3600)
+        function, interval = jobs['poll_feeds']
+        assert interval == 60
+        assert function.keywords == {
+            'engine': self.app.config['RSSTANK_DAEMON_POLL_ENGINE']}
+
+    def test_get_jobs_checks_intervals(self):
+        # Пустые, неизвестные задачи и неположительные интервалы -- ошибки
+        # настройки, о которых нужно сообщить сразу
+        for intervals in ({}, None, {'poll_feed': 60}, {'cleanup': 0}):
+            with mock.patch.dict(self.app.config,
+                                 {'RSSTANK_DAEMON_INTERVALS': intervals}):
+                with pytest.raises(ValueError):
+                    daemon.get_jobs()
+
+    def test_run(self):
+        lock = threading.Lock()
+        calls = collections.Counter()
+        running = collections.Counter()
+        overlaps = []
+
+        def make_job(name, duration):
+            def job():
+                with lock:
+                    calls[name] += 1
+                    running[name] += 1
+                    if running[name] > 1:
+                        overlaps.append(name)
+                time.sleep(duration)
+                with lock:
+                    running[name] -= 1
+                if name == 'failing':
+                    raise Exception('Whoops')
+            return job
+
+        jobs = {
+            # Быстрая задача запускается каждые 0.1 секунды
+            'fast': (make_job('fast', 0.01), 0.1),
+            # Медленная выполняется дольше своего интервала
+            'slow': (make_job('slow', 0.25), 0.1),
+            'failing': (make_job('failing', 0), 0.1),
+        }
+        stop = threading.Event()
+        threading.Timer(0.55, stop.set).start()
+        daemon.run(jobs, stop)
+
+        assert 5 <= calls['fast'] <= 7
+        # Ошибка задачи не останавливает её расписание
+        assert 5 <= calls['failing'] <= 7
+        # Запуски медленной задачи пропускались, пока она выполнялась,
+        # и никакая задача не выполнялась дважды одновременно
+        assert 2 <= calls['slow'] <= 3
+        assert not overlaps
+        # run дожидается выполняющихся задач
+        assert not any(running.values())
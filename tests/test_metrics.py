@@ -0,0 +1,87 @@
+# coding: utf-8
+import httpretty
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from . import TestCase, fixtures
+from rsstank import metrics, poll_feeds
+from rsstank.models import db, AccessKey
+
+
+class TestMetrics(TestCase):
+    """Тесты rsstank.metrics"""
+
+    def setup_method(self, method):
+        TestCase.setup_method(self, method)
+        metrics.reset()
+
+    def test_render_prometheus(self):
+        metrics.inc('rsstank_test_total', host='66.ru')
+        metrics.inc('rsstank_test_total', 2, host='66.ru')
+        metrics.inc('rsstank_test_total', host='a"b')
+        metrics.set_gauge('rsstank_test_gauge', 1.5)
+        metrics.observe('rsstank_test_seconds', 0.3)
+        metrics.observe('rsstank_test_seconds', 100)
+
+        lines = metrics.render_prometheus().splitlines()
+        assert '# TYPE rsstank_test_total counter' in lines
+        assert 'rsstank_test_total{host="66.ru"} 3' in lines
+        assert 'rsstank_test_total{host="a\\"b"} 1' in lines
+        assert 'rsstank_test_gauge 1.5' in lines
+        assert '# TYPE rsstank_test_seconds histogram' in lines
+        # Корзины накопительные
+        assert 'rsstank_test_seconds_bucket{le="0.25"} 0' in lines
+        assert 'rsstank_test_seconds_bucket{le="0.5"} 1' in lines
+        assert 'rsstank_test_seconds_bucket{le="60"} 1' in lines
+        assert 'rsstank_test_seconds_bucket{le="+Inf"} 2' in lines
+        assert 'rsstank_test_seconds_sum 100.3' in lines
+        assert 'rsstank_test_seconds_count 2' in lines
+
+        summary = metrics.format_summary().splitlines()
+        assert 'rsstank_test_total: 4' in summary
+        assert 'rsstank_test_seconds: 2 in 100.300s (avg 50.150s)' in summary
+
+        assert metrics.get_total('rsstank_test_total') == 4
+        assert metrics.get_total('rsstank_test_total', host='66.ru') == 3
+        assert metrics.get_total('rsstank_test_total', host='66.ru', x=1) == 0
+        assert metrics.get_histogram('rsstank_test_seconds') == (2, 100.3)
+        # Половина наблюдений -- в корзине (0.25, 0.5]
+        assert metrics.quantile('rsstank_test_seconds', 0.5) == 0.5
+        assert metrics.quantile('rsstank_test_seconds', 0.25) == 0.375
+        assert metrics.quantile('rsstank_test_seconds', 0.99) == 60
+        metrics.observe('rsstank_test_seconds', 0.01, host='66.ru')
+        assert metrics.get_histogram('rsstank_test_seconds', host='66.ru') == (1, 0.01)
+        assert metrics.quantile('rsstank_test_seconds', 0.5, host='66.ru') == 0.0075
+
+        metrics.reset()
+        assert metrics.render_prometheus() == '\n'
+        assert metrics.quantile('rsstank_test_seconds', 0.5) is None
+
+    @httpretty.httprettified
+    def test_poll_feed_metrics(self):
+        access_key = AccessKey(content='123', is_enabled=True, namespace='test')
+        feed = fixtures.create_feed('http://66.ru/news/society/rss/', access_key)
+        db.session.add(feed)
+        db.session.commit()
+        with open('./tests/fixtures/66.ru-society-rss') as fh:
+            rss_data = fh.read()
+        httpretty.register_uri(httpretty.GET, feed.url, body=rss_data)
+
+        poll_feeds.poll_feed(feed)
+        db.session.commit()
+
+        client = Client(metrics.wsgi_app, Response)
+        response = client.get('/metrics')
+        assert response.mimetype == 'text/plain'
+        lines = response.data.splitlines()
+        assert 'rsstank_fetch_responses_total{status="200"} 1' in lines
+        assert 'rsstank_downloaded_bytes_total{{host="66.ru"}} {0}'.format(
+            len(rss_data)) in lines
+        assert 'rsstank_feed_items_inserted_total {0}'.format(
+            feed.items.count()) in lines
+        assert 'rsstank_fetch_seconds_count 1' in lines
+        assert 'rsstank_parse_seconds_count 1' in lines
+
+        # Кроме метрик, приложение ничего не отдаёт
+        assert client.get('/').status_code == 404
+        assert client.post('/metrics').status_code == 404
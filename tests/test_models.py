@@ -0,0 +1,141 @@
+# coding: utf-8
+import json
+import datetime as dt
+
+import mock
+import httpretty
+
+from . import TestCase, fixtures
+from rsstank import models
+from rsstank.models import db, AccessKey, FeedItem
+
+
+def explain(query):
+    """Возвращает план выполнения запроса `query` одной строкой."""
+    statement = getattr(query, 'statement', query)
+    compiled = statement.compile(dialect=db.engine.dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    connection = db.session.connection()
+    if db.engine.dialect.name == 'sqlite':
+        rows = connection.execute('EXPLAIN QUERY PLAN ' + unicode(compiled), params)
+        return u' '.join(row['detail'] for row in rows)
+    # В possible_keys перечислены все подходящие индексы, поэтому
+    # смотрим только на использованный (key) и на пояснения (Extra)
+    rows = connection.execute('EXPLAIN ' + unicode(compiled), params)
+    return u' '.join(u'{0} {1}'.format(row['key'], row['Extra']) for row in rows)
+
+
+class TestFeedItemIndexes(TestCase):
+    """Проверяет, что частые запросы к элементам фидов используют индексы."""
+
+    def setup_method(self, method):
+        TestCase.setup_method(self, method)
+        access_key = AccessKey(content='123', is_enabled=True, namespace='test')
+        created_at = dt.datetime(2013, 11, 21, 12, 0, 0)
+        self.feeds = []
+        for i in range(10):
+            feed = fixtures.create_feed('http://66.ru/{0}.rss'.format(i), access_key)
+            for j in range(20):
+                item = fixtures.create_feed_item(j)
+                item.created_at = created_at + dt.timedelta(hours=j)
+                feed.items.append(item)
+            db.session.add(feed)
+            self.feeds.append(feed)
+        db.session.commit()
+        if db.engine.dialect.name == 'mysql':
+            db.session.execute('ANALYZE TABLE feed_item')
+        self.feed = self.feeds[0]
+        self.last_sent_at = created_at + dt.timedelta(hours=10)
+
+    def assert_uses_index(self, query, *index_names):
+        plan = explain(query)
+        # MySQL вычисляет MIN/MAX по индексу, не показывая его в плане
+        assert (any(name in plan for name in index_names) or
+                'optimized away' in plan), plan
+
+    def test_latest_created_at(self):
+        # Feed.are_there_items_to_send
+        query = self.feed.items.with_entities(db.func.max(FeedItem.created_at))
+        self.assert_uses_index(query, 'ix_feed_item_feed_id_created_at')
+
+    def test_items_to_send(self):
+        # send_feeds.build_mailing
+        query = self.feed.items.order_by(FeedItem.pub_date.desc()) \
+            .filter(FeedItem.created_at >= self.last_sent_at)
+        self.assert_uses_index(query, 'ix_feed_item_feed_id_created_at',
+                               'ix_feed_item_feed_id_pub_date')
+
+    def test_sent_items(self):
+        # cleanup.delete_sent_feed_items
+        table = FeedItem.__table__
+        query = db.select([table.c.id]).where(db.and_(
+            table.c.feed_id == self.feed.id,
+            table.c.created_at < self.last_sent_at,
+            db.or_(table.c.pub_date == None,
+                   table.c.pub_date < dt.datetime(2013, 11, 20, 12, 0, 0))))
+        self.assert_uses_index(query, 'ix_feed_item_feed_id_created_at',
+                               'ix_feed_item_feed_id_pub_date')
+
+
+class TestAccessKey(TestCase):
+    """Тесты rsstank.models.AccessKey"""
+
+    def test_is_enabled_expression(self):
+        enabled_key = AccessKey(content='1', is_enabled=True, namespace='a')
+        disabled_key = AccessKey(content='2', is_enabled=False, namespace='b')
+        db.session.add_all([enabled_key, disabled_key])
+        db.session.commit()
+
+        assert AccessKey.query.filter_by(is_enabled=True).all() == [enabled_key]
+        assert AccessKey.query.filter_by(is_enabled=False).all() == [disabled_key]
+        assert AccessKey.query.filter(AccessKey.is_enabled).all() == [enabled_key]
+
+    @httpretty.httprettified
+    def test_mailtank_clients_share_session(self):
+        api_url = self.app.config['MAILTANK_API_URL']
+        httpretty.register_uri(
+            httpretty.GET, '{}/tags/'.format(api_url),
+            body=json.dumps({'objects': [{'name': 'rss:a:http://go.rss/feed:100'}],
+                             'page': 1, 'pages_total': 1}))
+        httpretty.register_uri(
+            httpretty.POST, '{}/mailings/'.format(api_url),
+            body=json.dumps({'id': 1, 'status': 'ENQUEUED'}))
+
+        a_key = AccessKey(content='one', namespace='a')
+        b_key = AccessKey(content='two', namespace='b')
+        # Клиенты разных ключей ходят в API через одну сессию
+        assert a_key.mailtank.session is b_key.mailtank.session
+        session = a_key.mailtank.session
+
+        with mock.patch.object(session, 'request', wraps=session.request) as request_mock:
+            assert [tag.name for tag in a_key.get_tags(mask='rss:a:')] == \
+                ['rss:a:http://go.rss/feed:100']
+            assert httpretty.last_request().headers['X-Auth-Token'] == 'one'
+            mailing = b_key.mailtank.create_mailing(
+                layout_id='layout', context={'items': []}, target={'tags': ['a']})
+            assert mailing.id == 1
+            assert httpretty.last_request().headers['X-Auth-Token'] == 'two'
+
+        assert request_mock.call_count == 2
+        timeout = (self.app.config['MAILTANK_CONNECT_TIMEOUT'],
+                   self.app.config['MAILTANK_READ_TIMEOUT'])
+        for _, kwargs in request_mock.call_args_list:
+            assert kwargs['timeout'] == timeout
+
+    def test_mailtank_clients_cache_is_limited(self):
+        keys = [AccessKey(content=str(i), namespace='') for i in range(4)]
+        with mock.patch.dict(self.app.config, MAILTANK_CLIENTS_CACHE_SIZE=2):
+            client = keys[0].mailtank
+            assert keys[0].mailtank is client
+            keys[1].mailtank
+            # Недавно использованный клиент остаётся в кеше, а вытесняется
+            # дольше всех не использовавшийся
+            keys[0].mailtank
+            keys[2].mailtank
+            assert len(models._mailtank_clients) == 2
+            assert keys[0].mailtank is client
+            assert [cache_key[1] for cache_key in models._mailtank_clients] == ['2', '0']
+            for key in keys:
+                key.mailtank
+            assert len(models._mailtank_clients) == 2
+            assert keys[0].mailtank is not client
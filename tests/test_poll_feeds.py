@@ -1,16 +1,18 @@
 # coding: utf-8
+import threading
 import datetime as dt
 import collections
 
 import mock
+import pytest
 import httpretty
 import feedparser
 import requests
 from furl import furl
 
 from . import TestCase, fixtures
-from rsstank import poll_feeds
-from rsstank.models import db, AccessKey, Feed, FeedItem
+from rsstank import poll_feeds, cleanup
+from rsstank.models import db, AccessKey, Feed, FeedItem, RobotsTxt, HostLease
 
 
 ROBOTS_TXT_1 = """
@@ -60,6 +62,45 @@ class TestPollFeeds(TestCase):
         assert rules.allowed('/a/c/')
         assert not rules.allowed('/a/b/c/')
 
+    @httpretty.httprettified
+    def test_load_robots_rules(self):
+        httpretty.register_uri(
+            httpretty.GET, 'http://66.ru/robots.txt', body=ROBOTS_TXT_1,
+            cache_control='max-age=7200')
+        httpretty.register_uri(
+            httpretty.GET, 'http://news.yandex.ru/robots.txt', body='', status=503)
+
+        hosts = ['66.ru', 'news.yandex.ru']
+        rules = poll_feeds.load_robots_rules(hosts, 'Chrome')
+        assert rules['66.ru'].delay == 2
+        # Правила хоста, ответившего 5xx, неизвестны
+        assert rules['news.yandex.ru'] is None
+
+        # robots.txt сохранены в БД со сроком годности из Cache-Control
+        robots_txt = RobotsTxt.query.get('66.ru')
+        assert robots_txt.status_code == 200
+        expires_in = robots_txt.expires_at - robots_txt.fetched_at
+        assert expires_in == dt.timedelta(seconds=7200)
+        assert RobotsTxt.query.get('news.yandex.ru').status_code == 503
+
+        # Пока срок годности не истёк, robots.txt не перезапрашивается
+        httpretty.reset()
+        httpretty.register_uri(
+            httpretty.GET, 'http://66.ru/robots.txt', body=ROBOTS_TXT_2)
+        rules = poll_feeds.load_robots_rules(hosts, 'Chrome')
+        assert rules['66.ru'].delay == 2
+
+        # А после -- перезапрашивается
+        robots_txt = RobotsTxt.query.get('66.ru')
+        robots_txt.expires_at = dt.datetime.utcnow() - dt.timedelta(seconds=1)
+        db.session.commit()
+        rules = poll_feeds.load_robots_rules(hosts, 'Chrome')
+        assert rules['66.ru'].delay == 3
+        robots_txt = RobotsTxt.query.get('66.ru')
+        expires_in = robots_txt.expires_at - robots_txt.fetched_at
+        assert expires_in == dt.timedelta(
+            seconds=self.app.config['RSSTANK_ROBOTS_TXT_TTL'])
+
     def test_get_feed_ids_by_hosts(self):
         for feed_url in ('http://66.ru/news/society/rss/',
                          'http://66.ru/news/business/rss/',
@@ -82,17 +123,108 @@ class TestPollFeeds(TestCase):
             db.session.add(feed)
         db.session.commit()
 
+        # И фид, который опрашивать ещё рано
+        feed = fixtures.create_feed('http://66.ru/news/sport/rss/', self.access_key)
+        feed.next_poll_at = dt.datetime.utcnow() + dt.timedelta(hours=1)
+        db.session.add(feed)
+        db.session.commit()
+
         feed_ids_by_hosts = poll_feeds.get_feed_ids_by_hosts()
 
         def get_feeds(host):
             return [feed.id for feed in Feed.query.filter(
                 Feed.url.contains('http://{}'.format(host))
-            ) if feed.access_key.is_enabled]
+            ) if feed.access_key.is_enabled and not feed.next_poll_at]
         assert set(feed_ids_by_hosts['66.ru']) == \
             set(get_feeds('66.ru'))
         assert set(feed_ids_by_hosts['news.yandex.ru']) == \
             set(get_feeds('news.yandex.ru'))
 
+    def test_lease_hosts(self):
+        utc_now = dt.datetime(2013, 11, 20, 12, 0, 0)
+        lease_time = dt.timedelta(seconds=self.app.config['RSSTANK_HOST_LEASE_TIME'])
+
+        assert poll_feeds.lease_hosts(['66.ru', 'lenta.ru'], 'a', utc_now=utc_now) == \
+            {'66.ru', 'lenta.ru'}
+        # Хосты, арендованные одним процессом, другому не достаются
+        assert poll_feeds.lease_hosts(['lenta.ru', 'news.yandex.ru'], 'b',
+                                      utc_now=utc_now) == {'news.yandex.ru'}
+        assert HostLease.query.get('lenta.ru').owner == 'a'
+        assert HostLease.query.get('lenta.ru').expires_at == utc_now + lease_time
+
+        # ...пока аренда не освобождена
+        poll_feeds.release_hosts('a')
+        assert poll_feeds.lease_hosts(['lenta.ru'], 'b', utc_now=utc_now) == \
+            {'lenta.ru'}
+        assert HostLease.query.get('66.ru').owner is None
+
+        # ...или не истекла
+        utc_now += lease_time + dt.timedelta(seconds=1)
+        assert poll_feeds.lease_hosts(['lenta.ru', 'news.yandex.ru'], 'c',
+                                      utc_now=utc_now) == \
+            {'lenta.ru', 'news.yandex.ru'}
+
+        # Продлевается аренда только хостов владельца
+        poll_feeds.renew_hosts('c', utc_now=utc_now + lease_time)
+        assert HostLease.query.get('lenta.ru').expires_at == utc_now + 2 * lease_time
+        assert HostLease.query.get('66.ru').owner is None
+
+    def test_main_leases_hosts_in_batches(self):
+        for feed_url in ('http://66.ru/news/society/rss/',
+                         'http://66.ru/news/business/rss/',
+                         'http://news.yandex.ru/hardware.rss',
+                         'http://lenta.ru/rss/articles/russia'):
+            db.session.add(fixtures.create_feed(feed_url, self.access_key))
+        db.session.commit()
+
+        calls = []
+
+        def poll_hosts(feed_ids_by_hosts):
+            leases = dict((lease.host, lease) for lease in HostLease.query)
+            calls.append((dict(feed_ids_by_hosts), set(
+                host for host, lease in leases.iteritems() if lease.owner)))
+            # Пока опрашивается первая пачка, другой процесс опросил фид
+            # из следующей
+            for feed in Feed.query:
+                if furl(feed.url).host not in feed_ids_by_hosts:
+                    feed.next_poll_at = dt.datetime.utcnow() + dt.timedelta(hours=1)
+                    db.session.commit()
+                    break
+            # Аренда хостов продлевается, пока они опрашиваются
+            expires_at = leases[next(iter(feed_ids_by_hosts))].expires_at
+            renewed.clear()
+            assert renewed.wait(10)
+            db.session.expire_all()
+            assert HostLease.query.get(next(iter(feed_ids_by_hosts))).expires_at > \
+                expires_at
+
+        renewed = threading.Event()
+        real_renew_hosts = poll_feeds.renew_hosts
+
+        def renew_hosts(owner, utc_now=None):
+            # Продлеваем аренду как будто час спустя, чтобы срок её истечения
+            # заметно изменился и в БД, хранящей время с точностью до секунды
+            real_renew_hosts(owner, utc_now=dt.datetime.utcnow() + dt.timedelta(hours=1))
+            renewed.set()
+
+        with mock.patch.dict(self.app.config, {'RSSTANK_HOST_LEASE_BATCH_SIZE': 2,
+                                               'RSSTANK_HOST_LEASE_TIME': 3}):
+            with mock.patch.dict(poll_feeds.ENGINES, {'threads': poll_hosts}), \
+                    mock.patch('rsstank.poll_feeds.renew_hosts', side_effect=renew_hosts):
+                poll_feeds.main()
+
+        # Три хоста -- две пачки; арендована в каждый момент только
+        # опрашиваемая пачка
+        assert len(calls[0][0]) == 2
+        for feed_ids_by_hosts, leased_hosts in calls:
+            assert set(feed_ids_by_hosts) == leased_hosts
+        polled_feed_ids = [feed_id for feed_ids_by_hosts, _ in calls
+                           for feed_ids in feed_ids_by_hosts.itervalues()
+                           for feed_id in feed_ids]
+        # Фид, опрошенный другим процессом, заново не опрашивается
+        assert len(polled_feed_ids) == 3
+        assert HostLease.query.filter(HostLease.owner != None).count() == 0
+
     @httpretty.httprettified
     def test_poll_feed_basics(self):
         # Дата публикации новости "оссийское правительство принимает меры
@@ -167,14 +299,268 @@ class TestPollFeeds(TestCase):
         # И отражают записи как до "обновления фида", так и после
         assert set(guids_in_db) == (guids_before_update | guids_after_update)
 
-        # Проверим, что после чистки старые элементы не будут подгружены
-        for item in feed.items.all():
-            db.session.delete(item)
+        # Проверим, что после чистки старые элементы не будут подгружены.
+        # Чистка оставляет элемент с последней датой публикации (H), по нему
+        # отсеиваются повторы
+        feed.last_sent_at = dt.datetime.utcnow() + dt.timedelta(days=1)
         db.session.commit()
+        cleanup.delete_sent_feed_items(feed)
+        assert feed.items.count() == 1
 
         poll_feeds.poll_feed(feed)
         db.session.commit()
-        assert feed.items.count() == 0
+        assert feed.items.count() == 1
+
+    def partition_feed_item(self):
+        # В секционированной feed_item уникальный индекс включает created_at
+        # (см. rsstank.cleanup). На SQLite секций нет, но индекс тот же
+        if db.engine.dialect.name == 'mysql':
+            cleanup.partition_feed_item()
+        else:
+            db.session.execute('DROP INDEX ix_feed_item_feed_id_guid_hash')
+            db.session.execute('CREATE UNIQUE INDEX ix_feed_item_feed_id_guid_hash '
+                               'ON feed_item (feed_id, guid_hash, created_at)')
+            db.session.commit()
+
+    @httpretty.httprettified
+    def test_poll_feed_deduplicates_items_in_partitioned_feed_item(self):
+        self.partition_feed_item()
+
+        feed = fixtures.create_feed('http://news.yandex.ru/hardware.rss', self.access_key)
+        db.session.add(feed)
+        db.session.commit()
+        with open('./tests/fixtures/news.yandex.ru-world-rss-1') as fh:
+            httpretty.register_uri(httpretty.GET, feed.url, body=fh.read())
+
+        with mock.patch.dict(self.app.config, {'RSSTANK_FEED_ITEM_PARTITIONING': True}):
+            poll_feeds.poll_feed(feed)
+            db.session.commit()
+            assert feed.items.count() == 5
+
+            # Элементы сохранены при прошлом опросе, а фид разбирается заново
+            db.session.execute(FeedItem.__table__.update().values(
+                created_at=dt.datetime.utcnow() - dt.timedelta(hours=1)))
+            feed.content_digest = None
+            db.session.commit()
+            poll_feeds.poll_feed(feed)
+            db.session.commit()
+            # Самый свежий элемент, опубликованный одновременно с last_pub_date,
+            # не сохранён второй раз
+            assert feed.items.count() == 5
+
+    @httpretty.httprettified
+    def test_poll_feed_skips_items_of_dropped_partitions(self):
+        self.partition_feed_item()
+        feed = fixtures.create_feed('http://news.yandex.ru/hardware.rss', self.access_key)
+        db.session.add(feed)
+        db.session.commit()
+        with open('./tests/fixtures/news.yandex.ru-world-rss-1') as fh:
+            httpretty.register_uri(httpretty.GET, feed.url, body=fh.read())
+
+        with mock.patch.dict(self.app.config, {'RSSTANK_FEED_ITEM_PARTITIONING': True}):
+            poll_feeds.poll_feed(feed)
+            db.session.commit()
+            assert feed.items.count() == 5
+            assert feed.items.filter_by(pub_date=feed.last_pub_date).count() > 0
+
+            # Все элементы разосланы, и cleanup удалил их секцию -- вместе
+            # с элементом, опубликованным одновременно с last_pub_date
+            utc_now = dt.datetime.utcnow()
+            feed.last_sent_at = utc_now + dt.timedelta(hours=1)
+            feed.content_digest = None
+            db.session.commit()
+            if db.engine.dialect.name == 'mysql':
+                assert cleanup.drop_sent_feed_item_partitions(
+                    cleanup.get_feed_item_partitions(),
+                    utc_now=utc_now + dt.timedelta(days=2)) > 0
+            else:
+                db.session.execute(FeedItem.__table__.delete())
+                db.session.commit()
+            assert feed.items.count() == 0
+
+            # Фид разбирается заново, но разосланное не сохраняется снова
+            # и не попадёт в следующую рассылку
+            poll_feeds.poll_feed(feed)
+            db.session.commit()
+            assert feed.items.count() == 0
+
+    @httpretty.httprettified
+    def test_poll_feed_deduplicates_items_by_guid(self):
+        feed = fixtures.create_feed('http://66.ru/news/society/rss/', self.access_key)
+        feed.last_pub_date = dt.datetime(2013, 11, 20, 12, 0, 0)
+        old_item = fixtures.create_feed_item(1)
+        old_item.guid_hash = FeedItem.hash_guid(old_item.guid)
+        old_item.pub_date = feed.last_pub_date
+        feed.items.append(old_item)
+        db.session.add(feed)
+        db.session.commit()
+
+        rss_item = u'''
+            <item>
+              <title>{guid}</title>
+              <link>http://66.ru/{guid}/</link>
+              <description>{guid}</description>
+              <guid>{guid}</guid>
+              <pubDate>{pub_date}</pubDate>
+            </item>'''
+        rss_data = u'''<?xml version="1.0" encoding="utf-8"?>
+            <rss version="2.0"><channel>
+              <title>66.ru</title><link>http://66.ru</link><description>66.ru</description>
+              {items}
+            </channel></rss>'''.format(items=u''.join([
+            # Уже сохранённый элемент, переопубликованный позже
+            rss_item.format(guid='1', pub_date='Wed, 20 Nov 2013 13:00:00 GMT'),
+            # Новый элемент, опубликованный одновременно с последним
+            rss_item.format(guid='2', pub_date='Wed, 20 Nov 2013 12:00:00 GMT'),
+            # Новый элемент, дважды встречающийся в фиде
+            rss_item.format(guid='3', pub_date='Wed, 20 Nov 2013 14:00:00 GMT'),
+            rss_item.format(guid='3', pub_date='Wed, 20 Nov 2013 14:00:00 GMT'),
+        ]))
+        httpretty.register_uri(httpretty.GET, feed.url, body=rss_data)
+
+        poll_feeds.poll_feed(feed)
+        db.session.commit()
+
+        assert sorted(item.guid for item in feed.items) == ['1', '2', '3']
+        assert feed.last_pub_date == dt.datetime(2013, 11, 20, 14, 0, 0)
+
+    @httpretty.httprettified
+    def test_poll_feed_conditional_get(self):
+        feed = fixtures.create_feed('http://news.yandex.ru/hardware.rss', self.access_key)
+        db.session.add(feed)
+        db.session.commit()
+
+        etag = '"5e5c8a1a"'
+        last_modified = 'Wed, 20 Nov 2013 06:31:59 GMT'
+        with open('./tests/fixtures/news.yandex.ru-hardware-rss') as fh:
+            rss_data = fh.read()
+
+        def request_callback(request, uri, headers):
+            if request.headers.get('If-None-Match') == etag:
+                return (304, headers, '')
+            headers.update({'etag': etag, 'last-modified': last_modified})
+            return (200, headers, rss_data)
+
+        httpretty.register_uri(httpretty.GET, feed.url, body=request_callback)
+
+        poll_feeds.poll_feed(feed)
+        db.session.commit()
+        assert feed.items.count() == 15
+        assert feed.etag == etag
+        assert feed.last_modified == last_modified
+        assert feed.next_poll_at > feed.last_polled_at
+
+        # Повторный опрос должен быть условным, а ответ 304 -- не разбираться
+        with mock.patch('feedparser.parse') as parse_mock:
+            poll_feeds.poll_feed(feed)
+            db.session.commit()
+        assert not parse_mock.called
+        request = httpretty.last_request()
+        assert request.headers['If-None-Match'] == etag
+        assert request.headers['If-Modified-Since'] == last_modified
+        assert feed.items.count() == 15
+
+    @httpretty.httprettified
+    def test_poll_feed_skips_unchanged_body(self):
+        feed = fixtures.create_feed('http://66.ru/news/society/rss/', self.access_key)
+        db.session.add(feed)
+        db.session.commit()
+
+        with open('./tests/fixtures/66.ru-society-rss') as fh:
+            rss_data = fh.read()
+        build_dates = iter(['Thu, 21 Nov 2013 06:00:00 +0600',
+                            'Thu, 21 Nov 2013 07:00:00 +0600'])
+
+        def request_callback(request, uri, headers):
+            # Сервер без ETag и Last-Modified, меняющий lastBuildDate
+            # при каждом запросе
+            body = rss_data.replace(
+                '<language>', '<lastBuildDate>{0}</lastBuildDate><language>'
+                .format(next(build_dates)), 1)
+            return (200, headers, body)
+
+        httpretty.register_uri(httpretty.GET, feed.url, body=request_callback)
+
+        poll_feeds.poll_feed(feed)
+        db.session.commit()
+        items_n = feed.items.count()
+        assert items_n > 0
+        assert feed.etag is None and feed.last_modified is None
+        assert feed.content_digest
+        polled_at = feed.last_polled_at
+
+        # Тело не изменилось -- фид не разбирается
+        with mock.patch('feedparser.parse') as parse_mock:
+            poll_feeds.poll_feed(feed)
+            db.session.commit()
+        assert not parse_mock.called
+        assert feed.last_polled_at > polled_at
+        assert feed.items.count() == items_n
+
+        # Изменившееся тело даёт другой хеш
+        assert poll_feeds.get_content_digest(rss_data) != \
+            poll_feeds.get_content_digest(rss_data.replace('147137', '147138'))
+
+    def test_feed_item_writer(self):
+        feed_1 = fixtures.create_feed('http://66.ru/news/society/rss/', self.access_key)
+        feed_2 = fixtures.create_feed('http://news.yandex.ru/hardware.rss', self.access_key)
+        db.session.add_all([feed_1, feed_2])
+        db.session.commit()
+
+        polled_at = dt.datetime(2013, 11, 21, 12, 0, 0)
+        writer = poll_feeds.FeedItemWriter(chunk_size=2)
+        writer.add(feed_1, [fixtures.create_feed_item(i) for i in range(3)],
+                   last_polled_at=polled_at,
+                   last_pub_date=dt.datetime(2013, 11, 21, 12, 0, 0))
+        assert writer.is_full
+        writer.add(feed_2, [fixtures.create_feed_item(i) for i in range(2)],
+                   last_polled_at=polled_at, etag='"abc"')
+
+        with mock.patch.object(db.session, 'execute',
+                               wraps=db.session.execute) as execute_mock:
+            writer.flush()
+        db.session.commit()
+        # Пять элементов пачками по два -- три INSERT-а, и один UPDATE
+        # на оба фида
+        assert execute_mock.call_count == 4
+        assert not writer.is_full
+
+        assert feed_1.items.count() == 3
+        assert feed_2.items.count() == 2
+        assert feed_1.last_polled_at == feed_2.last_polled_at == polled_at
+        assert feed_1.last_pub_date == dt.datetime(2013, 11, 21, 12, 0, 0)
+        assert feed_1.etag is None
+        # Колонки, которые не передавались, остались нетронутыми
+        assert feed_2.last_pub_date is None
+        assert feed_2.etag == '"abc"'
+        assert feed_2.channel_title == 'title'
+
+    def test_commit_writer_drops_failed_feeds(self):
+        feeds = [fixtures.create_feed('http://66.ru/{0}.rss'.format(i), self.access_key)
+                 for i in range(4)]
+        db.session.add_all(feeds)
+        db.session.commit()
+
+        polled_at = dt.datetime(2013, 11, 21, 12, 0, 0)
+        writer = poll_feeds.FeedItemWriter(chunk_size=100)
+        for feed in feeds[:3]:
+            writer.add(feed, [fixtures.create_feed_item(i) for i in range(2)],
+                       last_polled_at=polled_at)
+        # Элемент, который не получится записать в БД
+        writer._item_rows[2]['title'] = object()
+        poll_feeds.commit_writer(writer)
+
+        # Результаты опроса второго фида отброшены, остальные записаны
+        assert [feed.items.count() for feed in feeds[:3]] == [2, 0, 2]
+        assert [feed.last_polled_at for feed in feeds[:3]] == \
+            [polled_at, None, polled_at]
+
+        # Writer пуст, и следующие фиды записываются
+        writer.add(feeds[3], [fixtures.create_feed_item(0)], last_polled_at=polled_at)
+        poll_feeds.commit_writer(writer)
+        assert feeds[3].items.count() == 1
+        assert feeds[3].last_polled_at == polled_at
+        assert feeds[1].items.count() == 0
 
     @httpretty.httprettified
     def test_poll_feed_parse_defective_feed_items(self):
@@ -191,6 +577,260 @@ class TestPollFeeds(TestCase):
         assert feed.items.count() == 1
         assert feed.items.first().guid == 'http://link.url'
 
+    @httpretty.httprettified
+    def test_poll_feed_atom_without_subtitle(self):
+        feed = fixtures.create_feed('http://66.ru/news/atom/', self.access_key)
+        db.session.add(feed)
+        db.session.commit()
+
+        # <subtitle> у Atom-фида необязателен
+        atom_data = u'''<?xml version="1.0" encoding="utf-8"?>
+            <feed xmlns="http://www.w3.org/2005/Atom">
+              <title>66.ru</title><link href="http://66.ru/"/><id>urn:66.ru</id>
+              <updated>2013-11-20T14:00:00Z</updated>
+              <entry>
+                <title>Новость</title><link href="http://66.ru/1/"/><id>urn:66.ru:1</id>
+                <published>2013-11-20T14:00:00Z</published><summary>Новость</summary>
+              </entry>
+            </feed>'''
+        httpretty.register_uri(httpretty.GET, feed.url, body=atom_data.encode('utf-8'))
+
+        poll_feeds.poll_feed(feed)
+        db.session.commit()
+        assert [item.guid for item in feed.items] == ['urn:66.ru:1']
+        assert feed.channel_title == '66.ru'
+        assert feed.channel_description is None
+
+    @httpretty.httprettified
+    def test_poll_feed_stops_parsing_at_old_items(self):
+        feed = fixtures.create_feed('http://66.ru/news/society/rss/', self.access_key)
+        feed.last_pub_date = dt.datetime(2013, 11, 20, 12, 0, 0)
+        db.session.add(feed)
+        db.session.commit()
+
+        rss_item = u'''
+            <item>
+              <title>{guid}</title>
+              <link>http://66.ru/{guid}/</link>
+              <description>{description}</description>
+              <guid>{guid}</guid>
+              <pubDate>{pub_date}</pubDate>
+            </item>'''
+        rss_data = u'''<?xml version="1.0" encoding="utf-8"?>
+            <rss version="2.0"><channel>
+              <title>66.ru</title><link>http://66.ru</link><description>66.ru</description>
+              {items}
+            </channel></rss>'''
+        new_items = [
+            rss_item.format(guid=guid, description=u'Новость', pub_date=pub_date)
+            for guid, pub_date in (('3', 'Wed, 20 Nov 2013 14:00:00 GMT'),
+                                   ('2', 'Wed, 20 Nov 2013 13:00:00 GMT'))]
+        # Длинная вереница уже сохранённых элементов с громоздкими описаниями
+        old_items = [
+            rss_item.format(guid=i, description=u'x' * 10000,
+                            pub_date='Tue, 19 Nov 2013 12:00:00 GMT')
+            for i in range(100, 300)]
+        # Испорченный конец документа, до которого разбор не должен дойти
+        broken_tail = u'<item><title>&nbsp;</title></item>'
+        rss_data = rss_data.format(
+            items=u''.join(new_items + old_items + [broken_tail]))
+        httpretty.register_uri(httpretty.GET, feed.url, body=rss_data.encode('utf-8'))
+
+        with mock.patch('rsstank.poll_feeds.ResponseStream.read_all') as read_all_mock:
+            result = poll_feeds.fetch_feed(feed.url, watermark=feed.last_pub_date)
+        # Документ не дочитывался и не разбирался целиком
+        assert not read_all_mock.called
+        assert [entry.guid for entry in result.feed_data.entries] == ['3', '2']
+        assert result.feed_data.feed.title == '66.ru'
+
+        poll_feeds.poll_feed(feed)
+        db.session.commit()
+        assert sorted(item.guid for item in feed.items) == ['2', '3']
+        assert feed.items.filter_by(guid='3').first().description == u'Новость'
+
+        # Фид больше RSSTANK_MAX_FEED_SIZE не опрашивается
+        with mock.patch.dict(self.app.config, {'RSSTANK_MAX_FEED_SIZE': 1000}):
+            with pytest.raises(poll_feeds.FeedTooLargeError):
+                poll_feeds.fetch_feed(feed.url)
+
+    @httpretty.httprettified
+    def test_poll_feed_parses_oldest_first_feed_to_the_end(self):
+        feed_url = 'http://ascending.example.com/rss/'
+        with open('./tests/fixtures/oldest-first-rss') as fh:
+            httpretty.register_uri(httpretty.GET, feed_url, body=fh.read())
+        feed = fixtures.create_feed(feed_url, self.access_key)
+        # Шесть первых элементов фида уже сохранены, новые -- в его конце
+        feed.last_pub_date = dt.datetime(2013, 11, 20, 12, 0, 0)
+        db.session.add(feed)
+        db.session.commit()
+
+        with mock.patch.dict(self.app.config, RSSTANK_OLD_ITEMS_TO_STOP_PARSING=3):
+            poll_feeds.poll_feed(feed)
+        db.session.commit()
+        assert sorted(item.guid for item in feed.items) == [
+            'http://ascending.example.com/news/7/',
+            'http://ascending.example.com/news/8/']
+        assert feed.last_pub_date == dt.datetime(2013, 11, 20, 14, 0, 0)
+
+    def test_get_poll_interval(self):
+        feed = fixtures.create_feed('http://66.ru/news/society/rss/', self.access_key)
+        feed.sending_interval = 60 * 60 * 24
+        hour = 60 * 60
+
+        # Частота публикаций неизвестна
+        assert poll_feeds.get_poll_interval(feed) == \
+            self.app.config['RSSTANK_DEFAULT_POLL_INTERVAL']
+
+        # Средний промежуток между новыми публикациями и предыдущей
+        feed.last_pub_date = dt.datetime(2013, 11, 20, 12, 0, 0)
+        pub_dates = [dt.datetime(2013, 11, 20, 14, 0, 0),
+                     dt.datetime(2013, 11, 20, 16, 0, 0)]
+        assert poll_feeds.get_poll_interval(feed, pub_dates) == 2 * hour
+        # Но не чаще, чем позволяет Cache-Control...
+        assert poll_feeds.get_poll_interval(feed, pub_dates, ttl=3 * hour) == 3 * hour
+        # ...и RSSTANK_MIN_POLL_INTERVAL
+        pub_dates = [dt.datetime(2013, 11, 20, 12, 1, 0)]
+        assert poll_feeds.get_poll_interval(feed, pub_dates) == \
+            self.app.config['RSSTANK_MIN_POLL_INTERVAL']
+
+        # Без новых элементов интервал удваивается...
+        feed.last_polled_at = dt.datetime(2013, 11, 20, 12, 0, 0)
+        feed.next_poll_at = dt.datetime(2013, 11, 20, 16, 0, 0)
+        assert poll_feeds.get_poll_interval(feed) == 8 * hour
+        # ...но не превышает интервала рассылки фида
+        feed.sending_interval = 6 * hour
+        assert poll_feeds.get_poll_interval(feed) == 6 * hour
+
+    @httpretty.httprettified
+    def test_poll_feed_backs_off_after_errors(self):
+        feed = fixtures.create_feed('http://66.ru/news/society/rss/', self.access_key)
+        db.session.add(feed)
+        db.session.commit()
+
+        min_interval = self.app.config['RSSTANK_MIN_POLL_INTERVAL']
+        for errors_n in (1, 2, 3):
+            with mock.patch('rsstank.poll_feeds.fetch_feed', autospec=True,
+                            side_effect=requests.Timeout()):
+                with pytest.raises(requests.Timeout):
+                    poll_feeds.poll_feed(feed)
+            db.session.commit()
+            # С каждой ошибкой подряд следующая попытка откладывается вдвое дальше
+            assert feed.poll_errors_n == errors_n
+            interval = poll_feeds.total_seconds(feed.next_poll_at - dt.datetime.utcnow())
+            assert min_interval * 2 ** (errors_n - 1) - 5 < interval <= \
+                min_interval * 2 ** (errors_n - 1)
+            assert feed.last_polled_at is None
+
+        # Но не дальше RSSTANK_MAX_POLL_INTERVAL
+        feed.poll_errors_n = 100
+        assert poll_feeds.get_retry_interval(feed) == \
+            self.app.config['RSSTANK_MAX_POLL_INTERVAL']
+        feed.poll_errors_n = 3
+
+        # Удачный опрос сбрасывает счётчик ошибок
+        with mock.patch('rsstank.poll_feeds.fetch_feed', autospec=True,
+                        return_value=poll_feeds.FetchResult(
+                            status_code=304, etag=None, last_modified=None,
+                            feed_data=None, ttl=None, content_digest=None)):
+            poll_feeds.poll_feed(feed)
+        db.session.commit()
+        assert feed.poll_errors_n == 0
+        assert feed.last_polled_at is not None
+
+    @httpretty.httprettified
+    def test_poll_feeds_reuses_session(self):
+        feed_ids = []
+        for feed_url in ('http://66.ru/news/society/rss/',
+                         'http://66.ru/news/business/rss/'):
+            feed = fixtures.create_feed(feed_url, self.access_key)
+            db.session.add(feed)
+            db.session.commit()
+            feed_ids.append(feed.id)
+            with open('./tests/fixtures/66.ru-society-rss') as fh:
+                httpretty.register_uri(httpretty.GET, feed_url, body=fh.read())
+
+        session = requests.Session()
+        with mock.patch.object(session, 'get', wraps=session.get) as get_mock:
+            poll_feeds.poll_feeds(feed_ids, session=session)
+
+        # Оба фида скачаны через одну сессию и с таймаутами
+        assert get_mock.call_count == 2
+        expected_timeout = (self.app.config['RSSTANK_CONNECT_TIMEOUT'],
+                            self.app.config['RSSTANK_READ_TIMEOUT'])
+        for _, kwargs in get_mock.call_args_list:
+            assert kwargs['timeout'] == expected_timeout
+        for feed_id in feed_ids:
+            assert Feed.query.get(feed_id).items.count() > 0
+
+    @httpretty.httprettified
+    def test_poll_feeds_fetches_same_url_once(self):
+        feed_url = 'http://66.ru/news/society/rss/'
+        with open('./tests/fixtures/66.ru-society-rss') as fh:
+            httpretty.register_uri(httpretty.GET, feed_url, body=fh.read())
+
+        other_key = AccessKey(content='other', namespace='other', is_enabled=True)
+        other_key.enabled_at = self.access_key.enabled_at
+        feeds = [fixtures.create_feed(feed_url, self.access_key),
+                 fixtures.create_feed(feed_url + '#fragment', self.access_key),
+                 fixtures.create_feed('http://66.RU/news/society/rss/', other_key)]
+        # Один из подписчиков уже видел часть элементов
+        feeds[2].last_pub_date = dt.datetime(2013, 11, 13, 6, 0, 0)
+        db.session.add_all(feeds)
+        db.session.commit()
+        feed_ids = [feed.id for feed in feeds]
+        assert poll_feeds.group_feed_ids_by_url(feed_ids) == [feed_ids]
+
+        session = requests.Session()
+        with mock.patch.object(session, 'get', wraps=session.get) as get_mock:
+            poll_feeds.poll_feeds(feed_ids, session=session)
+
+        # Фид скачан однажды, а элементы сохранены для каждого подписчика
+        assert get_mock.call_count == 1
+        items_numbers = [feed.items.count() for feed in Feed.query.order_by(Feed.id)]
+        assert items_numbers[0] == items_numbers[1] > items_numbers[2] > 0
+
+    def test_poll_feeds_skips_deleted_feeds(self):
+        feed_urls = ['http://66.ru/news/society/rss/',
+                     'http://66.ru/news/business/rss/',
+                     'http://66.ru/news/freetime/rss/']
+        engines = [
+            lambda feed_ids: poll_feeds.poll_feeds(feed_ids),
+            lambda feed_ids: poll_feeds.poll_hosts_async({'66.ru': feed_ids}),
+        ]
+        for engine in engines:
+            feeds = [fixtures.create_feed(feed_url, self.access_key)
+                     for feed_url in feed_urls]
+            db.session.add_all(feeds)
+            db.session.commit()
+            feed_ids = [feed.id for feed in feeds]
+            db.session.remove()
+
+            def side_effect(url, etag=None, last_modified=None, session=None,
+                            watermark=None, content_digest=None):
+                if url == feed_urls[0]:
+                    # Пока опрашивается первый фид, update_feeds удаляет последний
+                    with db.engine.begin() as connection:
+                        connection.execute(Feed.__table__.delete().where(
+                            Feed.__table__.c.id == feed_ids[-1]))
+                return poll_feeds.FetchResult(
+                    status_code=304, etag=None, last_modified=None,
+                    feed_data=None, ttl=None, content_digest=None)
+
+            with mock.patch.dict(self.app.config, RSSTANK_DEFAULT_CRAWL_DELAY=0), \
+                    mock.patch('rsstank.poll_feeds.fetch_robots_txt',
+                               autospec=True, return_value=None), \
+                    mock.patch('rsstank.poll_feeds.fetch_feed', autospec=True,
+                               side_effect=side_effect) as fetch_feed_mock:
+                engine(feed_ids)
+
+            # Удалённый фид пропущен, а результаты опроса остальных сохранены
+            assert fetch_feed_mock.call_count == 2
+            assert Feed.query.get(feed_ids[-1]) is None
+            for feed_id in feed_ids[:-1]:
+                assert Feed.query.get(feed_id).last_polled_at is not None
+            Feed.query.delete()
+            db.session.commit()
+
     @httpretty.httprettified
     def test_main(self):
         httpretty.register_uri(
@@ -212,7 +852,8 @@ class TestPollFeeds(TestCase):
 
         call_datetimes_by_hosts = collections.defaultdict(list)
 
-        def side_effect(feed):
+        def side_effect(feeds, session=None, writer=None):
+            feed, = feeds
             if feed.url == 'http://incorrect-urlx':
                 raise requests.ConnectionError()
             elif feed.url == 'http://66.ru/404':
@@ -221,7 +862,7 @@ class TestPollFeeds(TestCase):
                 host = furl(feed.url).host
                 call_datetimes_by_hosts[host].append(dt.datetime.utcnow())
 
-        with mock.patch('rsstank.poll_feeds.poll_feed',
+        with mock.patch('rsstank.poll_feeds.poll_same_feeds',
                         autospec=True, side_effect=side_effect) as poll_feed_mock:
             poll_feeds.main()
 
@@ -242,3 +883,71 @@ class TestPollFeeds(TestCase):
             call_datetimes,
             dt.timedelta(seconds=2),
             dt.timedelta(milliseconds=15))
+
+    @httpretty.httprettified
+    def test_main_async(self):
+        httpretty.register_uri(
+            httpretty.GET, 'http://news.yandex.ru/robots.txt', body=ROBOTS_TXT_1)
+        httpretty.register_uri(
+            httpretty.GET, 'http://66.ru/robots.txt', body=ROBOTS_TXT_2)
+
+        for feed_url in ('http://66.ru/news/society/rss/',
+                         'http://66.ru/news/business/rss/',
+                         'http://66.ru/news/freetime/rss/',
+                         'http://66.ru/a/b/c/',
+                         'http://news.yandex.ru/hardware.rss',
+                         'http://news.yandex.ru/fire.rss'):
+            feed = fixtures.create_feed(feed_url, self.access_key)
+            db.session.add(feed)
+        db.session.commit()
+
+        call_datetimes_by_hosts = collections.defaultdict(list)
+
+        def side_effect(url, etag=None, last_modified=None, session=None,
+                        watermark=None, content_digest=None):
+            call_datetimes_by_hosts[furl(url).host].append(dt.datetime.utcnow())
+            if url == 'http://news.yandex.ru/fire.rss':
+                raise requests.ConnectionError()
+            return poll_feeds.FetchResult(
+                status_code=304, etag=None, last_modified=None, feed_data=None,
+                ttl=None, content_digest=None)
+
+        with mock.patch('rsstank.poll_feeds.fetch_feed',
+                        autospec=True, side_effect=side_effect):
+            poll_feeds.main(engine='async')
+
+        def assert_deltas_equal(sequence, x, precision):
+            deltas = [next_el - el for el, next_el in zip(sequence, sequence[1:])]
+            assert all((x < delta < x + precision) for delta in deltas)
+
+        # http://66.ru/a/b/c/ запрещён robots.txt
+        call_datetimes = call_datetimes_by_hosts['66.ru']
+        assert len(call_datetimes) == 3
+        assert_deltas_equal(
+            call_datetimes,
+            dt.timedelta(seconds=1),
+            dt.timedelta(milliseconds=100))
+
+        call_datetimes = call_datetimes_by_hosts['news.yandex.ru']
+        assert len(call_datetimes) == 2
+        assert_deltas_equal(
+            call_datetimes,
+            dt.timedelta(seconds=2),
+            dt.timedelta(milliseconds=100))
+
+        # Хосты опрашивались одновременно, а не друг за другом
+        assert (max(call_datetimes_by_hosts['66.ru']) >
+                min(call_datetimes_by_hosts['news.yandex.ru']))
+
+        # Ответ 304 записан в БД, ошибка соединения -- нет
+        polled_urls = set(feed.url for feed in Feed.query.filter(
+            Feed.last_polled_at != None))
+        assert polled_urls == {'http://66.ru/news/society/rss/',
+                               'http://66.ru/news/business/rss/',
+                               'http://66.ru/news/freetime/rss/',
+                               'http://news.yandex.ru/hardware.rss'}
+        # Но следующая попытка опросить фид, не ответивший из-за ошибки
+        # соединения, отложена
+        failed_feed = Feed.query.filter_by(url='http://news.yandex.ru/fire.rss').one()
+        assert failed_feed.poll_errors_n == 1
+        assert failed_feed.next_poll_at > dt.datetime.utcnow()
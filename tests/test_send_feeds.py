@@ -1,4 +1,6 @@
 # coding: utf-8
+import time
+import threading
 import datetime as dt
 
 import pytest
@@ -126,6 +128,52 @@ class TestSendFeeds(TestCase):
         feed.last_sent_at = dt.datetime.utcnow() + dt.timedelta(days=1)
         assert not feed.are_there_items_to_send()
 
+    def test_get_feeds_to_send(self):
+        def create_feed(name, last_sent_at=None, items_created_at=(),
+                        access_key=self.access_key):
+            feed = fixtures.create_feed(name, access_key)
+            feed.last_sent_at = last_sent_at
+            for i, created_at in enumerate(items_created_at):
+                feed_item = fixtures.create_feed_item(i)
+                feed_item.created_at = created_at
+                feed.items.append(feed_item)
+            db.session.add(feed)
+
+        utc_interval_start, utc_interval_end = get_first_send_interval_as_datetimes()
+        for utc_now, expected_names in (
+                (utc_interval_start + dt.timedelta(minutes=30),
+                 {'never-sent', 'sent-long-ago', 'sent-interval-ago'}),
+                (utc_interval_end + dt.timedelta(hours=1),
+                 {'sent-long-ago', 'sent-interval-ago'})):
+            FeedItem.query.delete()
+            Feed.query.delete()
+
+            day_ago = utc_now - dt.timedelta(days=1)  # `sending_interval` фидов
+            week_ago = utc_now - dt.timedelta(days=7)
+            create_feed('never-sent', items_created_at=[day_ago])
+            create_feed('never-sent-empty')
+            create_feed('sent-long-ago', last_sent_at=week_ago,
+                        items_created_at=[week_ago - dt.timedelta(days=1), day_ago])
+            create_feed('sent-long-ago-nothing-new', last_sent_at=week_ago,
+                        items_created_at=[week_ago - dt.timedelta(days=1)])
+            create_feed('sent-recently', last_sent_at=utc_now - dt.timedelta(hours=1),
+                        items_created_at=[utc_now - dt.timedelta(minutes=1)])
+            create_feed('sent-interval-ago', last_sent_at=day_ago,
+                        items_created_at=[utc_now - dt.timedelta(minutes=1)])
+            create_feed('disabled', items_created_at=[day_ago],
+                        access_key=self.disabled_access_key)
+            db.session.commit()
+
+            with freezegun.freeze_time(utc_now):
+                # Запрос выбирает те же фиды, что и проверки на стороне Python
+                expected_by_methods = set(
+                    feed.url for feed in self.access_key.feeds
+                    if feed.is_it_time_to_send() and feed.are_there_items_to_send())
+                feeds = send_feeds.get_feeds_to_send().all()
+
+            assert set(feed.url for feed in feeds) == expected_names
+            assert expected_by_methods == expected_names
+
     def test_send_feed_boundary_cases(self):
         feed = fixtures.create_feed('http://example.com/example-1.rss', self.access_key)
         feed.access_key = self.access_key
@@ -151,7 +199,7 @@ class TestSendFeeds(TestCase):
 
         # Делаем вид, что Mailtank API вернул 503
         mailtank_error_stub = MailtankErrorStub(503, 'Whoops')
-        with mock.patch('mailtank.Mailtank.create_mailing',
+        with mock.patch('rsstank.models.MailtankClient.create_mailing',
                         autospec=True, side_effect=mailtank_error_stub):
             with testfixtures.LogCapture() as l:
                 send_feeds.send_feed(feed)
@@ -179,7 +227,7 @@ class TestSendFeeds(TestCase):
         db.session.commit()
 
         # Проверяем, что в рассылке не будет дублирующихся элементов фида
-        with mock.patch('mailtank.Mailtank.create_mailing',
+        with mock.patch('rsstank.models.MailtankClient.create_mailing',
                         autospec=True) as create_mailing_mock:
             send_feeds.send_feed(feed)
 
@@ -189,6 +237,22 @@ class TestSendFeeds(TestCase):
         assert context['items'][1]['pub_date'] == \
             item1.pub_date.strftime('%Y-%m-%d %H:%M:%S')
 
+    def test_items_limit_in_mailing(self):
+        feed = fixtures.create_feed('http://example.com/example-1.rss', self.access_key)
+        feed.items.extend([fixtures.create_feed_item(i) for i in range(5)])
+        db.session.add(feed)
+        db.session.commit()
+
+        with mock.patch.dict(app.config, {'RSSTANK_MAX_ITEMS_PER_MAILING': 3}):
+            with mock.patch('rsstank.models.MailtankClient.create_mailing',
+                            autospec=True) as create_mailing_mock:
+                send_feeds.send_feed(feed)
+
+        # В рассылку попали три самых свежих элемента, от старых к новым
+        _, kwargs = create_mailing_mock.call_args
+        assert [item['guid'] for item in kwargs['context']['items']] == \
+            ['2', '1', '0']
+
     def test_context_contains_channel_data(self):
         feed = fixtures.create_feed('http://example.com/example-1.rss', self.access_key)
         item = fixtures.create_feed_item(1)
@@ -196,7 +260,7 @@ class TestSendFeeds(TestCase):
         db.session.add(feed)
         db.session.commit()
 
-        with mock.patch('mailtank.Mailtank.create_mailing',
+        with mock.patch('rsstank.models.MailtankClient.create_mailing',
                         autospec=True) as create_mailing_mock:
             send_feeds.send_feed(feed)
 
@@ -240,6 +304,7 @@ class TestSendFeeds(TestCase):
         # ==============
         # Заявляем, что в последний раз посылали первый фид три дня назад
         feed_1.last_sent_at = dt.datetime.utcnow() - dt.timedelta(days=4)
+        db.session.commit()
 
         # Замораживаем время где-нибудь в будущем, но точно вне интервала,
         # допускающего посылку вида впервые
@@ -247,7 +312,7 @@ class TestSendFeeds(TestCase):
             utc_now=dt.datetime.utcnow() + dt.timedelta(days=1))
         freezed_utc_now = utc_interval_end + dt.timedelta(seconds=1)
         with freezegun.freeze_time(freezed_utc_now):
-            with mock.patch('mailtank.Mailtank.create_mailing',
+            with mock.patch('rsstank.models.MailtankClient.create_mailing',
                             autospec=True) as create_mailing_mock:
                 send_feeds.main()
 
@@ -271,7 +336,7 @@ class TestSendFeeds(TestCase):
         # Случай номер 2
         # ==============
         # Запускаем команду в это же время во второй раз. Ничего не должно произойти
-        with mock.patch('mailtank.Mailtank.create_mailing',
+        with mock.patch('rsstank.models.MailtankClient.create_mailing',
                         autospec=True) as create_mailing_mock:
             with freezegun.freeze_time(freezed_utc_now):
                 send_feeds.main()
@@ -295,7 +360,7 @@ class TestSendFeeds(TestCase):
             utc_now=freezed_utc_now)
 
         with freezegun.freeze_time(freezed_utc_now):
-            with mock.patch('mailtank.Mailtank.create_mailing',
+            with mock.patch('rsstank.models.MailtankClient.create_mailing',
                             autospec=True) as create_mailing_mock:
                 send_feeds.main()
 
@@ -319,3 +384,55 @@ class TestSendFeeds(TestCase):
 
         assert feed_1.last_sent_at == freezed_utc_now
         assert feed_2.last_sent_at == freezed_utc_now
+
+    def test_send_feeds_limits_concurrency_per_key(self):
+        feeds = []
+        for i in range(5):
+            feed = fixtures.create_feed(
+                'http://example.com/example-{0}.rss'.format(i), self.access_key)
+            feed.last_sent_at = dt.datetime.utcnow() - dt.timedelta(days=1)
+            feed.items.append(fixtures.create_feed_item(i))
+            db.session.add(feed)
+            feeds.append(feed)
+        db.session.commit()
+        failing_tag = feeds[2].tag
+
+        class MailtankErrorStub(mailtank.MailtankError):
+            def __init__(self, code, message):
+                self.code = code
+                self.message = message
+
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def create_mailing(mailtank_, **kwargs):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            if kwargs['target']['tags'] == [failing_tag]:
+                raise MailtankErrorStub(503, 'Whoops')
+
+        with mock.patch.dict(app.config, {'RSSTANK_SEND_WORKERS': 10,
+                                          'RSSTANK_SEND_WORKERS_PER_KEY': 2}):
+            with mock.patch('rsstank.models.MailtankClient.create_mailing', autospec=True,
+                            side_effect=create_mailing) as create_mailing_mock:
+                with testfixtures.LogCapture() as l:
+                    send_feeds.send_feeds(feeds)
+
+        assert create_mailing_mock.call_count == 5
+        # По одному ключу одновременно выполнялось не больше двух запросов
+        assert max_running[0] == 2
+
+        # Ошибка Mailtank API отражена в логах и не помешала остальным фидам
+        assert any(r.levelname == 'WARNING' and repr(feeds[2]) in r.getMessage()
+                   for r in l.records)
+        yesterday = dt.datetime.utcnow() - dt.timedelta(hours=12)
+        for i, feed in enumerate(feeds):
+            if i == 2:
+                assert feed.last_sent_at < yesterday
+            else:
+                assert feed.last_sent_at > yesterday
@@ -1,14 +1,18 @@
 # coding: utf-8
 import json
+import time
+import datetime as dt
+import threading
 
 import mock
 import httpretty
 import furl
+import concurrent.futures
 
-from . import TestCase
+from . import TestCase, fixtures
 from rsstank import update_feeds, db
 from rsstank.update_feeds import sync
-from rsstank.models import AccessKey, Feed
+from rsstank.models import AccessKey, Feed, FeedItem
 
 
 TAGS_DATA = {
@@ -71,6 +75,39 @@ class TestUpdateFeeds(TestCase):
         sync(tags, key)
         assert not Feed.query.first()
 
+    def test_sync_deletes_stale_feed_items(self):
+        key = AccessKey(content='asdf', namespace='a')
+        sync(['rss:a:http://go.rss/feed:100',
+              'rss:a:http://go.rss/feed:100',
+              'rss:a:http://no.rss/feed:100'], key)
+        # Одинаковые теги дают один фид
+        assert Feed.query.count() == 2
+
+        feed = Feed.query.filter_by(url='http://no.rss/feed').one()
+        feed.items.extend([fixtures.create_feed_item(i) for i in range(3)])
+        kept_feed = Feed.query.filter_by(url='http://go.rss/feed').one()
+        kept_feed.items.append(fixtures.create_feed_item(3))
+        db.session.commit()
+        kept_feed_id = kept_feed.id
+
+        sync(['rss:a:http://go.rss/feed:100'], key)
+        assert [feed.id for feed in Feed.query] == [kept_feed_id]
+        assert [item.feed_id for item in FeedItem.query] == [kept_feed_id]
+
+    def test_is_sync_needed(self):
+        tags = ['rss:a:http://go.rss/feed:100', u'rss:a:http://фид.рф:200']
+        key = AccessKey(content='asdf', namespace='a')
+        assert update_feeds.is_sync_needed(tags, key)
+
+        sync(tags, key)
+        assert not update_feeds.is_sync_needed(list(reversed(tags)), key)
+        assert update_feeds.is_sync_needed(tags[:1], key)
+
+        # Время от времени фиды синхронизируются, даже если теги не менялись
+        utc_now = key.tags_synced_at + dt.timedelta(
+            seconds=self.app.config['RSSTANK_FULL_SYNC_INTERVAL'])
+        assert update_feeds.is_sync_needed(tags, key, utc_now=utc_now)
+
     @httpretty.httprettified
     def test_main(self):
         def request_callback(method, uri, headers):
@@ -110,3 +147,82 @@ class TestUpdateFeeds(TestCase):
             assert not b_key.is_enabled
             # Клюс, на который Mailtank ответил 500, остался включенным
             assert d_key.is_enabled
+
+    @httpretty.httprettified
+    def test_get_tags_retries_server_errors(self):
+        httpretty.register_uri(
+            httpretty.GET,
+            '{}/tags/'.format(self.app.config['MAILTANK_API_URL']),
+            responses=[
+                httpretty.Response(body='', status=503),
+                httpretty.Response(body=json.dumps(TAGS_DATA), status=200),
+            ])
+
+        key = AccessKey(namespace='a', content='one', is_enabled=True)
+        # Клиент Mailtank API создаётся однажды на ключ...
+        assert key.mailtank is key.mailtank
+
+        tags = [tag.name for tag in key.get_tags(mask='rss:a:')]
+        assert set(tags) == set(tag['name'] for tag in TAGS_DATA['objects'])
+
+        # ...и забывается, когда ключ выключают
+        mailtank_client = key.mailtank
+        key.is_enabled = False
+        assert key.mailtank is not mailtank_client
+
+    def test_fetch_tags(self):
+        keys = [AccessKey(namespace=namespace, content=namespace, is_enabled=True)
+                for namespace in ('a', 'b', 'hanging')]
+        release = threading.Event()
+
+        def get_tags(key_content, mask):
+            if key_content == 'hanging':
+                release.wait(5)
+            return [mock.Mock(name=mask)]
+
+        config = {'RSSTANK_UPDATE_WORKERS': 2, 'RSSTANK_UPDATE_KEY_TIMEOUT': 0.2}
+        try:
+            with mock.patch.dict(self.app.config, config):
+                with mock.patch('rsstank.update_feeds.get_tags',
+                                side_effect=get_tags):
+                    results = list(update_feeds.fetch_tags(keys))
+        finally:
+            release.set()
+
+        # Зависший ключ не задерживает остальные и не ждётся дольше таймаута
+        errors = dict((key.content, e) for key, tags, e in results)
+        assert set(errors) == {'a', 'b', 'hanging'}
+        assert errors['a'] is None and errors['b'] is None
+        assert isinstance(errors['hanging'], concurrent.futures.TimeoutError)
+        assert results[-1][0].content == 'hanging'
+
+    def test_fetch_tags_gives_up_when_all_workers_hang(self):
+        keys = [AccessKey(namespace=namespace, content=namespace, is_enabled=True)
+                for namespace in ('a', 'b', 'c')]
+        release = threading.Event()
+        called = []
+
+        def get_tags(key_content, mask):
+            called.append(key_content)
+            release.wait(5)
+            return []
+
+        config = {'RSSTANK_UPDATE_WORKERS': 1, 'RSSTANK_UPDATE_KEY_TIMEOUT': 0.1,
+                  'RSSTANK_UPDATE_TIMEOUT': 0.3}
+        started_at = time.time()
+        try:
+            with mock.patch.dict(self.app.config, config):
+                with mock.patch('rsstank.update_feeds.get_tags',
+                                side_effect=get_tags):
+                    results = list(update_feeds.fetch_tags(keys))
+        finally:
+            release.set()
+
+        # Единственный поток занят зависшим запросом, и очередь до остальных
+        # ключей не доходит -- их перестают ждать через RSSTANK_UPDATE_TIMEOUT
+        assert time.time() - started_at < 1
+        assert len(called) == 1
+        assert set(key.content for key, _, _ in results) == {'a', 'b', 'c'}
+        for _, tags, e in results:
+            assert tags is None
+            assert isinstance(e, concurrent.futures.TimeoutError)